@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+
+# Streaming aggregator for the Weather Station
+#
+# Every sample updates running statistics for each measured quantity in the current minute,
+# hour, day and month bucket. Each update is O(1): min/max, mean and variance use Welford's
+# method, percentiles use the P-squared estimator (five markers, no stored samples) and wind
+# direction is kept as a speed-weighted vector sum. gust_peak is the peak gust of each 2 s of a
+# v2 frame's send cycle, several to a packet (AddSeries()).
+#
+# Buckets are keyed on local time as it is when the sample arrives:
+#       minute - Unix time // 60
+#       hour   - local hour together with its UTC offset, so the repeated hour when DST ends
+#                is two buckets and the skipped hour when it starts simply never appears
+#       day    - local date, so a DST day is 23 or 25 hours long
+#       month  - local year and month
+# A bucket is closed as soon as the key changes, in either direction, so a timezone change
+# closes the current buckets instead of reopening old ones. Closed buckets are passed to the
+# listeners given to AddListener().
+#
+# Checkpoint() and Restore() turn the open buckets into plain lists and back, for Checkpoint.py.
+#
+# Run this file directly to check hour/day rollover across a DST change:
+#       python3 Aggregator.py --dst-check
+
+import datetime
+import math
+import time
+import os
+import sys
+import argparse
+
+MINUTE = "minute"
+HOUR = "hour"
+DAY = "day"
+MONTH = "month"
+
+QUANTITIES = ("temp_out", "humid_out", "pressure", "rain", "rain_hour", "wind_speed", "wind_gust", "gust_peak", "battery", "temp_in", "humid_in")
+PERCENTILES = (0.1, 0.5, 0.9)
+
+
+# P-squared single quantile estimator (Jain & Chlamtac 1985)
+class P2Quantile():
+        __slots__ = ("P", "Count", "Heights", "Positions", "Desired", "Increments")
+
+        def __init__(self, p):
+                self.P = p
+                self.Count = 0
+                self.Heights = []
+                self.Positions = [1, 2, 3, 4, 5]
+                self.Desired = [1, 1 + 2*p, 1 + 4*p, 3 + 2*p, 5]
+                self.Increments = [0, p/2, p, (1+p)/2, 1]
+
+        def Add(self, x):
+                q = self.Heights
+                self.Count += 1
+                if self.Count <= 5:
+                        q.append(x)
+                        if self.Count == 5:
+                                q.sort()
+                        return
+                if x < q[0]:
+                        q[0] = x
+                        k = 0
+                elif x >= q[4]:
+                        q[4] = x
+                        k = 3
+                else:
+                        k = 0
+                        while x >= q[k+1]:
+                                k += 1
+                n = self.Positions
+                for i in range(k+1, 5):
+                        n[i] += 1
+                for i in range(5):
+                        self.Desired[i] += self.Increments[i]
+                for i in (1, 2, 3):
+                        d = self.Desired[i] - n[i]
+                        if (d >= 1 and n[i+1] - n[i] > 1) or (d <= -1 and n[i-1] - n[i] < -1):
+                                d = 1 if d > 0 else -1
+                                parabolic = q[i] + d / (n[i+1] - n[i-1]) * ((n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i]) + (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+                                if q[i-1] < parabolic < q[i+1]:
+                                        q[i] = parabolic
+                                else:
+                                        q[i] = q[i] + d * (q[i+d] - q[i]) / (n[i+d] - n[i])
+                                n[i] += d
+
+        def Value(self):
+                if self.Count == 0:
+                        return None
+                if self.Count < 5:
+                        ordered = sorted(self.Heights)
+                        return ordered[min(len(ordered)-1, int(self.P * len(ordered)))]
+                return self.Heights[2]
+
+        def State(self):
+                return [self.Count, self.Heights, self.Positions, self.Desired]
+
+        def Restore(self, state):
+                self.Count, self.Heights, self.Positions, self.Desired = state
+
+
+class RunningStats():
+        __slots__ = ("Count", "Min", "Max", "Mean", "M2", "Last", "Quantiles")
+
+        def __init__(self, percentiles=PERCENTILES):
+                self.Count = 0
+                self.Min = None
+                self.Max = None
+                self.Mean = 0.0
+                self.M2 = 0.0
+                self.Last = None
+                self.Quantiles = tuple(P2Quantile(p) for p in percentiles)
+
+        def Add(self, x):
+                self.Count += 1
+                if self.Count == 1:
+                        self.Min = x
+                        self.Max = x
+                elif x < self.Min:
+                        self.Min = x
+                elif x > self.Max:
+                        self.Max = x
+                delta = x - self.Mean
+                self.Mean += delta / self.Count
+                self.M2 += delta * (x - self.Mean)
+                self.Last = x
+                for quantile in self.Quantiles:
+                        quantile.Add(x)
+
+        def Variance(self):
+                if self.Count < 2:
+                        return 0.0
+                return self.M2 / (self.Count - 1)
+
+        def Percentile(self, p):
+                for quantile in self.Quantiles:
+                        if quantile.P == p:
+                                return quantile.Value()
+                raise KeyError(p)
+
+        def State(self):
+                return [self.Count, self.Min, self.Max, self.Mean, self.M2, self.Last, [quantile.State() for quantile in self.Quantiles]]
+
+        def Restore(self, state):
+                self.Count, self.Min, self.Max, self.Mean, self.M2, self.Last, quantiles = state
+                for quantile, saved in zip(self.Quantiles, quantiles):
+                        quantile.Restore(saved)
+
+
+# Wind direction as vectors: the plain mean of unit vectors and the mean weighted by speed
+class VectorStats():
+        __slots__ = ("Count", "SumSin", "SumCos", "SumWeightedSin", "SumWeightedCos")
+
+        def __init__(self):
+                self.Count = 0
+                self.SumSin = 0.0
+                self.SumCos = 0.0
+                self.SumWeightedSin = 0.0
+                self.SumWeightedCos = 0.0
+
+        def Add(self, degrees, speed):
+                radians = math.radians(degrees)
+                s = math.sin(radians)
+                c = math.cos(radians)
+                self.Count += 1
+                self.SumSin += s
+                self.SumCos += c
+                self.SumWeightedSin += s * speed
+                self.SumWeightedCos += c * speed
+
+# Mean direction in degrees, None if calm or no samples
+        def Direction(self, weighted=True):
+                if weighted:
+                        s, c = self.SumWeightedSin, self.SumWeightedCos
+                else:
+                        s, c = self.SumSin, self.SumCos
+                if self.Count == 0 or (abs(s) < 1e-9 and abs(c) < 1e-9):
+                        return None
+                return math.degrees(math.atan2(s, c)) % 360
+
+# Mean wind speed along the mean direction, always <= the scalar mean speed
+        def VectorSpeed(self):
+                if self.Count == 0:
+                        return 0.0
+                return math.hypot(self.SumWeightedSin, self.SumWeightedCos) / self.Count
+
+        def State(self):
+                return [self.Count, self.SumSin, self.SumCos, self.SumWeightedSin, self.SumWeightedCos]
+
+        def Restore(self, state):
+                self.Count, self.SumSin, self.SumCos, self.SumWeightedSin, self.SumWeightedCos = state
+
+
+class Bucket():
+        __slots__ = ("Key", "Start", "End", "Stats", "Wind")
+
+        def __init__(self, key, start, percentiles):
+                self.Key = key
+                self.Start = start
+                self.End = start
+                self.Stats = {name: RunningStats(percentiles) for name in QUANTITIES}
+                self.Wind = VectorStats()
+
+# Function to get the bucket as plain values, leaving out the quantities it has no samples of
+        def State(self):
+                return [self.Start, self.End, dict((name, stats.State()) for name, stats in self.Stats.items() if stats.Count), self.Wind.State()]
+
+
+# Function to rebuild a bucket from its State(), its key worked out again from its start
+def RestoreBucket(period, state):
+        start, end, stats, wind = state
+        bucket = Bucket(BucketKey(period, start, datetime.datetime.fromtimestamp(start).astimezone()), start, () if period == MINUTE else PERCENTILES)
+        bucket.End = end
+        for name, saved in stats.items():
+                if name in bucket.Stats:
+                        bucket.Stats[name].Restore(saved)
+        bucket.Wind.Restore(wind)
+        return bucket
+
+
+def BucketKey(period, when, local):
+        if period == MINUTE:
+                return int(when // 60)
+        if period == HOUR:
+                return (local.year, local.month, local.day, local.hour, local.utcoffset())
+        if period == DAY:
+                return local.date()
+        return (local.year, local.month)
+
+
+class StreamingAggregator():
+
+        def __init__(self, periods=(MINUTE, HOUR, DAY, MONTH)):
+                self.Periods = periods
+                self.Current = {}
+                self.Previous = {}
+                self.Listeners = []
+
+# Function to register listener(period, bucket), called for every bucket that closes
+        def AddListener(self, listener):
+                self.Listeners.append(listener)
+
+# Function to add one sample. values maps quantity names to numbers, missing or None values are skipped
+        def Add(self, when, values):
+                self.Tick(when)
+                for period in self.Periods:
+                        bucket = self.Current[period]
+                        bucket.End = when
+                        stats = bucket.Stats
+                        for name, value in values.items():
+                                if value is not None and name in stats:
+                                        stats[name].Add(value)
+                        direction = values.get("wind_dir")
+                        if direction is not None:
+                                bucket.Wind.Add(direction, values.get("wind_speed") or 0)
+
+# Function to add several samples of one quantity that came in the same packet, oldest first
+        def AddSeries(self, when, name, values):
+                self.Tick(when)
+                for period in self.Periods:
+                        stats = self.Current[period].Stats[name]
+                        for value in values:
+                                stats.Add(value)
+
+# Function to close any bucket whose period has ended, also called when no samples arrive
+        def Tick(self, when):
+                local = datetime.datetime.fromtimestamp(when).astimezone()
+                for period in self.Periods:
+                        key = BucketKey(period, when, local)
+                        bucket = self.Current.get(period)
+                        if bucket is not None and bucket.Key == key:
+                                continue
+                        self.Current[period] = Bucket(key, when, () if period == MINUTE else PERCENTILES)
+                        if bucket is not None:
+                                self.Previous[period] = bucket
+                                for listener in self.Listeners:
+                                        listener(period, bucket)
+
+# Function to get the open buckets and the last closed ones as plain values, minutes left out as they close so soon
+        def Checkpoint(self):
+                return {"current": dict((period, bucket.State()) for period, bucket in self.Current.items() if period != MINUTE),
+                        "previous": dict((period, bucket.State()) for period, bucket in self.Previous.items() if period != MINUTE)}
+
+# Function to put back what Checkpoint() returned. Buckets that have ended since close at the next Tick()
+        def Restore(self, state):
+                for which, buckets in (("current", self.Current), ("previous", self.Previous)):
+                        for period, saved in state[which].items():
+                                if period in self.Periods:
+                                        buckets[period] = RestoreBucket(period, saved)
+
+# Function to get the running stats of a quantity in the current bucket, None if no samples yet
+        def Stats(self, period, name):
+                bucket = self.Current.get(period)
+                if bucket is None or bucket.Stats[name].Count == 0:
+                        return None
+                return bucket.Stats[name]
+
+# Same for the last bucket that closed
+        def PreviousStats(self, period, name):
+                bucket = self.Previous.get(period)
+                if bucket is None or bucket.Stats[name].Count == 0:
+                        return None
+                return bucket.Stats[name]
+
+
+#------------------------------------------------------------------------------------
+# DST rollover check
+#------------------------------------------------------------------------------------
+
+def DstCheck():
+        os.environ["TZ"] = "Europe/London"
+        time.tzset()
+        failures = 0
+        # 2021-10-31 has 01:00 BST twice (25 hours), 2021-03-28 skips 01:00 GMT (23 hours)
+        for name, day, hours in (("DST end", datetime.date(2021, 10, 31), 25), ("DST start", datetime.date(2021, 3, 28), 23)):
+                closed = []
+                aggregator = StreamingAggregator((HOUR, DAY))
+                aggregator.AddListener(lambda period, bucket: closed.append((period, bucket)))
+                begin = datetime.datetime.combine(day, datetime.time()).timestamp() - 12 * 3600
+                for minute in range(0, 48 * 60, 10):
+                        aggregator.Add(begin + minute * 60, {"temp_out": 10.0})
+                dayspan = [(bucket.End - bucket.Start + 600) / 3600 for period, bucket in closed if period == DAY and bucket.Key == day]
+                hourbuckets = [bucket for period, bucket in closed if period == HOUR and bucket.Key[:3] == (day.year, day.month, day.day)]
+                samples = sum(bucket.Stats["temp_out"].Count for bucket in hourbuckets)
+                ok = dayspan == [hours] and len(hourbuckets) == hours and samples == hours * 6
+                print("%-9s %s  %s is %s hours in %d hour buckets" % (name, "OK  " if ok else "FAIL", day, dayspan, len(hourbuckets)))
+                failures += not ok
+        return 1 if failures else 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station streaming aggregator")
+        parser.add_argument("--dst-check", action="store_true", help="check hour and day buckets across the UK DST changes")
+        args = parser.parse_args()
+        if not args.dst_check:
+                parser.print_help()
+                sys.exit(0)
+        sys.exit(DstCheck())
@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+
+# Historical analytics over a columnar archive of per-minute weather data
+#
+# The sample store only keeps raw packets for a month, so every midnight the station appends
+# the finished day to a ColumnArchive as one row per minute: means of the readings, the gust
+# maximum, the rain counters and a speed-weighted wind direction. Each column is a flat binary
+# file of one dtype (time is float64 Unix seconds, everything else float32 with NaN for
+# missing), so appending is a plain write and reading is a memory map: ten years is 5.3 million
+# rows, about 250 MB on disk and only the pages a query touches are read.
+#
+# The analyses work on whole columns with NumPy, no Python loop per row:
+#       WindRose          - time at each speed band per compass sector
+#       RainIntensity     - rainy hours by Met Office intensity class
+#       DegreeDays        - heating/cooling degree days per local day
+#       DewPoint          - Magnus formula
+#       HeatIndex         - NOAA (Rothfusz with adjustments, Steadman below 80F)
+#       PressureTendency  - three hour change, in the classes of the shipping forecast
+#
+#       python3 Analytics.py --export WeatherStation.db --archive Archive
+#       python3 Analytics.py --report --archive Archive
+#       python3 Analytics.py --benchmark --years 10
+
+import datetime
+import time
+import os
+import sys
+import argparse
+import numpy as np
+
+# Archive columns and their dtypes, time first
+ARCHIVE_COLUMNS = (("time", np.float64), ("temp_out", np.float32), ("humid_out", np.float32), ("pressure", np.float32),
+                   ("rain", np.float32), ("rain_hour", np.float32), ("wind_speed", np.float32), ("wind_gust", np.float32),
+                   ("wind_dir", np.float32), ("temp_in", np.float32), ("humid_in", np.float32))
+
+SECTORS = ("N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW")
+WIND_BANDS = (0.5, 5, 10, 20, 30, np.inf)				# Upper bounds of the rose's speed bands, below the first is calm
+RAIN_CLASSES = (("light", 2.5), ("moderate", 10.0), ("heavy", 50.0), ("violent", np.inf))	# mm/h upper bounds
+TENDENCY_CLASSES = (("falling very rapidly", -6.0), ("falling quickly", -3.5), ("falling", -1.5), ("falling slowly", -0.1),
+                    ("steady", 0.1), ("rising slowly", 1.5), ("rising", 3.5), ("rising quickly", 6.0), ("rising very rapidly", np.inf))	# hPa in 3 hours
+
+
+class ColumnArchive():
+
+        def __init__(self, path="Archive"):
+                self.Path = path
+                os.makedirs(path, exist_ok=True)
+
+        def File(self, name):
+                return os.path.join(self.Path, name + ".bin")
+
+        def __len__(self):
+                try:
+                        return os.path.getsize(self.File("time")) // 8
+                except OSError:
+                        return 0
+
+# Function to map every column read-only, truncated to the rows all columns have (an append may have been cut short)
+        def Columns(self):
+                rows = min(os.path.getsize(self.File(name)) // np.dtype(dtype).itemsize if os.path.exists(self.File(name)) else 0 for name, dtype in ARCHIVE_COLUMNS)
+                if rows == 0:
+                        return dict((name, np.zeros(0, dtype)) for name, dtype in ARCHIVE_COLUMNS)
+                return dict((name, np.memmap(self.File(name), dtype=dtype, mode='r', shape=(rows,))) for name, dtype in ARCHIVE_COLUMNS)
+
+        def LastTime(self):
+                rows = len(self)
+                if rows == 0:
+                        return None
+                return float(np.memmap(self.File("time"), dtype=np.float64, mode='r', offset=(rows - 1) * 8, shape=(1,))[0])
+
+# Function to append rows, given a dict of equal length arrays for every column. Time goes last so a
+# crash part way leaves the other columns longer, and Columns() ignores the extra rows
+        def Append(self, columns):
+                rows = len(columns["time"])
+                if rows == 0:
+                        return
+                for name, dtype in ARCHIVE_COLUMNS[1:] + ARCHIVE_COLUMNS[:1]:
+                        path = self.File(name)
+                        if name != "time" and os.path.exists(path) and os.path.getsize(path) != len(self) * np.dtype(dtype).itemsize:
+                                with open(path, 'r+b') as column:		# Drop what a cut short append left behind
+                                        column.truncate(len(self) * np.dtype(dtype).itemsize)
+                        with open(path, 'ab') as column:
+                                column.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+
+# Function to append the finished minutes in a sample store since the last archived one, up to until
+        def Export(self, store, until):
+                last = self.LastTime()
+                since = 0 if last is None else last + 60
+                until = until // 60 * 60						# Whole minutes only
+                rows = store.Db.execute("SELECT time, temp_out, humid_out, pressure, rain, rain_hour, wind_speed, wind_gust, wind_dir, temp_in, humid_in "
+                                        "FROM samples WHERE kind IN ('T', 't') AND time >= ? AND time < ? ORDER BY time", (since, until)).fetchall()
+                if not rows:
+                        return 0
+                columns = MinuteColumns(np.array(rows, dtype=np.float64))		# None comes through as NaN
+                self.Append(columns)
+                return len(columns["time"])
+
+
+# Function to reduce packet rows (time, then the archive columns in order) to one row per minute
+def MinuteColumns(packets):
+        minute, index = np.unique(packets[:, 0] // 60, return_inverse=True)
+        count = len(minute)
+        columns = {"time": minute * 60}
+
+        def Mean(values):
+                valid = ~np.isnan(values)
+                totals = np.bincount(index, np.where(valid, values, 0), count)
+                samples = np.bincount(index, valid, count)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                        return totals / samples
+
+        def Max(values):
+                result = np.full(count, -np.inf)
+                np.maximum.at(result, index, np.where(np.isnan(values), -np.inf, values))
+                result[result == -np.inf] = np.nan
+                return result
+
+        for position, (name, dtype) in enumerate(ARCHIVE_COLUMNS[1:], 1):
+                if name in ("wind_gust", "rain", "rain_hour"):			# Gust is a maximum, the rain counters only go up within a day
+                        columns[name] = Max(packets[:, position])
+                elif name != "wind_dir":
+                        columns[name] = Mean(packets[:, position])
+        speed = np.nan_to_num(packets[:, 6]) + 1e-6				# Speed weighted, so a calm moment does not swing the direction
+        radians = np.radians(packets[:, 8])
+        x = np.bincount(index, np.nan_to_num(speed * np.sin(radians)), count)
+        y = np.bincount(index, np.nan_to_num(speed * np.cos(radians)), count)
+        direction = np.degrees(np.arctan2(x, y)) % 360
+        direction[(x == 0) & (y == 0)] = np.nan
+        columns["wind_dir"] = direction
+        return columns
+
+
+#------------------------------------------------------------------------------------
+# Analyses, each over whole columns
+#------------------------------------------------------------------------------------
+
+# Function to sum values over the runs between consecutive start indices, as float64. Empty runs give 0
+def RunSums(values, starts):
+        starts = np.asarray(starts, np.int64)
+        sums = np.zeros(len(starts))
+        filled = starts < np.r_[starts[1:], len(values)]
+        if np.any(filled):
+                sums[filled] = np.add.reduceat(values, starts[filled], dtype=np.float64)
+        return sums
+
+
+# Function to get the Unix time of every local midnight from the day of first up to the day after last, exact across DST
+def LocalMidnights(first, last):
+        day = datetime.date.fromtimestamp(first)
+        end = datetime.date.fromtimestamp(last) + datetime.timedelta(days=1)
+        midnights = []
+        while day <= end:
+                midnights.append(datetime.datetime.combine(day, datetime.time()).timestamp())
+                day += datetime.timedelta(days=1)
+        return np.array(midnights)
+
+
+# Function to get the fraction of the time in each (speed band, sector) and the calm fraction. Bands are
+# in km/h and must be multiples of 0.5: each reading is counted by half km/h step and sixteenth of a
+# circle in one bincount, and the steps are only then added up into bands and sectors
+def WindRose(speed, direction, sectors=16, bands=WIND_BANDS):
+        steps = int(bands[-2] * 2) + 1						# Half km/h steps up to the last finite band, then one for faster
+        index = np.multiply(speed, 2, dtype=np.float32)
+        np.minimum(index, steps, out=index)
+        np.fmin(index, steps + 1, out=index)					# NaN lands past the fastest step
+        np.maximum(index, 0, out=index)
+        code = index.astype(np.int32)
+        code *= sectors + 2
+        index = np.multiply(direction, sectors / 360, dtype=np.float32)
+        index += 1.5								# Half a sector, and one for NaN at 0
+        np.fmax(index, 0, out=index)
+        np.minimum(index, sectors + 1, out=index)
+        code += index.astype(np.int32)
+        counts = np.bincount(code, minlength=(steps + 2) * (sectors + 2)).reshape(steps + 2, sectors + 2)
+        counts = np.c_[counts[:steps + 1, 1:sectors + 1] + np.c_[counts[:steps + 1, sectors + 1], np.zeros((steps + 1, sectors - 1), np.int64)]]	# A full circle is north again
+        band = np.searchsorted(np.asarray(bands[:-1]), np.arange(steps + 1) / 2, side='right')
+        rose = np.zeros((len(bands), sectors), np.int64)
+        np.add.at(rose, band, counts)
+        total = rose.sum()
+        if total == 0:
+                return np.zeros((len(bands) - 1, sectors)), 0.0
+        return rose[1:] / total, rose[0].sum() / total
+
+
+# Function to get per minute rainfall from the daily counter, which the Arduino resets at midnight
+def RainPerMinute(rain):
+        fallen = np.diff(rain, prepend=rain[:1])
+        reset = np.nonzero(fallen < 0)[0]
+        fallen[reset] = rain[reset]						# Counter restarted, what it shows fell since
+        return np.fmax(fallen, 0, out=fallen)					# No reading, no rain
+
+
+# Function to get the rainfall of every clock hour with rain and the number of those hours in each intensity class
+def RainIntensity(times, rain, classes=RAIN_CLASSES):
+        if len(times) == 0:
+                return np.zeros(0), np.zeros(len(classes), np.int64)
+        hours = np.arange(times[0] // 3600, times[-1] // 3600 + 1) * 3600
+        hourly = RunSums(RainPerMinute(rain), np.searchsorted(times, hours))
+        hourly = hourly[hourly > 0]
+        counts = np.bincount(np.searchsorted(np.array([bound for name, bound in classes[:-1]]), hourly, side='right'), minlength=len(classes))
+        return hourly, counts
+
+
+# Function to get (local dates, daily mean temperature, heating degree days, cooling degree days) for days with readings
+def DegreeDays(times, temp, heatingbase=15.5, coolingbase=22.0):
+        if len(times) == 0:
+                return [], np.zeros(0), np.zeros(0), np.zeros(0)
+        midnights = LocalMidnights(times[0], times[-1])
+        starts = np.searchsorted(times, midnights[:-1])
+        ends = np.r_[starts[1:], len(times)]
+        samples = ends - starts
+        totals = RunSums(temp, starts)
+        for day in np.nonzero(np.isnan(totals))[0]:				# Only the few days with a missing reading are summed again
+                day_temp = temp[starts[day]:ends[day]]
+                samples[day] = np.count_nonzero(~np.isnan(day_temp))
+                totals[day] = np.nansum(day_temp, dtype=np.float64)
+        seen = samples > 0
+        mean = totals[seen] / samples[seen]
+        days = [datetime.date.fromtimestamp(midnight) for midnight in midnights[:-1][seen]]
+        return days, mean, np.maximum(heatingbase - mean, 0), np.maximum(mean - coolingbase, 0)
+
+
+# Magnus formula dew point in C, good to about 0.1C between -45C and 60C
+def DewPoint(temp, humid):
+        with np.errstate(divide='ignore', invalid='ignore'):
+                gamma = np.log(humid, dtype=np.float32)
+                gamma -= np.float32(np.log(100))
+                scaled = np.add(temp, np.float32(243.12), dtype=np.float32)
+                np.divide(temp, scaled, out=scaled)
+                scaled *= np.float32(17.62)
+                gamma += scaled
+                np.subtract(np.float32(17.62), gamma, out=scaled)
+                gamma *= np.float32(243.12)
+                gamma /= scaled
+                return gamma
+
+
+# NOAA heat index in C: Steadman's simple formula, and the Rothfusz regression with its adjustments where
+# the simple one averaged with the temperature reaches 80F. Both formulas are in Fahrenheit, the simple
+# one is worked out here in Celsius so only the few hot readings are converted
+def HeatIndex(temp, humid):
+        index = np.multiply(temp, np.float32(1.1), dtype=np.float32)		# 0.5 * (T + 61 + (T - 68) * 1.2 + RH * 0.094) in C
+        index += np.multiply(humid, np.float32(0.047 / 1.8), dtype=np.float32)
+        index -= np.float32(7.1 / 1.8)
+        with np.errstate(invalid='ignore'):
+                hot = np.nonzero(index + temp >= np.float32(48 / 1.8 * 2))[0]	# (simple + T) / 2 >= 80F
+        if len(hot):
+                t = temp[hot] * 1.8 + 32
+                rh = humid[hot].astype(np.float64)
+                full = (-42.379 + 2.04901523 * t + 10.14333127 * rh - 0.22475541 * t * rh - 0.00683783 * t * t
+                        - 0.05481717 * rh * rh + 0.00122874 * t * t * rh + 0.00085282 * t * rh * rh - 0.00000199 * t * t * rh * rh)
+                with np.errstate(invalid='ignore'):
+                        dry = (rh < 13) & (t >= 80) & (t <= 112)
+                        full[dry] -= (13 - rh[dry]) / 4 * np.sqrt((17 - np.abs(t[dry] - 95)) / 17)
+                        wet = (rh > 85) & (t >= 80) & (t <= 87)
+                        full[wet] += (rh[wet] - 85) / 10 * (87 - t[wet]) / 5
+                index[hot] = (full - 32) / 1.8
+        return index
+
+
+# Function to get the pressure change over the last three hours at every minute (NaN where there is no
+# reading three hours back) and the number of minutes in each tendency class. Rows are a minute apart
+# unless the station was off, so the reading three hours back is looked up directly and only searched
+# for after a gap
+def PressureTendency(times, pressure, classes=TENDENCY_CLASSES, window=10800):
+        change = np.full(len(times), np.nan, np.float32)
+        back = int(window // 60)
+        if len(times) > back:
+                np.subtract(pressure[back:], pressure[:-back], out=change[back:])
+                gap = np.nonzero(times[back:] - times[:-back] != window)[0] + back
+                if len(gap):
+                        earlier = np.searchsorted(times, times[gap] - window)
+                        found = times[earlier] == times[gap] - window
+                        change[gap] = np.where(found, pressure[gap] - pressure[earlier], np.nan)
+        below = [np.count_nonzero(change < bound) for name, bound in classes[:-1]]	# NaN is never below
+        counts = np.diff(np.r_[0, below, len(change) - np.count_nonzero(np.isnan(change))])
+        return change, counts
+
+
+#------------------------------------------------------------------------------------
+# Report, and a benchmark over years of synthetic per minute data
+#------------------------------------------------------------------------------------
+
+def Analyse(columns):
+        timings = []
+        results = {}
+        for name, function in (("wind rose", lambda: WindRose(columns["wind_speed"], columns["wind_dir"])),
+                               ("rain intensity", lambda: RainIntensity(columns["time"], columns["rain"])),
+                               ("degree days", lambda: DegreeDays(columns["time"], columns["temp_out"])),
+                               ("dew point", lambda: DewPoint(columns["temp_out"], columns["humid_out"])),
+                               ("heat index", lambda: HeatIndex(columns["temp_out"], columns["humid_out"])),
+                               ("pressure tendency", lambda: PressureTendency(columns["time"], columns["pressure"]))):
+                started = time.perf_counter()
+                results[name] = function()
+                timings.append((name, time.perf_counter() - started))
+        return results, timings
+
+
+def Report(archive):
+        columns = archive.Columns()
+        if len(columns["time"]) == 0:
+                print("Archive %s is empty" % archive.Path)
+                return 1
+        results, timings = Analyse(columns)
+        print("%d minutes from %s to %s" % (len(columns["time"]), datetime.datetime.fromtimestamp(columns["time"][0]), datetime.datetime.fromtimestamp(columns["time"][-1])))
+        rose, calm = results["wind rose"]
+        print("Wind rose, %% of the time (calm %.1f%%)" % (calm * 100))
+        print("%-10s" % "km/h" + "".join("%6s" % sector for sector in SECTORS))
+        low = WIND_BANDS[0]
+        for band, high in enumerate(WIND_BANDS[1:]):
+                print("%-10s" % ("%g-%g" % (low, high) if high != np.inf else ">%g" % low) + "".join("%6.1f" % value for value in rose[band] * 100))
+                low = high
+        hourly, counts = results["rain intensity"]
+        print("Rainy hours: " + ", ".join("%s %d" % (name, count) for (name, bound), count in zip(RAIN_CLASSES, counts)))
+        days, mean, heating, cooling = results["degree days"]
+        print("Degree days over %d days: heating %.0f, cooling %.0f" % (len(days), heating.sum(), cooling.sum()))
+        dewpoint = results["dew point"]
+        heatindex = results["heat index"]
+        print("Dew point %.1f to %.1fC, highest heat index %.1fC" % (np.nanmin(dewpoint), np.nanmax(dewpoint), np.nanmax(heatindex)))
+        change, counts = results["pressure tendency"]
+        print("Pressure tendency: " + ", ".join("%s %.1f%%" % (name, count * 100 / max(counts.sum(), 1)) for (name, bound), count in zip(TENDENCY_CLASSES, counts) if count))
+        return 0
+
+
+# Synthetic per minute columns: daily and yearly temperature cycles, humidity against temperature,
+# weather systems in the pressure, a prevailing south westerly and rain in afternoon showers
+def SyntheticColumns(start, minutes, seed=1):
+        rng = np.random.default_rng(seed)
+        times = start + np.arange(minutes, dtype=np.float64) * 60
+        days = np.arange(minutes, dtype=np.float32) / 1440
+        daily = np.sin(2 * np.pi * (days % 1 - 0.375)).astype(np.float32)
+        yearly = -np.cos(2 * np.pi * (days - 20) / 365.25).astype(np.float32)
+        temp = 11 + 7 * yearly + 5 * daily + rng.normal(0, 1, minutes).astype(np.float32)
+        humid = np.clip(75 - 15 * daily + rng.normal(0, 5, minutes), 5, 99).astype(np.float32)
+        pressure = (1013 + 12 * np.sin(2 * np.pi * days / 4.3) + 5 * np.sin(2 * np.pi * days / 1.7)).astype(np.float32)
+        speed = np.abs(rng.gamma(2.0, 4.0, minutes)).astype(np.float32)
+        direction = (225 + rng.normal(0, 50, minutes)).astype(np.float32) % 360
+        showers = (days % 1 > 0.58) & (days % 1 < 0.62) & (np.floor(days) % 3 == 0)
+        rate = np.where(showers, rng.gamma(1.5, 0.08, minutes), 0).astype(np.float32)	# mm per minute
+        total = np.cumsum(rate, dtype=np.float64)
+        midnight = np.arange(minutes) // 1440 * 1440
+        rain = (total - total[midnight] + rate[midnight]).astype(np.float32)	# Daily counter, reset at midnight
+        temp[rng.integers(0, minutes, minutes // 5000)] = np.nan			# The odd failed sensor read
+        return {"time": times, "temp_out": temp, "humid_out": humid, "pressure": pressure, "rain": rain, "rain_hour": rate * 60,
+                "wind_speed": speed, "wind_gust": speed * 1.5, "wind_dir": direction, "temp_in": np.full(minutes, 20, np.float32), "humid_in": np.full(minutes, 50, np.float32)}
+
+
+def Benchmark(years):
+        import tempfile
+        minutes = int(years * 365.25 * 1440)
+        archive = ColumnArchive(os.path.join(tempfile.mkdtemp(), "Archive"))
+        started = time.perf_counter()
+        archive.Append(SyntheticColumns(datetime.datetime(2015, 1, 1).timestamp(), minutes))
+        print("Wrote %.0f years, %d minutes, %.0f MB in %.1fs" % (years, minutes, sum(os.path.getsize(archive.File(name)) for name, dtype in ARCHIVE_COLUMNS) / 1e6, time.perf_counter() - started))
+        started = time.perf_counter()
+        columns = archive.Columns()
+        results, timings = Analyse(columns)
+        total = time.perf_counter() - started
+        for name, seconds in timings:
+                print("%-18s %8.1f ms" % (name, seconds * 1000))
+        print("%-18s %8.1f ms (memory mapped, page cache warm)" % ("total", total * 1000))
+        started = time.perf_counter()
+        for index in range(0, minutes, 1440):					# What a loop per row costs, on one column only
+                sum(float(value) for value in columns["temp_out"][index:index + 1440])
+        print("%-18s %8.1f ms (one Python loop over temp_out, for comparison)" % ("per row loop", (time.perf_counter() - started) * 1000))
+        return 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station historical analytics")
+        parser.add_argument("--archive", default="Archive", help="per minute column archive (default: %(default)s)")
+        parser.add_argument("--export", metavar="DB", help="append the finished minutes in sample store DB to the archive")
+        parser.add_argument("--report", action="store_true", help="print the analyses of the archive")
+        parser.add_argument("--benchmark", action="store_true", help="time the analyses over synthetic per minute data")
+        parser.add_argument("--years", type=float, default=10, help="years of synthetic data for --benchmark")
+        args = parser.parse_args()
+        if args.export:
+                from SampleStore import SampleStore
+                print("Archived %d minutes" % ColumnArchive(args.archive).Export(SampleStore(args.export), time.time()))
+        if args.report:
+                sys.exit(Report(ColumnArchive(args.archive)))
+        if args.benchmark:
+                sys.exit(Benchmark(args.years))
+        if not (args.export or args.report or args.benchmark):
+                parser.print_help()
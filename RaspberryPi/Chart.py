@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+# Line chart that renders its static parts once and blits the lines over them
+#
+# The axes, ticks, labels and grid are drawn by a full canvas.draw() only when the frame
+# changes, and the result is cached with copy_from_bbox. The lines are animated artists: an
+# update restores the cached background, draws just the lines and blits the axes area, which
+# costs a few milliseconds instead of a full Agg render. A frame change (new axis limits or
+# day labels) or a resize redraws the background on the next Draw().
+#
+# Run this file directly to compare frame times with the old clear-and-redraw chart:
+#       python3 Chart.py --benchmark
+
+import math
+import time
+import sys
+import argparse
+
+
+class BlitChart():
+
+        def __init__(self, canvas, axes):
+                self.Canvas = canvas
+                self.Axes = axes
+                self.Lines = {}
+                self.Frame = None
+                self.Background = None
+                self.Canvas.mpl_connect('draw_event', self.OnDraw)
+
+        def AddLine(self, name, color):
+                line, = self.Axes.plot([], [], color=color, animated=True)	# Animated lines are left out of canvas.draw()
+                self.Lines[name] = line
+
+# Function to set axis limits, ticks and x labels. Only a change to these redraws the background
+        def SetFrame(self, xlimits, ylimits, xticks, yticks, xlabels):
+                frame = (tuple(xlimits), tuple(ylimits), tuple(xticks), tuple(yticks), tuple(xlabels))
+                if frame == self.Frame:
+                        return
+                self.Frame = frame
+                self.Axes.set_xlim(*xlimits)
+                self.Axes.set_ylim(*ylimits)
+                self.Axes.set_xticks(xticks)
+                self.Axes.set_yticks(yticks)
+                self.Axes.set_xticklabels(xlabels)
+                self.Axes.grid(True)
+                self.Background = None
+
+        def SetData(self, name, x, y):
+                self.Lines[name].set_data(x, y)
+
+# Function to show the current lines, redrawing the static parts only if they changed
+        def Draw(self):
+                if self.Background is None:
+                        self.Canvas.draw()				# OnDraw caches the background and draws the lines
+                        return
+                self.Canvas.restore_region(self.Background)
+                self.DrawLines()
+
+        def DrawLines(self):
+                for line in self.Lines.values():
+                        self.Axes.draw_artist(line)
+                self.Canvas.blit(self.Axes.figure.bbox)
+
+# Called after every full draw, including the ones Tk makes on resize or expose
+        def OnDraw(self, event):
+                self.Background = self.Canvas.copy_from_bbox(self.Axes.figure.bbox)
+                self.DrawLines()
+
+
+#------------------------------------------------------------------------------------
+# Benchmark: the old clear-and-redraw history chart against BlitChart, on the Agg canvas
+#------------------------------------------------------------------------------------
+
+def NewFigure():
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        figure = Figure(figsize=(3.8,1.1), dpi=100)			# Same size as the display's history chart
+        canvas = FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        axes.set_facecolor("black")
+        figure.patch.set_facecolor("black")
+        figure.subplots_adjust(left=0.1,bottom=0.3,right=0.95)
+        return canvas, axes
+
+
+# What Display.UpdateTempHistory() used to do for every redraw
+def OldRender(canvas, axes, highs, lows, labels):
+        axes.clear()
+        MaxTemp = max(highs)
+        MinTemp = min(lows)
+        axes.axis([0,5,MinTemp - (MinTemp/100.0*10),MaxTemp + (MaxTemp/100.0*10)])
+        axes.plot(highs, color='r')
+        axes.plot(lows, color='b')
+        axes.set_yticks([round(MinTemp,-1),round((MaxTemp-MinTemp)/4,-1),round((MaxTemp-MinTemp)/2,-1),round((MaxTemp-MinTemp)*3/4,-1),round(MaxTemp,-1)])
+        axes.set_xticks([0,1,2,3,4,5])
+        axes.set_xticklabels(labels)
+        axes.grid()
+        canvas.draw()
+
+
+def Report(name, frames):
+        frames.sort()
+        print("%-28s %7.2f ms mean  %7.2f ms p95" % (name, sum(frames) / len(frames) * 1000, frames[int(len(frames) * 0.95)] * 1000))
+
+
+def Benchmark(count):
+        labels = ['Tu','We','Th','Fr','Sa','Su']
+        highs = [18.2, 19.5, 17.0, 21.3, 22.8, 20.1]
+        lows = [8.1, 9.4, 7.7, 10.2, 12.0, 11.3]
+        frames = []
+        canvas, axes = NewFigure()
+        for index in range(count):
+                started = time.perf_counter()
+                OldRender(canvas, axes, highs[:5] + [20 + index % 3], lows, labels)
+                frames.append(time.perf_counter() - started)
+        Report("old: clear and draw", frames)
+
+        canvas, axes = NewFigure()
+        chart = BlitChart(canvas, axes)
+        chart.AddLine("max", 'r')
+        chart.AddLine("min", 'b')
+        chart.AddLine("live", 'w')
+        chart.SetFrame((0, 5), (5, 25), (0, 1, 2, 3, 4, 5), (10, 20), labels)
+        chart.SetData("max", range(6), highs)
+        chart.SetData("min", range(6), lows)
+        chart.Draw()
+        for name, points in (("new: 6 point history", 0), ("new: + 288 point live line", 288)):
+                frames = []
+                for index in range(count):
+                        started = time.perf_counter()
+                        chart.SetData("max", range(6), highs[:5] + [20 + index % 3])
+                        if points:						# A day of five minute samples across the same axes
+                                chart.SetData("live", [5 * i / points for i in range(points)], [15 + 5 * math.sin(i / 20 + index) for i in range(points)])
+                        chart.Draw()
+                        frames.append(time.perf_counter() - started)
+                Report(name, frames)
+
+        frames = []
+        for index in range(count):
+                started = time.perf_counter()
+                chart.SetFrame((0, 5), (5, 25 + index % 2), (0, 1, 2, 3, 4, 5), (10, 20), labels)
+                chart.Draw()
+                frames.append(time.perf_counter() - started)
+        Report("new: frame change", frames)
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station blitted chart")
+        parser.add_argument("--benchmark", action="store_true", help="time the old and new history chart renderers")
+        parser.add_argument("--frames", type=int, default=200, help="frames to time for each renderer")
+        args = parser.parse_args()
+        if not args.benchmark:
+                parser.print_help()
+                sys.exit(0)
+        Benchmark(args.frames)
@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+
+# Crash-safe checkpoints of a station's live state
+#
+# Only the daily max/min history used to survive a restart. Today's extremes, the hour's
+# pressure mean behind the trend arrow, the month's statistics, the latest readings and the
+# link estimate all started again from nothing, so after a crash the display showed the wrong
+# extremes for the rest of the day. A checkpoint holds all of that: the aggregator's open hour,
+# day and month buckets and the last closed ones, the readings and the LinkEstimator.
+#
+# The checkpoint is written incrementally on top of the sample store. Every packet is already
+# appended to the store's WAL as it arrives, so a checkpoint only needs to be as new as the
+# last one. Restore loads the checkpoint, then replays the samples stored after it. A
+# checkpoint is taken every CHECKPOINT_INTERVAL, and only if packets have come in since the
+# last one. That is a few KB of zlib'd JSON per write, not a rewrite of the state per packet.
+# Each write goes to a temporary file, is fsynced and is renamed over the last checkpoint,
+# and then the directory is fsynced. A power cut leaves either the old checkpoint or the new
+# one, never half of one. The write and fsync happen on CheckpointWriter's thread, so an SD
+# card that stalls on a flush never holds up the receive loop.
+#
+# A checkpoint is only restored if its magic, format, length, CRC32 and pipe all check out and
+# its day is still today. Otherwise it is ignored. In that case, or when there is no
+# checkpoint, today is rebuilt by replaying the store's samples since midnight. That is slower,
+# and the month's statistics then only start today. Either way the ring of recent samples is
+# filled again from the store.
+#
+# Run this file directly to measure restore time and write amplification over a simulated day:
+#       python3 Checkpoint.py --benchmark
+
+import threading
+import datetime
+import struct
+import zlib
+import json
+import time
+import os
+import sys
+import argparse
+from Aggregator import DAY, BucketKey
+from SampleStore import SAMPLE_COLUMNS
+from Stations import RECENT_PACKETS, RECENT_FIELDS, NAN
+
+MAGIC = b"WSCK"
+FORMAT = 1
+HEADER = struct.Struct("<4sHHdII")					# Magic, format, pipe, time of the last packet in it, CRC32 and length of the body
+CHECKPOINT_INTERVAL = 600						# Seconds, the store's WAL covers the packets in between
+READING_FIELDS = ("TempOut", "HumidOut", "TempIn", "HumidIn", "Pressure", "Rain", "RainHour", "WindSpeed", "WindGust", "WindDir", "GustPeak", "Battery", "LastReceive", "Packets", "SignalLosses")
+WEATHER_COLUMNS = (("temp_out", "TempOut"), ("humid_out", "HumidOut"), ("pressure", "Pressure"), ("rain", "Rain"), ("rain_hour", "RainHour"),
+                   ("wind_speed", "WindSpeed"), ("wind_gust", "WindGust"), ("wind_dir", "WindDir"), ("gust_peak", "GustPeak"))
+
+
+# Function to encode a station's live state, on the receive loop so nothing changes under it. Restore replays
+# the samples stored after the last packet it holds
+def EncodeCheckpoint(station, now):
+        with station.Lock:
+                readings = dict((name, getattr(station, name)) for name in READING_FIELDS)
+        state = {"readings": readings, "stats": station.Stats.Checkpoint(), "link": station.Link.State()}
+        body = zlib.compress(json.dumps(state, separators=(',', ':')).encode('ascii'), 6)
+        return HEADER.pack(MAGIC, FORMAT, station.Pipe, readings["LastReceive"] or now, zlib.crc32(body), len(body)) + body
+
+
+# Function to check and decode a checkpoint, returns (time saved, state) or None with the reason it was rejected
+def DecodeCheckpoint(data, pipe):
+        if len(data) < HEADER.size:
+                return None, "truncated"
+        magic, format, savedpipe, saved, crc, length = HEADER.unpack_from(data)
+        body = data[HEADER.size:]
+        if magic != MAGIC or format != FORMAT:
+                return None, "not a format %d checkpoint" % FORMAT
+        if savedpipe != pipe:
+                return None, "for pipe %d" % savedpipe
+        if len(body) != length or zlib.crc32(body) != crc:
+                return None, "corrupt"
+        try:
+                return (saved, json.loads(zlib.decompress(body))), None
+        except (ValueError, zlib.error):
+                return None, "corrupt"
+
+
+# Function to write a file so that a crash leaves either the old contents or the new, never a mix
+def WriteAtomic(path, data):
+        temporary = path + ".tmp"
+        with open(temporary, 'wb') as checkpoint:
+                checkpoint.write(data)
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+        os.replace(temporary, path)
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+                os.fsync(directory)						# Makes the rename itself durable
+        finally:
+                os.close(directory)
+
+
+# Writes checkpoints on its own thread, the newest for each path winning. Before Start() it writes inline
+class CheckpointWriter():
+
+        def __init__(self, timer=None):
+                self.Timer = timer						# Called with the seconds each write and fsync took
+                self.Lock = threading.Lock()
+                self.Wake = threading.Condition(self.Lock)
+                self.Pending = {}						# Path -> bytes not yet written
+                self.Writing = False
+                self.Stopping = False
+                self.Thread = None
+                self.Writes = 0
+                self.Bytes = 0
+                self.Failures = 0
+                self.Superseded = 0						# Checkpoints replaced by a newer one before they were written
+
+        def Start(self):
+                if self.Thread is None:
+                        self.Thread = threading.Thread(target=self.Run, name="CheckpointWriter", daemon=True)
+                        self.Thread.start()
+
+# Function to write whatever is pending and stop the thread
+        def Stop(self):
+                with self.Lock:
+                        self.Stopping = True
+                        self.Wake.notify_all()
+                if self.Thread is not None:
+                        self.Thread.join()
+                        self.Thread = None
+
+        def Submit(self, path, data):
+                if self.Thread is None:
+                        self.Write(path, data)
+                        return
+                with self.Lock:
+                        if path in self.Pending:
+                                self.Superseded += 1
+                        self.Pending[path] = data
+                        self.Wake.notify_all()
+
+# Function to wait until everything submitted so far is on disk
+        def Flush(self):
+                with self.Lock:
+                        while self.Pending or self.Writing:
+                                self.Wake.wait()
+
+        def Run(self):
+                while True:
+                        with self.Lock:
+                                self.Writing = False
+                                self.Wake.notify_all()
+                                while not self.Pending and not self.Stopping:
+                                        self.Wake.wait()
+                                if not self.Pending:
+                                        return
+                                path, data = self.Pending.popitem()
+                                self.Writing = True
+                        self.Write(path, data)
+
+        def Write(self, path, data):
+                started = time.perf_counter()
+                try:
+                        WriteAtomic(path, data)
+                except OSError:
+                        self.Failures += 1
+                        return
+                self.Writes += 1
+                self.Bytes += len(data)
+                if self.Timer is not None:
+                        self.Timer(time.perf_counter() - started)
+
+
+# Function to bring a station back to where it was: its checkpoint if it is good and from today, else the
+# store's samples since midnight, and in both cases the samples since then. The station's aggregator listeners
+# are held off, so nothing is uploaded or rolled up twice. Returns (where from, samples replayed, reason a
+# checkpoint was not used or None)
+def RestoreCheckpoint(station, path, now):
+        loaded, reason = None, "none"
+        if path is not None:
+                try:
+                        with open(path, 'rb') as checkpoint:
+                                loaded, reason = DecodeCheckpoint(checkpoint.read(), station.Pipe)
+                except OSError:
+                        pass
+        if loaded is not None:
+                saved, state = loaded
+                today = BucketKey(DAY, now, datetime.datetime.fromtimestamp(now).astimezone())
+                day = state["stats"]["current"].get(DAY)
+                if saved > now or day is None or BucketKey(DAY, day[0], datetime.datetime.fromtimestamp(day[0]).astimezone()) != today:
+                        loaded, reason = None, "stale"
+        listeners = station.Stats.Listeners
+        station.Stats.Listeners = []
+        try:
+                if loaded is not None:
+                        station.Stats.Restore(state["stats"])
+                        station.Link.Restore(state["link"])
+                        with station.Lock:
+                                for name, value in state["readings"].items():
+                                        if name in READING_FIELDS:
+                                                setattr(station, name, value)
+                        since, source = saved, "checkpoint"
+                else:
+                        since, source = datetime.datetime.combine(datetime.date.fromtimestamp(now), datetime.time()).timestamp(), "store"
+                replayed = ReplayStore(station, since, now)
+                station.Stats.Tick(now)						# Close whatever ended while the station was down
+        finally:
+                station.Stats.Listeners = listeners
+        FillRecent(station, now)
+        return source, replayed, None if loaded is not None else reason
+
+
+# Function to replay the samples stored after since through the station, as ProcessPacket() took them. Only
+# the highest of a v2 frame's gust samples is stored, so gust_peak gets that one instead of all of them
+def ReplayStore(station, since, now):
+        count = 0
+        names = ("time", "kind") + SAMPLE_COLUMNS
+        rows = station.Store.Db.execute("SELECT %s FROM samples WHERE time > ? AND time <= ? ORDER BY time" % ", ".join(names), (since, now))
+        for row in rows:
+                sample = dict(zip(names, row))
+                if sample["kind"] == '?':
+                        continue						# Stores from before corrupt frames were dropped
+                when = sample["time"]
+                values = dict((name, value) for name, value in sample.items() if value is not None and name not in ("time", "kind", "lost", "rpd"))
+                station.Stats.Add(when, values)
+                weather = sample["kind"] in ("T", "t")
+                if weather:
+                        station.Link.Packet(when, sample["rpd"])
+                with station.Lock:
+                        station.Packets += 1
+                        station.LastReceive = when
+                        station.TempIn = sample["temp_in"]				# NULL as it was live, the DHT22 had nothing recent
+                        station.HumidIn = sample["humid_in"]
+                        if weather:
+                                for column, name in WEATHER_COLUMNS:
+                                        if sample[column] is not None:
+                                                setattr(station, name, sample[column])
+                        elif sample["battery"] is not None:
+                                station.Battery = sample["battery"]
+                count += 1
+        return count
+
+
+# Function to fill the ring of recent weather samples again from the store
+def FillRecent(station, now):
+        rows = station.Store.Db.execute("SELECT time, %s FROM samples WHERE kind IN ('T', 't') AND time <= ? ORDER BY time DESC LIMIT ?" % ", ".join(RECENT_FIELDS), (now, RECENT_PACKETS)).fetchall()
+        if not rows:
+                return
+        rows.reverse()
+        columns = list(zip(*rows))
+        with station.Lock:
+                station.Samples.Extend(columns[0], [[NAN if value is None else value for value in column] for column in columns[1:]])
+
+
+#------------------------------------------------------------------------------------
+# Benchmark: restore time and write amplification over a simulated day
+#------------------------------------------------------------------------------------
+
+def Benchmark():
+        import tempfile
+        import importlib
+        from Simulation import Simulator, GenerateCapture
+        os.environ["TZ"] = "Europe/London"
+        time.tzset()
+        workdir = tempfile.mkdtemp()
+        dbpath = os.path.join(workdir, "WeatherStation.db")
+        checkpoint = os.path.join(workdir, "Checkpoint.dat")
+        start = datetime.datetime(2021, 6, 1).timestamp()
+        end = start + 86400 - 60
+        sim = Simulator(start, dbpath, checkpoint=checkpoint)
+        station = sim.Station
+        started = time.perf_counter()
+        sim.Replay(GenerateCapture(start, (end - start) / 86400))
+        print("Simulated day of packets replayed in %.1fs" % (time.perf_counter() - started))
+        packets = station.Primary.Packets
+        writer = station.Checkpoints
+        size = os.path.getsize(checkpoint)
+        raw = len(json.dumps({"readings": 0, "stats": station.Primary.Stats.Checkpoint(), "link": station.Primary.Link.State()}, separators=(',', ':')))
+        encode = station.CheckpointEncodeTime.Read()
+        print("Checkpoint %d bytes (%d bytes of JSON), encode %.2f ms mean on the receive loop" % (size, raw, encode[1] / max(sum(encode[0]), 1) * 1000))
+        started = time.perf_counter()
+        for index in range(20):
+                WriteAtomic(checkpoint + ".bench", open(checkpoint, 'rb').read())
+        print("Write, fsync and rename %.2f ms on this disk" % ((time.perf_counter() - started) / 20 * 1000))
+        print("Writes per day %d, %.0f KB/day, %.1f bytes per packet" % (writer.Writes, writer.Bytes / 1024, writer.Bytes / packets))
+        print("Rewriting the state every packet would be %.0f KB/day, %.0fx as much" % (size * packets / 1024, size * packets / writer.Bytes))
+        wal = sum(os.path.getsize(path) for path in (dbpath, dbpath + "-wal") if os.path.exists(path))
+        print("Sample store for comparison %.0f KB (%.0f bytes per packet)" % (wal / 1024, wal / packets))
+        expected = (station.TodayRange('temp_out'), station.TodayRange('pressure'), station.PressureTrend(), station.Primary.Stats.Current["month"].Stats["temp_out"].Count)
+        failures = 0
+        for label, corrupt in (("checkpoint + replay", False), ("store since midnight", True)):
+                if corrupt:
+                        with open(checkpoint, 'r+b') as damaged:
+                                damaged.seek(HEADER.size + 10)
+                                damaged.write(b"\0\0\0\0")
+                importlib.reload(station)
+                started = time.perf_counter()
+                restarted = Simulator(end, dbpath, checkpoint=checkpoint)
+                elapsed = time.perf_counter() - started
+                source, replayed, reason = restarted.Station.Restored[1]
+                got = (restarted.Station.TodayRange('temp_out'), restarted.Station.TodayRange('pressure'), restarted.Station.PressureTrend(), restarted.Station.Primary.Stats.Current["month"].Stats["temp_out"].Count)
+                ok = got[:3] == expected[:3]
+                failures += not ok
+                print("Restore from %-21s %7.1f ms for the whole start, %5d samples replayed, restore %6.1f ms  %s" % (label, elapsed * 1000, replayed, restarted.Station.RestoreTime * 1000, "OK" if ok else "FAIL %r != %r" % (got, expected)))
+        return 1 if failures else 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station checkpoints")
+        parser.add_argument("--benchmark", action="store_true", help="measure restore time and write amplification over a simulated day")
+        args = parser.parse_args()
+        if not args.benchmark:
+                parser.print_help()
+                sys.exit(0)
+        sys.exit(Benchmark())
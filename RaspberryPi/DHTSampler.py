@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+# Indoor temperature/humidity sampler for the Weather Station
+#
+# Adafruit_DHT.read_retry() can take seconds when the DHT22 is slow to answer, so the sensor
+# is read on its own thread and on its own schedule. The packet handler only picks up the
+# latest cached reading with Latest(), which never blocks on the sensor. A reading more than
+# STALE_INTERVALS sampling intervals old counts as none, so a failed or unplugged DHT22 shows
+# up as missing indoor values instead of the last ones being carried on.
+#
+# Run this file directly to check packet handling latency against a slow fake sensor:
+#       python3 DHTSampler.py --latency-check
+
+import threading
+import time
+import sys
+import argparse
+
+STALE_INTERVALS = 3
+
+class DHTSampler():
+
+        def __init__(self, readfunction, interval=30):
+                self.ReadFunction = readfunction				# Returns (humidity, temperature), either may be None on failure
+                self.Interval = interval
+                self.Lock = threading.Lock()
+                self.Stopping = threading.Event()
+                self.HumidIn = 0.0
+                self.TempIn = 0.0
+                self.Timestamp = 0						# time.time() of the last good reading, 0 = none yet
+                self.Thread = None
+
+        def Start(self):
+                self.Thread = threading.Thread(target=self.Run, name="DHTSampler", daemon=True)
+                self.Thread.start()
+
+        def Stop(self):
+                self.Stopping.set()
+                if self.Thread is not None:
+                        self.Thread.join()
+
+        def Run(self):
+                while not self.Stopping.is_set():
+                        self.Sample()
+                        self.Stopping.wait(self.Interval)
+
+# Function to take three readings and publish the calibrated median
+        def Sample(self):
+                HumidIn = []
+                TempIn = []
+                for ReadAttempt in range(3):
+                        try:
+                                Humid, Temp = self.ReadFunction()
+                        except Exception:
+                                continue
+                        if Humid is not None and Temp is not None:
+                                HumidIn.append(Humid)
+                                TempIn.append(Temp)
+                if not HumidIn:
+                        return							# Keep the previous reading rather than publish zeros
+                HumidIn.sort()
+                TempIn.sort()
+                HumidInFloat = HumidIn[len(HumidIn)//2] * 0.925
+                TempInFloat = (TempIn[len(TempIn)//2] * 1.09) - 1.50
+                with self.Lock:
+                        self.HumidIn = HumidInFloat
+                        self.TempIn = TempInFloat
+                        self.Timestamp = time.time()
+
+# Function to get the latest (humidity, temperature, timestamp) without touching the sensor, timestamp 0 if it is stale
+        def Latest(self):
+                with self.Lock:
+                        if time.time() - self.Timestamp > STALE_INTERVALS * self.Interval:
+                                return self.HumidIn, self.TempIn, 0
+                        return self.HumidIn, self.TempIn, self.Timestamp
+
+
+# Build a read function for the real DHT22
+def AdafruitReader(sensor, pin):
+        import Adafruit_DHT
+        return lambda: Adafruit_DHT.read_retry(sensor, pin)
+
+
+#------------------------------------------------------------------------------------
+# Latency check against a slow fake sensor
+#------------------------------------------------------------------------------------
+
+def LatencyCheck(sensordelay, packets):
+        def SlowSensor():
+                time.sleep(sensordelay)
+                return 50.0, 20.0
+
+        def Median(values):
+                values = sorted(values)
+                return values[len(values)//2]
+
+        Blocking = []
+        for packet in range(packets):						# Old path, three sensor reads per packet
+                start = time.perf_counter()
+                Readings = sorted(SlowSensor() for ReadAttempt in range(3))
+                Blocking.append(time.perf_counter() - start)
+
+        Sampler = DHTSampler(SlowSensor, interval=0)				# Worst case: sensor busy all the time
+        Sampler.Start()
+        Cached = []
+        for packet in range(packets * 100):
+                start = time.perf_counter()
+                HumidIn, TempIn, Timestamp = Sampler.Latest()
+                Cached.append(time.perf_counter() - start)
+                time.sleep(sensordelay / 50)
+        Sampler.Stop()
+
+        print("Sensor delay %.2fs per read" % sensordelay)
+        print("Blocking read   median %9.3f ms   max %9.3f ms" % (Median(Blocking) * 1000, max(Blocking) * 1000))
+        print("Cached reading  median %9.3f ms   max %9.3f ms" % (Median(Cached) * 1000, max(Cached) * 1000))
+        if max(Cached) > 0.005:
+                print("FAIL: cached reading latency depends on the sensor")
+                return 1
+        print("OK: packet handling latency is independent of the sensor")
+        return 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station DHT22 sampler")
+        parser.add_argument("--latency-check", action="store_true", help="compare packet handling latency with a slow fake sensor")
+        parser.add_argument("--delay", type=float, default=0.5, help="seconds the fake sensor takes per read")
+        parser.add_argument("--packets", type=int, default=3)
+        args = parser.parse_args()
+        if not args.latency_check:
+                parser.print_help()
+                sys.exit(0)
+        sys.exit(LatencyCheck(args.delay, args.packets))
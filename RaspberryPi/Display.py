@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+
+# Tk display for the Weather Station
+#
+# Everything shown comes from a State dict (see Snapshot() in WeatherStation.py), so the same
+# Display works inside the station process or in a separate GUI process attached to a headless
+# daemon through StateLink.py.
+#
+# Updates go through a view model: DisplayView() turns a state into the text and image of
+# every widget, and Render() only touches the widgets whose value differs from what was last
+# rendered. Packets arriving faster than Tk redraws are coalesced into one after_idle render.
+#
+# Run this file directly (needs an X display) to count Tk calls and time each frame:
+#       python3 Display.py --benchmark
+
+import math
+import datetime
+import os
+import sys
+import time
+import argparse
+import tkinter as tk
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from Chart import BlitChart
+
+# Function to turn a station state into what every widget should show, keyed by widget
+def DisplayView(State, Unit):
+        TempOutRange = State["temp_out_range"]					# Today's [max, min], None until the first reading
+        TempInRange = State["temp_in_range"]
+        PressRange = State["pressure_range"]
+        Trend = State["pressure_trend"]
+        Battery = State["battery"]
+        View = {"time": "Weather Station\n" + datetime.datetime.fromtimestamp(State["time"]).strftime("%d-%m-%Y %H:%M")}
+        if not Unit:
+                View["temp_humid_out"] = ' {:.1f}'.format(State["temp_out"]) + u'\N{DEGREE SIGN}C\n(' + '{:.0f}'.format(State["humid_out"]) + '%)'
+                View["temp_humid_in"] = ' {:.1f}'.format(State["temp_in"]) + u'\N{DEGREE SIGN}C\n(' + str(State["humid_in"]) + '%)' if State["temp_in"] is not None else "-"
+                View["temp_out_range"] = '{:.1f}\n\n{:.1f}'.format(*TempOutRange) if TempOutRange else "-"
+                View["temp_in_range"] = '{:.1f}\n\n{:.1f}'.format(*TempInRange) if TempInRange else "-"
+                View["pressure_range"] = '{:.0f}\n{:.0f}'.format(*PressRange) if PressRange else "-"
+                Pressure = '{:.0f}'.format(State["pressure"]) + " hPa"		# v2 stations send tenths, the layout has room for whole hPa
+                View["rain"] = '{:.1f}'.format(State["rain"]) + " mm"
+                View["rain_hour"] = '{:.1f}'.format(State["rain_hour"]) + "/H"
+        else:
+                View["temp_humid_out"] = ' {:.1f}'.format((State["temp_out"] / 5 * 9) + 32) + u'\N{DEGREE SIGN}F\n(' + '{:.0f}'.format(State["humid_out"]) + '%)'
+                View["temp_humid_in"] = ' {:.1f}'.format((State["temp_in"] / 5 * 9) + 32) + u'\N{DEGREE SIGN}F\n(' + str(State["humid_in"]) + '%)' if State["temp_in"] is not None else "-"
+                View["temp_out_range"] = ' {:.1f}\n\n{:.1f}'.format(*((Temp /5 * 9) + 32 for Temp in TempOutRange)) if TempOutRange else "-"
+                View["temp_in_range"] = ' {:.1f}\n\n{:.1f}'.format(*((Temp /5 * 9) + 32 for Temp in TempInRange)) if TempInRange else "-"
+                View["pressure_range"] = '{:.1f}\n{:.1f}'.format(*(Press * 0.03 for Press in PressRange)) if PressRange else "-"
+                Pressure = '{:.2f}'.format(State["pressure"] * 0.03) + " inHg"
+                View["rain"] = '{:.1f}'.format(State["rain"] / 25.4) + " in"
+                View["rain_hour"] = '{:.1f}'.format(State["rain_hour"] / 25.4) + "/H"
+        if (Trend > 0):
+                Pressure += " (+)"
+        elif (Trend < 0):
+                Pressure += " (-)"
+        View["pressure"] = Pressure
+        View["battery"] = '{:.1f}'.format(Battery) + "V"
+        if Battery > 12.5:
+                View["battery_image"] = "high"
+        elif Battery > 11.5:
+                View["battery_image"] = "mid"
+        else:
+                View["battery_image"] = "low"
+        View["wind_speed"] = '{:.0f}'.format(State["wind_speed"])
+        View["wind_gust"] = "(" + '{:.0f}'.format(State["wind_gust"]) + ")"
+        View["wind_calm"] = State["wind_speed"] == 0 and State["wind_gust"] == 0
+        View["wind_dir"] = State["wind_dir"]
+        return View
+
+# Class for all display functions
+
+class Display():
+
+        def __init__(self, main, rendertimer=None):
+                self.RenderTimer = rendertimer				# Called with each Render()'s duration in seconds, e.g. Histogram.Observe
+                self.Unit = False					# False = metric, True = Imperial
+                self.TempHumidOut_Text = tk.StringVar()
+                self.TempHumidOut_Text.set("-")
+
+                self.TempHumidIn_Text = tk.StringVar()
+                self.TempHumidIn_Text.set("-")
+
+                self.TempOutMinMax_Text = tk.StringVar()
+                self.TempOutMinMax_Text.set("-")
+
+                self.TempInMinMax_Text = tk.StringVar()
+                self.TempInMinMax_Text.set("-")
+
+                self.Pressure_Text = tk.StringVar()
+                self.Pressure_Text.set("-")
+
+                self.PressureMinMax_Text = tk.StringVar()
+                self.PressureMinMax_Text.set("-")
+
+                self.Rainfall_Text = tk.StringVar()
+                self.Rainfall_Text.set("-")
+
+                self.RainHour_Text = tk.StringVar()
+                self.RainHour_Text.set("-")
+
+                self.CurrentTime = tk.StringVar()
+                self.CurrentTime.set("-")
+
+                self.BattLevel_Text = tk.StringVar()
+                self.BattLevel_Text.set("--.-V")
+
+                os.chdir(os.path.dirname(__file__))
+
+                self.ThermInPic = tk.PhotoImage(file="ThermHumidIn.gif")
+                self.ThermOutPic = tk.PhotoImage(file="ThermHumidOut.gif")
+                self.PressurePic = tk.PhotoImage(file="Pressure.gif")
+                self.RainPic = tk.PhotoImage(file="RainFall.gif")
+                self.SignalPics = [tk.PhotoImage(file="Signal%d.gif" % Level) for Level in range(6)]	# 0 is the no signal warning
+                self.WindPic = tk.PhotoImage(file="WindSpeed.gif")
+                self.TempRangePic = tk.PhotoImage(file="TempRange.gif")			# Dummy to set 100 pixel height
+                self.OtherRangePic = tk.PhotoImage(file="OtherRange.gif")		# Dummy to set 60 pixel height
+                self.BattHighPic = tk.PhotoImage(file="BattHigh.gif")
+                self.BattMidPic = tk.PhotoImage(file="BattMid.gif")
+                self.BattLowPic = tk.PhotoImage(file="BattLow.gif")
+                self.weather = main
+                self.weatherframe = tk.Frame(self.weather, bg="black", width=800, height=480, relief=tk.RAISED, padx=2, pady=2, borderwidth=5)
+                self.weatherframe.grid(row=0, column=0)
+                self.weatherframe.grid_propagate(0)
+                self.weatherframe.grid_rowconfigure(1, weight=27)
+                self.weatherframe.grid_rowconfigure(2, weight=17)
+                self.weatherframe.grid_rowconfigure(3, weight=17)
+                self.weatherframe.grid_rowconfigure(4, weight=17)
+                self.weatherframe.grid_rowconfigure(5, weight=17)
+
+                self.currentlabel = tk.Label(self.weatherframe, textvariable=self.CurrentTime, bg="black", fg="white", font = "Verdana 12 bold")
+                self.currentlabel.grid(row=0, column=0, columnspan=4, sticky="n")
+
+                self.temphumidoutlabel = tk.Label(self.weatherframe, image=self.ThermOutPic, compound=tk.LEFT, bg="black", fg="white", textvariable=self.TempHumidOut_Text, anchor="w", relief=tk.SUNKEN, width=260, borderwidth=5, font = "Verdana 25 bold")
+                self.temphumidoutlabel.grid(row=1, column=0, sticky="w")
+
+                self.tempoutrangelabel = tk.Label(self.weatherframe, bg="black", fg="white", width=120, image=self.TempRangePic, compound=tk.RIGHT, textvariable=self.TempOutMinMax_Text, relief=tk.SUNKEN, borderwidth=5, font = "Verdana 16 bold")
+                self.tempoutrangelabel.grid(row=1,column=1, sticky="w")
+
+                self.temphumidinlabel = tk.Label(self.weatherframe, image=self.ThermInPic, compound=tk.LEFT, bg="black", fg="white", textvariable=self.TempHumidIn_Text, anchor="w", relief=tk.SUNKEN, borderwidth=5, width = 260, font = "Verdana 25 bold")
+                self.temphumidinlabel.grid(row=2, column=0, sticky="w")
+
+                self.tempinrangelabel = tk.Label(self.weatherframe, bg="black", fg="white", width=120, image=self.TempRangePic, compound=tk.LEFT, textvariable=self.TempInMinMax_Text, relief=tk.SUNKEN, borderwidth=5, font = "Verdana 16 bold")
+                self.tempinrangelabel.grid(row=2,column=1, sticky="w")
+
+                self.pressurelabel = tk.Label(self.weatherframe, image=self.PressurePic, compound=tk.LEFT, bg="black", fg="white", textvariable=self.Pressure_Text, anchor="w", relief=tk.SUNKEN, borderwidth=5, width = 260, font = "Verdana 20 bold")
+                self.pressurelabel.grid(row=3, column=0, sticky="w")
+
+                self.pressurerangelabel = tk.Label(self.weatherframe, bg="black", fg="white", width=120, image=self.OtherRangePic, compound=tk.LEFT, textvariable=self.PressureMinMax_Text, relief=tk.SUNKEN, borderwidth=5, font = "Verdana 16 bold")
+                self.pressurerangelabel.grid(row=3,column=1, sticky="w")
+
+                self.rainlabel = tk.Label(self.weatherframe, image=self.RainPic, compound=tk.LEFT, bg="black", fg="white", textvariable=self.Rainfall_Text, anchor="w", relief=tk.SUNKEN, borderwidth=5, width = 260, font = "Verdana 20 bold")
+                self.rainlabel.grid(row=4, column=0, sticky="w")
+
+                self.rainhourlabel = tk.Label(self.weatherframe, bg="black", fg="white", width=120, image=self.OtherRangePic, compound=tk.LEFT, textvariable=self.RainHour_Text, relief=tk.SUNKEN, borderwidth=5, font = "Verdana 16 bold")
+                self.rainhourlabel.grid(row=4,column=1, sticky="w")
+
+                self.signallabel = tk.Label(self.weatherframe, image=self.SignalPics[0])
+                self.signallabel.grid(row=0, column=3, sticky="en")
+
+                self.battlabel = tk.Label(self.weatherframe, image=self.BattHighPic, compound=tk.CENTER, fg="black", textvariable=self.BattLevel_Text, font = "Verdana 12 bold")
+                self.battlabel.grid(row=0, column=0, sticky="wn")
+
+                self.windcanvas = tk.Canvas(self.weatherframe, bg="black", width=350, height=280, relief=tk.SUNKEN, borderwidth=5)
+                self.windcanvas.grid(row=2,column=2, columnspan=2, rowspan=3)
+
+                self.wind_circle = self.windcanvas.create_oval(60,25,300,265,outline='white', width=5)
+
+                self.coords = self.CalculateWindTriangle(0,180,145)
+                self.winddirection = self.windcanvas.create_polygon(self.coords[0], self.coords[1], self.coords[2], self.coords[3], self.coords[4], self.coords[5], width=2, outline = "white", fill="blue")
+                self.winddirectiontail = self.windcanvas.create_line(self.coords[6], self.coords[7], self.coords[8], self.coords[9], width= 2, fill="white")
+                self.windspeed = self.windcanvas.create_text(180,130,text="0", justify=tk.CENTER, fill="white", font="Verdana 20 bold")
+                self.windgust = self.windcanvas.create_text(180,160,text="(0)", justify=tk.CENTER, fill="white", font="Verdana 20 bold")
+                self.northtext = self.windcanvas.create_text(180,15,text="N", fill="white", font="Verdana 12 bold")
+                self.northeasttext = self.windcanvas.create_text(280,53,text="NE", fill="white", font="Verdana 12 bold")
+                self.easttext = self.windcanvas.create_text(310,145,text="E", fill="white", font="Verdana 12 bold")
+                self.southeasttext = self.windcanvas.create_text(280,240,text="SE", fill="white", font="Verdana 12 bold")
+                self.southtext = self.windcanvas.create_text(180,275,text="S", fill="white", font="Verdana 12 bold")
+                self.southwesttext = self.windcanvas.create_text(75,235,text="SW", fill="white", font="Verdana 12 bold")
+                self.westtext = self.windcanvas.create_text(48,145,text="W", fill="white", font="Verdana 12 bold")
+                self.northwesttext = self.windcanvas.create_text(75,53,text="NW", fill="white", font="Verdana 12 bold")
+                self.mph = self.windcanvas.create_text(180,190,text="MPH", fill="white", font="Verdana 12 bold")
+
+                self.temphistorycanvas = tk.Canvas(self.weatherframe, bg="black", width=400, bd=5, height=100)
+                self.temphistorycanvas.grid(row=1, column=2, columnspan=2)
+                self.weather.bind('<Key>',self.Close)
+
+                self.figure1 = Figure(figsize=(3.8,1.1), dpi=100)
+                self.TempPlot = self.figure1.add_subplot(111)
+                self.TempPlot.set_facecolor("black")
+                self.figure1.patch.set_facecolor("black")
+                self.TempPlot.spines['bottom'].set_color('white')
+                self.TempPlot.tick_params(axis='x',colors='white')
+                self.TempPlot.spines['left'].set_color('white')
+                self.TempPlot.tick_params(axis='y',colors='white')
+
+                self.figure1.subplots_adjust(left=0.1,bottom=0.3,right=0.95)
+                self.TempHistGraph = FigureCanvasTkAgg(self.figure1, self.temphistorycanvas)
+                self.TempHistGraph.get_tk_widget().grid(row=0, column=0)
+                self.TempChart = BlitChart(self.TempHistGraph, self.TempPlot)	# Axes drawn once per day, lines blitted
+                self.TempChart.AddLine("trace", 'grey')				# The days in between, from the history index
+                self.TempChart.AddLine("max", 'r')
+                self.TempChart.AddLine("min", 'b')
+
+                self.TextVars = {"time": self.CurrentTime,			# View model keys shown through a StringVar
+                                 "temp_humid_out": self.TempHumidOut_Text,
+                                 "temp_humid_in": self.TempHumidIn_Text,
+                                 "temp_out_range": self.TempOutMinMax_Text,
+                                 "temp_in_range": self.TempInMinMax_Text,
+                                 "pressure": self.Pressure_Text,
+                                 "pressure_range": self.PressureMinMax_Text,
+                                 "rain": self.Rainfall_Text,
+                                 "rain_hour": self.RainHour_Text,
+                                 "battery": self.BattLevel_Text}
+                self.BattPics = {"high": self.BattHighPic, "mid": self.BattMidPic, "low": self.BattLowPic}
+                self.Rendered = {}							# What each widget shows now
+                self.State = None							# Latest state, waiting to be rendered
+                self.RenderPending = False
+
+
+        def Close(self,event):
+                self.weather.destroy()
+
+
+        def CalculateWindTriangle(self,degrees,CentreXCoord,CentreYCoord):
+                TipRadians = math.radians(degrees)					# Convert Triangle Tip angle to Radians
+                LeftRadians = math.radians(degrees - 18)				# Convert Triangle Left Tip angle to Radians
+                RightRadians = math.radians(degrees + 18)				# Convert Triangle Right Tip angle to Radians
+                TipXOffsetFromCentre = math.sin(TipRadians) * 115			# 120 = length of radius, but circle is not true on display so fudge it!
+                TipYOffsetFromCentre = math.cos(TipRadians) * 115
+                LeftXOffsetFromCentre = math.sin(LeftRadians) * 63			# 63 = length of radius to left/right triangle tip
+                LeftYOffsetFromCentre = math.cos(LeftRadians) * 63
+                RightXOffsetFromCentre = math.sin(RightRadians) * 63
+                RightYOffsetFromCentre = math.cos(RightRadians) * 63
+                TipXCoord = CentreXCoord + TipXOffsetFromCentre
+                TipYCoord = CentreYCoord - TipYOffsetFromCentre
+                LeftXCoord = CentreXCoord + LeftXOffsetFromCentre
+                LeftYCoord = CentreYCoord - LeftYOffsetFromCentre
+                RightXCoord = CentreXCoord + RightXOffsetFromCentre
+                RightYCoord = CentreYCoord - RightYOffsetFromCentre
+                TailEndRadians = math.radians((degrees+180)%360)
+                TailStartXOffsetFromCentre = math.sin(TailEndRadians) * 63
+                TailStartYOffsetFromCentre = math.cos(TailEndRadians) * 63
+                TailStartXCoord = CentreXCoord + TailStartXOffsetFromCentre
+                TailStartYCoord = CentreYCoord - TailStartYOffsetFromCentre
+                TailEndXOffsetFromCentre = math.sin(TailEndRadians) * 115
+                TailEndYOffsetFromCentre = math.cos(TailEndRadians) * 115
+                TailEndXCoord = CentreXCoord + TailEndXOffsetFromCentre
+                TailEndYCoord = CentreYCoord - TailEndYOffsetFromCentre
+                return (TipXCoord, TipYCoord, LeftXCoord, LeftYCoord, RightXCoord, RightYCoord, TailStartXCoord, TailStartYCoord, TailEndXCoord, TailEndYCoord)
+
+# Function to update the temperature history chart
+        def UpdateTempHistory(self, State):
+                self.DayNow = datetime.datetime.fromtimestamp(State["time"])
+                self.CurrentDOW = self.DayNow.weekday()
+                if (self.CurrentDOW == 6):
+                        self.CurrentDOW = 0						# If it's Sunday then set the history start to previous Monday
+                else:
+                        self.CurrentDOW += 1						# Otherwise just set the history start to 6 days ago
+                self.DOW = ['Mo','Tu','We','Th','Fr','Sa','Su']				# List of days for display
+                self.DOW = self.DOW[self.CurrentDOW:] + self.DOW[:self.CurrentDOW] 	# Rotate according to current day of week
+                if not self.Unit:							# Metric
+                        HistoryMax = State["history_max"]
+                        HistoryMin = State["history_min"]
+                else:									# Imperial
+                        HistoryMax = [(Temp /5 * 9) + 32 for Temp in State["history_max"]]
+                        HistoryMin = [(Temp /5 * 9) + 32 for Temp in State["history_min"]]
+                MaxTemp = max(HistoryMax)
+                MaxAxisTemp = MaxTemp + (MaxTemp/100.0*10)
+                MinTemp = min(HistoryMin)
+                MinAxisTemp = MinTemp - (MinTemp/100.0*10)
+                self.TempChart.SetFrame((0,5), (MinAxisTemp,MaxAxisTemp), [0,1,2,3,4,5],
+                                        [round(MinTemp,-1),round((MaxTemp-MinTemp)/4,-1),round((MaxTemp-MinTemp)/2,-1),round((MaxTemp-MinTemp)*3/4,-1),round(MaxTemp,-1)],
+                                        self.DOW[0:6])						# Show rotated days of week
+                Trace = State.get("history_trace") or [[], []]
+                if self.Unit:
+                        Trace = [Trace[0], [(Temp /5 * 9) + 32 for Temp in Trace[1]]]
+                self.TempChart.SetData("trace", Trace[0], Trace[1])
+                self.TempChart.SetData("max", range(6), HistoryMax)
+                self.TempChart.SetData("min", range(6), HistoryMin)
+                self.TempChart.Draw()
+
+# Function to take a new station state, rendered once Tk is idle however many arrive before then
+        def UpdateDisplay(self, State):
+                self.State = State
+                if not self.RenderPending:
+                        self.RenderPending = True
+                        self.weather.after_idle(self.Render)
+
+# Function to bring the widgets up to date with the latest state, only touching those that changed
+        def Render(self):
+                self.RenderPending = False
+                Started = time.perf_counter()
+                for Key, Value in DisplayView(self.State, self.Unit).items():
+                        if self.Rendered.get(Key) == Value:
+                                continue
+                        self.Rendered[Key] = Value
+                        if Key in self.TextVars:
+                                self.TextVars[Key].set(Value)
+                        elif Key == "battery_image":
+                                self.battlabel.config(image=self.BattPics[Value])
+                        elif Key == "wind_speed":
+                                self.windcanvas.itemconfigure(self.windspeed, text=Value)
+                        elif Key == "wind_gust":
+                                self.windcanvas.itemconfigure(self.windgust, text=Value)
+                        elif Key == "wind_calm":
+                                if Value:
+                                        self.windcanvas.itemconfigure(self.winddirection, outline='black', fill='black')
+                                else:
+                                        self.windcanvas.itemconfigure(self.winddirection, outline='white', fill='blue')
+                        elif Key == "wind_dir":
+                                self.coords = self.CalculateWindTriangle(((Value+180)%360),180,145)
+                                self.windcanvas.coords(self.winddirection, self.coords[0], self.coords[1], self.coords[2], self.coords[3], self.coords[4], self.coords[5], self.coords[0], self.coords[1])
+                                self.windcanvas.coords(self.winddirectiontail, self.coords[6], self.coords[7], self.coords[8], self.coords[9])
+                if self.RenderTimer is not None:
+                        self.RenderTimer(time.perf_counter() - Started)
+
+# Function to show the signal strength icon, 0-5 bars
+        def UpdateSignal(self,SignalLevel):
+                if self.Rendered.get("signal") == SignalLevel:
+                        return
+                self.Rendered["signal"] = SignalLevel
+                self.signallabel.config(image=self.SignalPics[SignalLevel])
+
+#------------------------------------------------------------------------------------
+# End of Display Class
+#------------------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------------
+# Benchmark: Tk calls and frame time per packet, repainting everything vs rendering changes
+#------------------------------------------------------------------------------------
+
+# Wraps the Tcl interpreter of a Tk root to count the calls made through it
+class CountingTk():
+
+        def __init__(self, interpreter):
+                self.Interpreter = interpreter
+                self.Calls = 0
+
+        def call(self, *args):
+                self.Calls += 1
+                return self.Interpreter.call(*args)
+
+        def __getattr__(self, name):
+                return getattr(self.Interpreter, name)
+
+
+def Benchmark(hours):
+        import tempfile
+        from Simulation import Simulator, GenerateCapture
+        start = datetime.datetime(2021, 6, 1, 9).timestamp()
+        sim = Simulator(start, os.path.join(tempfile.mkdtemp(), "WeatherStation.db"))
+        States = []
+        for packet in GenerateCapture(start, hours / 24):			# The states a station would publish, one per packet
+                sim.Replay([packet])
+                States.append(sim.Display.State)
+        Window = tk.Tk()
+        Counter = CountingTk(Window.tk)
+        Window.tk = Counter							# Widgets created from here on call through the counter
+        MainWindow = Display(Window)
+        Window.update()
+        for Name, Full in (("repaint all", True), ("changes only", False)):
+                Calls = []
+                Frames = []
+                for State in States:
+                        Before = Counter.Calls
+                        Started = time.perf_counter()
+                        if Full:						# What every packet used to cost
+                                MainWindow.Rendered.clear()
+                                MainWindow.UpdateDisplay(State)
+                                Window.update_idletasks()
+                                MainWindow.weatherframe.update()
+                        else:
+                                MainWindow.UpdateDisplay(State)
+                                Window.update_idletasks()
+                        Frames.append(time.perf_counter() - Started)
+                        Calls.append(Counter.Calls - Before)
+                Frames.sort()
+                print("%-13s %6.1f Tk calls/packet  %6.2f ms/frame mean  %6.2f ms p95" % (Name, sum(Calls) / len(Calls), sum(Frames) / len(Frames) * 1000, Frames[int(len(Frames) * 0.95)] * 1000))
+        Window.destroy()
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station Tk display")
+        parser.add_argument("--benchmark", action="store_true", help="count Tk calls and time frames for replayed packets")
+        parser.add_argument("--hours", type=float, default=2, help="hours of synthetic packets to replay")
+        args = parser.parse_args()
+        if not args.benchmark:
+                parser.print_help()
+                sys.exit(0)
+        Benchmark(args.hours)
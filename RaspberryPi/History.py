@@ -0,0 +1,621 @@
+#!/usr/bin/python3
+
+# Bulk export and backfill of a station's history, run beside WeatherStation.py
+#
+# Export streams a table of the sample store (samples, hourly, daily) or the per minute archive
+# out as CSV, JSON lines or Parquet. Rows are read a chunk at a time, each chunk its own short
+# query (SampleStore.Chunks()) or a slice of the archive's memory maps, and go through
+# generators straight to the output. So memory stays the same however many years are exported,
+# and the station can keep writing the same store meanwhile.
+#
+# Import backfills a sample store from
+#       capture - the raw payloads WeatherStation.py --record writes, see Simulation.py
+#       csv     - a header row naming the columns: this tool's exports, the CsvSink's daily files,
+#                 or a ThingSpeak channel export (created_at, entry_id, field1..field8 in Uploader.FIELDS order)
+#       jsonl   - one object a line, named as in the exports
+# The file is read in chunks of lines that a pool of worker processes decodes, at most AHEAD
+# chunks per worker in flight, and the rows are written in file order, one transaction a chunk.
+# A row whose time is already in the store (to the millisecond) is skipped, so an import can be
+# run again. Every day an import adds to is rolled up again, the archive and history index are
+# caught up to the last whole day, and the store's retention then applies as it does on the
+# station. Files are expected in time order, as they are written. Stop the station first: the
+# import appends to its archive and index.
+#
+# Backfill sends the minute means of a time range in the store to the minute sinks in Sinks.ini,
+# ThingSpeak's bulk update after an outage, and waits for them to go. It gives up when every
+# sink still holding minutes keeps failing, or nothing has gone for DRAIN_TIMEOUT, and says
+# what was not sent and where to start again. The sinks' own backlog files are left to the station.
+#
+# Parquet needs pyarrow, everything else only NumPy (for the archive and backfill).
+#
+#       python3 History.py --export samples --start 2021-06-01 --end 2021-07-01 > June.csv
+#       python3 History.py --export archive --format parquet --output Archive.parquet
+#       python3 History.py --import capture.txt --workers 4
+#       python3 History.py --import feeds.csv
+#       python3 History.py --backfill --start 2021-06-03T09:00 --end 2021-06-04 --sink thingspeak:1
+#       python3 History.py --benchmark --years 2
+
+import collections
+import itertools
+import datetime
+import json
+import csv
+import math
+import time
+import os
+import sys
+import argparse
+from PayloadParser import ParsePayload, KIND_WEATHER, KIND_STATUS
+from SampleStore import SampleStore, SampleRow, SAMPLE_COLUMNS, TABLE_KEYS
+from Stations import StationFile
+from Uploader import FIELDS
+
+FORMATS = ("csv", "jsonl", "parquet")
+IMPORT_FORMATS = ("capture", "csv", "jsonl")
+TABLES = tuple(TABLE_KEYS) + ("archive",)
+CHUNK_ROWS = 5000							# Rows per read when exporting
+CHUNK_LINES = 20000							# Lines per decode task when importing, about a day of packets
+AHEAD = 2								# Decode tasks in flight per worker
+TEXT_COLUMNS = ("kind", "day")
+INTEGER_COLUMNS = ("hour", "samples")
+TENTHS = ("temp_out", "wind_gust", "rain", "rain_hour")			# Uploaded to 0.1, the rest whole numbers
+DRAIN_FAILURES = 3							# Failed requests in a row a backfill sink gets before giving up
+DRAIN_TIMEOUT = 900							# Seconds a backfill waits for any sink to deliver something
+
+
+# Function to read a time as Unix seconds: a number, or ISO 8601 in local time unless it has a zone
+# (ThingSpeak's exports end in " UTC")
+def ParseTime(text):
+        try:
+                return float(text)
+        except ValueError:
+                pass
+        if text.endswith(" UTC"):
+                text = text[:-4] + "+00:00"
+        elif text.endswith("Z"):
+                text = text[:-1] + "+00:00"
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+# Function to get the SAMPLE_COLUMNS position an exported name is stored in, fieldN by Uploader.FIELDS, or None
+def ColumnOf(name):
+        if name in SAMPLE_COLUMNS:
+                return SAMPLE_COLUMNS.index(name)
+        if name.startswith("field") and name[5:].isdigit() and 1 <= int(name[5:]) <= len(FIELDS):
+                return SAMPLE_COLUMNS.index(FIELDS[int(name[5:]) - 1])
+        return None
+
+
+#------------------------------------------------------------------------------------
+# Export: generators of (column names, rows) chunks and the writers that drain them
+#------------------------------------------------------------------------------------
+
+# Generator of (column names, rows) chunks of a table with start <= time < end, oldest first
+def ReadChunks(table, start, end, dbpath, archivepath=None, size=CHUNK_ROWS):
+        if table == "archive":
+                yield from ArchiveChunks(archivepath, start, end, size)
+                return
+        if table == "daily":							# Keyed by local date, any day that starts before end
+                start = datetime.date.fromtimestamp(start).isoformat() if start > 0 else ""
+                if end < math.inf:
+                        day = datetime.date.fromtimestamp(end)
+                        if datetime.datetime.combine(day, datetime.time()).timestamp() < end:
+                                day += datetime.timedelta(days=1)
+                        end = day.isoformat()
+                else:
+                        end = "9999-12-31"
+        store = SampleStore(dbpath, readonly=True)
+        try:
+                yield from store.Chunks(table, start, end, size)
+        finally:
+                store.Close()
+
+
+# Generator of (column names, rows) chunks of the per minute archive, NaN as None and float32 to 3 places
+def ArchiveChunks(path, start, end, size):
+        import numpy as np
+        from Analytics import ColumnArchive, ARCHIVE_COLUMNS
+        if not os.path.isdir(path):
+                raise FileNotFoundError("No archive at %s" % path)
+        columns = ColumnArchive(path).Columns()
+        names = [name for name, dtype in ARCHIVE_COLUMNS]
+        first, last = np.searchsorted(columns["time"], (start, end))
+        for index in range(first, last, size):
+                values = []
+                for name in names:
+                        column = columns[name][index:min(index + size, last)].astype(np.float64)
+                        if name != "time":
+                                column = column.round(3)
+                        missing = np.isnan(column)
+                        column = column.astype(object)
+                        column[missing] = None
+                        values.append(column.tolist())
+                yield names, list(zip(*values))
+
+
+# Function to write chunks as CSV with a header row, None as an empty field. Returns the rows written
+def WriteCsv(output, chunks):
+        writer = csv.writer(output)
+        count = 0
+        for columns, rows in chunks:
+                if count == 0:
+                        writer.writerow(columns)
+                writer.writerows(rows)
+                count += len(rows)
+        return count
+
+
+# Function to write chunks as one JSON object a line. Returns the rows written
+def WriteJsonLines(output, chunks):
+        encode = json.JSONEncoder().encode
+        count = 0
+        for columns, rows in chunks:
+                output.write("".join(encode(dict(zip(columns, row))) + "\n" for row in rows))
+                count += len(rows)
+        return count
+
+
+# Function to write chunks to a Parquet file, one row group a chunk so only one chunk is ever held. Returns the rows written
+def WriteParquet(path, chunks):
+        import pyarrow
+        import pyarrow.parquet
+        writer = None
+        count = 0
+        try:
+                for columns, rows in chunks:
+                        if writer is None:
+                                schema = pyarrow.schema([(name, pyarrow.string() if name in TEXT_COLUMNS else pyarrow.int64() if name in INTEGER_COLUMNS else pyarrow.float64()) for name in columns])
+                                writer = pyarrow.parquet.ParquetWriter(path, schema)
+                        writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(values, field.type) for values, field in zip(zip(*rows), schema)], schema=schema))
+                        count += len(rows)
+        finally:
+                if writer is not None:
+                        writer.close()
+        return count
+
+
+# Function to export a table to a file, or stdout for "-". Returns the rows written
+def Export(table, form, start, end, dbpath, archivepath, path="-"):
+        chunks = ReadChunks(table, start, end, dbpath, archivepath)
+        if form == "parquet":
+                if path == "-":
+                        raise ValueError("Parquet needs an --output file")
+                return WriteParquet(path, chunks)
+        write = WriteCsv if form == "csv" else WriteJsonLines
+        if path == "-":
+                return write(sys.stdout, chunks)
+        with open(path, 'w', newline='') as output:
+                return write(output, chunks)
+
+
+#------------------------------------------------------------------------------------
+# Import: chunks of lines decoded by worker processes, written in order
+#------------------------------------------------------------------------------------
+
+# Function to tell an import file's format from its name
+def ImportFormat(path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".csv":
+                return "csv"
+        if extension in (".jsonl", ".ndjson", ".json"):
+                return "jsonl"
+        return "capture"
+
+
+# Generator of decode tasks (format, header line, lines) of up to size lines each
+def LineChunks(path, form, size=CHUNK_LINES):
+        with open(path, newline='') as source:
+                header = source.readline() if form == "csv" else None
+                while True:
+                        lines = list(itertools.islice(source, size))
+                        if not lines:
+                                return
+                        yield form, header, lines
+
+
+# Function to find the time, kind and sample columns in a CSV header line, ValueError if there is no time column
+def CsvColumns(header):
+        names = next(csv.reader([header]), [])
+        if "created_at" in names:
+                when = names.index("created_at")
+        elif "time" in names:
+                when = names.index("time")
+        else:
+                raise ValueError("CSV header has no created_at or time column: %s" % header.strip())
+        kind = names.index("kind") if "kind" in names else None
+        return when, kind, [(position, ColumnOf(name)) for position, name in enumerate(names) if ColumnOf(name) is not None]
+
+
+# Function run by the workers to decode one task into ([(pipe, samples row)], lines that did not
+# parse). Pipe is None for a CSV or JSON row, which are for the station being imported into
+def DecodeChunk(task):
+        form, header, lines = task
+        rows = []
+        if form == "capture":
+                for line in lines:
+                        fields = line.split()
+                        try:
+                                reading = ParsePayload(bytes.fromhex(fields[1]))
+                                if reading.Kind not in (KIND_WEATHER, KIND_STATUS):
+                                        continue				# Corrupt or unknown frame, counted as not parsed
+                                rows.append((int(fields[2]) if len(fields) > 2 else 1, SampleRow(float(fields[0]), reading)))
+                        except (ValueError, IndexError):
+                                continue
+        elif form == "csv":
+                when, kind, targets = CsvColumns(header)
+                for fields in csv.reader(lines):
+                        try:
+                                values = [None] * len(SAMPLE_COLUMNS)
+                                for position, column in targets:
+                                        if fields[position] != "":
+                                                values[column] = float(fields[position])
+                                rows.append((None, (ParseTime(fields[when]), fields[kind] if kind is not None else 'T') + tuple(values)))
+                        except (ValueError, IndexError):
+                                continue
+        else:
+                for line in lines:
+                        try:
+                                sample = json.loads(line)
+                                values = [None] * len(SAMPLE_COLUMNS)
+                                for name, value in sample.items():
+                                        column = ColumnOf(name)
+                                        if column is not None and value is not None:
+                                                values[column] = float(value)
+                                stamp = sample["time"] if "time" in sample else sample["created_at"]
+                                rows.append((None, (stamp if isinstance(stamp, (int, float)) else ParseTime(stamp), sample.get("kind", 'T')) + tuple(values)))
+                        except (ValueError, KeyError, TypeError, AttributeError):
+                                continue
+        return rows, len(lines) - len(rows)
+
+
+# Generator of function(item) for each item in order, from workers processes with at most ahead items each
+# in flight, so a long input is only read as fast as it is decoded. One worker runs in this process
+def OrderedMap(function, items, workers, ahead=AHEAD):
+        if workers <= 1:
+                yield from map(function, items)
+                return
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as pool:
+                pending = collections.deque()
+                for item in items:
+                        pending.append(pool.submit(function, item))
+                        if len(pending) >= workers * ahead:
+                                yield pending.popleft().result()
+                while pending:
+                        yield pending.popleft().result()
+
+
+# Writes decoded rows to each pipe's store and keeps its rollups, archive and history index up with them
+class Importer():
+
+        def __init__(self, dbpath, archivepath=None, indexpath=None, pipe=1, rawdays=31):
+                self.DbPath = dbpath
+                self.ArchivePath = archivepath
+                self.IndexPath = indexpath
+                self.Pipe = pipe						# Station that CSV and JSON rows are for
+                self.RawDays = rawdays
+                self.Stations = {}						# Pipe -> [store, archive, index, last time added]
+                self.Added = 0
+                self.Duplicates = 0
+                self.Unparsed = 0
+
+        def Station(self, pipe):
+                if pipe not in self.Stations:
+                        archive = index = None
+                        if self.ArchivePath:
+                                from Analytics import ColumnArchive
+                                archive = ColumnArchive(StationFile(self.ArchivePath, pipe))
+                        if self.IndexPath:
+                                from HistoryIndex import HistoryIndex
+                                index = HistoryIndex(StationFile(self.IndexPath, pipe))
+                        self.Stations[pipe] = [SampleStore(StationFile(self.DbPath, pipe), rawdays=self.RawDays), archive, index, None]
+                return self.Stations[pipe]
+
+# Function to add one decoded chunk, as DecodeChunk() returns it
+        def Add(self, decoded):
+                rows, unparsed = decoded
+                self.Unparsed += unparsed
+                pipes = collections.defaultdict(list)
+                for pipe, row in rows:
+                        pipes[self.Pipe if pipe is None else pipe].append(row)
+                for pipe, rows in pipes.items():
+                        station = self.Station(pipe)
+                        store = station[0]
+                        first = min(row[0] for row in rows)
+                        last = max(row[0] for row in rows)
+                        stored = store.Times(first, last)
+                        new = [row for row in rows if round(row[0], 3) not in stored]
+                        self.Duplicates += len(rows) - len(new)
+                        if not new:
+                                continue
+                        self.Added += store.AppendRows(new)
+                        store.RollupDays(set(datetime.date.fromtimestamp(when) for when in set(row[0] // 3600 * 3600 for row in new)))
+                        station[3] = last if station[3] is None else max(station[3], last)
+                        midnight = datetime.datetime.combine(datetime.date.fromtimestamp(last), datetime.time()).timestamp()
+                        self.Catchup(station, midnight)
+                        store.Prune(min(time.time(), midnight + store.RawDays * 86400))	# Never a day that is not rolled up yet
+
+# Function to archive and index a station's minutes before until, as the station does at midnight
+        def Catchup(self, station, until):
+                store, archive, index, last = station
+                if archive is not None:
+                        archive.Export(store, until)
+                if index is not None:
+                        index.Catchup(store, until)
+
+# Function to catch up to the last minute imported and apply the stores' retention
+        def Finish(self):
+                for store, archive, index, last in self.Stations.values():
+                        if last is not None:
+                                self.Catchup((store, archive, index, last), last // 60 * 60 + 60)
+                        store.Prune(time.time())
+
+        def Close(self):
+                for store, archive, index, last in self.Stations.values():
+                        if index is not None:
+                                index.Close()
+                        store.Close()
+
+
+# Function to import a file into the stores. Returns the Importer with its counts, ValueError for a CSV file without a time column
+def Import(path, form, dbpath, archivepath=None, indexpath=None, pipe=1, workers=1, rawdays=31, progress=False):
+        if form == "csv":
+                with open(path, newline='') as source:
+                        CsvColumns(source.readline())				# Checked once here rather than failing in every worker
+        importer = Importer(dbpath, archivepath, indexpath, pipe, rawdays)
+        try:
+                for decoded in OrderedMap(DecodeChunk, LineChunks(path, form), workers):
+                        importer.Add(decoded)
+                        if progress and decoded[0]:
+                                print("%s  %d rows added" % (datetime.datetime.fromtimestamp(decoded[0][-1][1][0]).strftime("%Y-%m-%d %H:%M"), importer.Added), file=sys.stderr)
+                importer.Finish()
+        finally:
+                importer.Close()
+        return importer
+
+
+#------------------------------------------------------------------------------------
+# Backfill: minute means from the store to the upload sinks
+#------------------------------------------------------------------------------------
+
+# Function to send the minute means of the weather packets in a store with start <= time < end to the
+# minute sinks in a Sinks.ini for the station on pipe, or only the named ones. A day is read at a time and
+# never more than half of a sink's backlog is queued. Returns the minutes queued, {sink name: minutes it
+# did not deliver} and the time to start again from, None if every sink took everything
+def Backfill(start, end, dbpath, sinkspath, pipe=1, names=None, station=None):
+        import numpy as np
+        from Analytics import MinuteColumns
+        from Uploader import ReadSinks, ThingSpeakUploader, MINUTE_FEED
+        if station is None:
+                from WeatherStation import STATIONS
+                station = STATIONS.get(pipe, "Station %d" % pipe)
+        sinks = [sink for sinkpipe, sink in ReadSinks(sinkspath) if sinkpipe in (None, pipe) and sink.Feed == MINUTE_FEED and (not names or sink.Name in names)]
+        if not sinks:
+                raise ValueError("No minute sinks for pipe %d in %s" % (pipe, sinkspath))
+        for sink in sinks:
+                sink.Pending.clear()						# The station's backlog is the station's to send
+                sink.BackupFile = None
+                sink.BacklogOnDisk = False
+                if isinstance(sink, ThingSpeakUploader) and not sink.Channel:
+                        print("%s has no channel, so one update every %ds instead of bulk updates" % (sink.Name, sink.MinInterval), file=sys.stderr)
+                sink.Start()
+        store = SampleStore(StationFile(dbpath, pipe), readonly=True)
+        count = 0
+        drained = True
+        try:
+                day = max(start, FirstSample(store))
+                while day < end and drained:
+                        until = min(end, datetime.datetime.combine(datetime.date.fromtimestamp(day) + datetime.timedelta(days=1), datetime.time()).timestamp())
+                        rows = store.Db.execute("SELECT time, temp_out, humid_out, pressure, rain, rain_hour, wind_speed, wind_gust, wind_dir, temp_in, humid_in "
+                                                "FROM samples WHERE kind IN ('T', 't') AND time >= ? AND time < ? ORDER BY time", (day, until)).fetchall()
+                        if rows:
+                                columns = MinuteColumns(np.array(rows, dtype=np.float64))
+                                for index, when in enumerate(columns["time"].tolist()):
+                                        minute = dict((name, columns[name][index]) for name in FIELDS)
+                                        if np.isnan(minute["temp_out"]):
+                                                continue				# As UploadMinute, nothing without a weather reading
+                                        values = {}
+                                        for name, value in minute.items():		# Rounded as UploadMinute rounds them
+                                                if not np.isnan(value):
+                                                        values[name] = round(float(value), 1) if name in TENTHS else int(round(value)) % 360 if name == "wind_dir" else int(round(value))
+                                        for sink in sinks:
+                                                sink.Submit(station, values, when)
+                                        count += 1
+                                        if count % 1000 == 0 and not Drain(sinks, 0.5):
+                                                drained = False
+                                                break
+                        if drained:
+                                print("%s  %d minutes queued" % (datetime.date.fromtimestamp(day), count), file=sys.stderr)
+                                day = until
+                if drained:
+                        Drain(sinks, 0)
+        finally:
+                for sink in sinks:
+                        sink.Stop()						# One last try for whatever is left
+                store.Close()
+        unsent = dict((sink.Name, count - sink.Sent) for sink in sinks if sink.Sent < count)
+        resume = min([sink.Pending[0]["time"] for sink in sinks if sink.Pending] + ([] if drained else [day]), default=None)
+        return count, unsent, resume
+
+
+# Function to get the time of the oldest sample in a store, where a backfill from the beginning starts
+def FirstSample(store):
+        first = store.Db.execute("SELECT MIN(time) FROM samples").fetchone()[0]
+        return first if first is not None else math.inf
+
+
+# Function to wait until no sink has more than the given share of its backlog queued. Returns False early
+# if every sink still over it is backing off after DRAIN_FAILURES more failures, or none has sent anything
+# for timeout seconds
+def Drain(sinks, share, timeout=DRAIN_TIMEOUT):
+        failed = dict((sink.Name, sink.Failed) for sink in sinks)
+        sent = sum(sink.Sent for sink in sinks)
+        progress = time.monotonic()
+        while True:
+                waiting = [sink for sink in sinks if sink.Metrics()["queue_depth"] > sink.Pending.maxlen * share]
+                if not waiting:
+                        return True
+                if all(sink.Backoff > 0 and sink.Failed - failed[sink.Name] >= DRAIN_FAILURES for sink in waiting):
+                        return False
+                if sum(sink.Sent for sink in sinks) != sent:
+                        sent = sum(sink.Sent for sink in sinks)
+                        progress = time.monotonic()
+                elif time.monotonic() - progress > timeout:
+                        return False
+                time.sleep(1)
+
+
+#------------------------------------------------------------------------------------
+# Throughput benchmark on a synthetic multi-year capture
+#------------------------------------------------------------------------------------
+
+def Benchmark(years, cadence, workers):
+        import tempfile
+        import tracemalloc
+        from Simulation import GenerateCapture
+        folder = tempfile.mkdtemp()
+        start = datetime.datetime(2019, 1, 1).timestamp()
+        capture = os.path.join(folder, "capture.txt")
+        started = time.perf_counter()
+        lines = 0
+        with open(capture, 'w') as output:
+                for when, payload, pipe in GenerateCapture(start, years * 365.25, cadence):
+                        output.write("%.3f %s\n" % (when, payload.hex()))
+                        lines += 1
+        last = when
+        print("Generated %.1f years of packets every %ds: %d lines, %.0f MB in %.1fs" % (years, cadence, lines, os.path.getsize(capture) / 1e6, time.perf_counter() - started))
+        failures = 0
+
+        print("Decode, %d CPUs:" % os.cpu_count())
+        for count in sorted(set((1, workers))):
+                started = time.perf_counter()
+                decoded = sum(len(rows) for rows, unparsed in OrderedMap(DecodeChunk, LineChunks(capture, "capture"), count))
+                elapsed = time.perf_counter() - started
+                print("  %d worker%s %9.0f packets/s" % (count, "" if count == 1 else "s", decoded / elapsed))
+
+        keep = int((time.time() - start) / 86400) + 2			# Keep every sample, so the export has years of them
+        dbpath = os.path.join(folder, "WeatherStation.db")
+        started = time.perf_counter()
+        importer = Import(capture, "capture", dbpath, os.path.join(folder, "Archive"), os.path.join(folder, "Index"), workers=workers, rawdays=keep)
+        elapsed = time.perf_counter() - started
+        store = SampleStore(dbpath, rawdays=keep)
+        days = store.Db.execute("SELECT COUNT(*) FROM daily").fetchone()[0]
+        ok = importer.Added == lines and importer.Unparsed == 0 and days == (datetime.date.fromtimestamp(last) - datetime.date.fromtimestamp(start)).days + 1
+        failures += not ok
+        print("Import capture   %9d rows %6.1fs %9.0f rows/s, %d days rolled up, %.0f MB store  %s" % (importer.Added, elapsed, importer.Added / elapsed, days, os.path.getsize(dbpath) / 1e6, "OK" if ok else "FAIL"))
+        started = time.perf_counter()
+        again = Import(capture, "capture", dbpath, workers=workers, rawdays=keep)
+        elapsed = time.perf_counter() - started
+        ok = again.Added == 0 and again.Duplicates == lines
+        failures += not ok
+        print("Import again     %9d rows %6.1fs %9.0f rows/s, all duplicates  %s" % (again.Duplicates, elapsed, again.Duplicates / elapsed, "OK" if ok else "FAIL"))
+
+        try:
+                import pyarrow
+                forms = FORMATS
+        except ImportError:
+                forms = FORMATS[:2]
+                print("Parquet skipped, no pyarrow")
+        for table in ("samples", "archive"):
+                for form in forms:
+                        path = os.path.join(folder, "%s.%s" % (table, form))
+                        started = time.perf_counter()
+                        rows = Export(table, form, 0, math.inf, dbpath, os.path.join(folder, "Archive"), path)
+                        elapsed = time.perf_counter() - started
+                        print("Export %-7s %-7s %9d rows %6.1fs %9.0f rows/s, %6.0f MB" % (table, form, rows, elapsed, rows / elapsed, os.path.getsize(path) / 1e6))
+
+        peaks = []								# The same whatever the range, if nothing builds up
+        for share in (0.1, 1):
+                tracemalloc.start()
+                for chunk in ReadChunks("samples", 0, start + share * years * 365.25 * 86400, dbpath, size=min(CHUNK_ROWS, max(100, lines // 100))):	# A tenth is several chunks however short the run
+                        pass
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+        ok = peaks[1] < peaks[0] * 1.5
+        failures += not ok
+        print("Export memory    %.1f MB peak for a tenth of the samples, %.1f MB for all of them  %s" % (peaks[0] / 1e6, peaks[1] / 1e6, "OK" if ok else "FAIL"))
+
+        source = store.Db.execute("SELECT COUNT(*), TOTAL(temp_out), TOTAL(pressure), TOTAL(wind_dir) FROM samples").fetchone()
+        copy = os.path.join(folder, "Copy.db")
+        started = time.perf_counter()
+        Import(os.path.join(folder, "samples.csv"), "csv", copy, workers=workers, rawdays=keep)
+        elapsed = time.perf_counter() - started
+        result = SampleStore(copy).Db.execute("SELECT COUNT(*), TOTAL(temp_out), TOTAL(pressure), TOTAL(wind_dir) FROM samples").fetchone()
+        ok = result[0] == source[0] and all(abs(a - b) <= 1e-6 * abs(a) for a, b in zip(result[1:], source[1:]))
+        failures += not ok
+        print("Import CSV export %8d rows %6.1fs %9.0f rows/s, same totals  %s" % (result[0], elapsed, result[0] / elapsed, "OK" if ok else "FAIL"))
+
+        feeds = os.path.join(folder, "feeds.csv")				# A ThingSpeak channel export of the archive's minutes
+        with open(feeds, 'w', newline='') as output:
+                writer = csv.writer(output)
+                writer.writerow(["created_at", "entry_id"] + ["field%d" % (index + 1) for index in range(len(FIELDS))])
+                entry = 0
+                for columns, rows in ReadChunks("archive", 0, math.inf, dbpath, os.path.join(folder, "Archive")):
+                        for row in rows:
+                                minute = dict(zip(columns, row))
+                                entry += 1
+                                writer.writerow([datetime.datetime.fromtimestamp(minute["time"], datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC"), entry] + ["" if minute[name] is None else minute[name] for name in FIELDS])
+        started = time.perf_counter()
+        thingspeak = Import(feeds, "csv", os.path.join(folder, "ThingSpeak.db"), workers=workers, rawdays=keep)
+        elapsed = time.perf_counter() - started
+        first = SampleStore(os.path.join(folder, "ThingSpeak.db")).Db.execute("SELECT MIN(time) FROM samples").fetchone()[0]
+        ok = thingspeak.Added == entry and first == start
+        failures += not ok
+        print("Import ThingSpeak %8d rows %6.1fs %9.0f rows/s  %s" % (thingspeak.Added, elapsed, thingspeak.Added / elapsed, "OK" if ok else "FAIL"))
+        return 1 if failures else 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station history export, import and backfill")
+        parser.add_argument("--export", choices=TABLES, help="write a table of the sample store, or the per minute archive, to --output")
+        parser.add_argument("--import", dest="source", metavar="FILE", help="add the packets or samples in FILE to the sample store")
+        parser.add_argument("--backfill", action="store_true", help="send the minute means from --start to --end to the upload sinks")
+        parser.add_argument("--benchmark", action="store_true", help="time decode, import and export of a synthetic multi-year capture")
+        parser.add_argument("--format", choices=FORMATS + ("capture",), help="csv, jsonl or parquet for --export (default: csv); capture, csv or jsonl for --import (default: from the file name)")
+        parser.add_argument("--output", default="-", help="file to export to (default: stdout)")
+        parser.add_argument("--start", help="local date or time in ISO format, or Unix seconds (default: the beginning)")
+        parser.add_argument("--end", help="the same, not included (default: now)")
+        parser.add_argument("--db", default="WeatherStation.db", help="sample store of the pipe 1 station, other pipes add -N to the name (default: %(default)s)")
+        parser.add_argument("--archive", default="Archive", help="per minute archive to export, and to add imported days to; empty to leave it (default: %(default)s)")
+        parser.add_argument("--index", default="Index", help="history index to add imported minutes to; empty to leave it (default: %(default)s)")
+        parser.add_argument("--pipe", type=int, default=1, help="station to export, backfill, or import CSV and JSON lines into (default: %(default)s)")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="decode processes for --import and --benchmark (default: %(default)s, the CPUs)")
+        parser.add_argument("--sinks", default="Sinks.ini", help="upload sink configuration for --backfill (default: %(default)s)")
+        parser.add_argument("--sink", action="append", help="only backfill the sink of this Sinks.ini section, may be repeated")
+        parser.add_argument("--years", type=float, default=2, help="years of synthetic capture for --benchmark")
+        parser.add_argument("--cadence", type=int, default=60, help="seconds between synthetic packets for --benchmark (the station's is 10)")
+        args = parser.parse_args()
+        start = ParseTime(args.start) if args.start else 0
+        end = ParseTime(args.end) if args.end else time.time()
+        if args.export:
+                form = args.format or ("parquet" if args.output.endswith(".parquet") else "jsonl" if args.output.endswith(".jsonl") else "csv")
+                if form not in FORMATS:
+                        parser.error("--export writes csv, jsonl or parquet")
+                if form == "parquet" and args.output == "-":
+                        parser.error("Parquet needs an --output file")
+                started = time.perf_counter()
+                rows = Export(args.export, form, start, end, StationFile(args.db, args.pipe), StationFile(args.archive, args.pipe), args.output)
+                print("Exported %d rows in %.1fs" % (rows, time.perf_counter() - started), file=sys.stderr)
+        elif args.source:
+                form = args.format or ImportFormat(args.source)
+                if form not in IMPORT_FORMATS:
+                        parser.error("--import reads capture, csv or jsonl")
+                started = time.perf_counter()
+                try:
+                        importer = Import(args.source, form, args.db, args.archive, args.index, args.pipe, args.workers, progress=True)
+                except ValueError as error:
+                        parser.error("%s: %s" % (args.source, error))
+                print("Added %d rows in %.1fs, %d already in the store, %d lines did not parse" % (importer.Added, time.perf_counter() - started, importer.Duplicates, importer.Unparsed), file=sys.stderr)
+        elif args.backfill:
+                count, unsent, resume = Backfill(start, end, args.db, args.sinks, args.pipe, args.sink)
+                print("Queued %d minutes" % count, file=sys.stderr)
+                for name, minutes in sorted(unsent.items()):
+                        print("%s did not send %d of them" % (name, minutes), file=sys.stderr)
+                if resume is not None:
+                        print("Stopped, run again with --start %s for the rest" % datetime.datetime.fromtimestamp(resume).isoformat(timespec='seconds'), file=sys.stderr)
+                if unsent or resume is not None:
+                        sys.exit(1)
+        elif args.benchmark:
+                sys.exit(Benchmark(args.years, args.cadence, args.workers))
+        else:
+                parser.print_help()
@@ -0,0 +1,460 @@
+#!/usr/bin/python3
+
+# Multi-resolution index of a station's history, for charts over any time range
+#
+# A chart is a few hundred pixels wide, so a week, a month or ten years of readings only ever
+# needs a few hundred points. The index keeps the history as a pyramid of levels, each one a
+# flat file of fixed size records, one per bucket:
+#       raw    - the weather packets in the sample store, kept for a month
+#       minute - every minute the aggregator closes
+#       10min, hour, day - rolled up from the level below, day buckets from local midnight
+# A record is the bucket's start and, for each of INDEX_FIELDS, the count, min, max and mean
+# (RECORD, 106 bytes, so about 60 MB a year with the levels above). The station adds each minute as the aggregator closes it, which is one
+# append, and a bucket of the level above is written when the next one starts. Nothing is done
+# per packet. The open buckets are kept in memory and worked out again from the level below
+# at start up, and the minutes closed while the station was down come from the sample store.
+#
+# Range() reads a time range from the finest level that has no more than OVERSAMPLE buckets
+# per point, found by a binary search on the record times. So whatever the range, it reads at
+# most a few thousand records, about what one screen needs. Series() then picks the points
+# with LTTB (Largest Triangle Three Buckets, Steinarsson 2013), which keeps the peaks and
+# troughs that plain decimation drops. Downsample() does the same for whole records and widens
+# each record's min/max over the buckets it stands for, so no extreme is lost. The display's
+# history chart and the web API's /api/series both read through these.
+#
+# Adding minutes needs nothing but struct. NumPy is only used by Load() and the benchmark.
+#
+#       python3 HistoryIndex.py --build --db WeatherStation.db --archive Archive --index Index
+#       python3 HistoryIndex.py --benchmark --years 10
+
+import threading
+import datetime
+import bisect
+import struct
+import math
+import time
+import os
+import sys
+import argparse
+
+INDEX_FIELDS = ("temp_out", "humid_out", "pressure", "wind_speed", "wind_gust", "rain_hour", "temp_in")
+LEVELS = (("minute", 60), ("10min", 600), ("hour", 3600), ("day", 86400))
+RAW_PERIOD = 10								# Seconds between weather packets, the raw level's resolution
+RECORD = struct.Struct("<d" + "Hfff" * len(INDEX_FIELDS))		# Bucket start, then count, min, max, mean of each field
+FIELD_RECORDS = dict((name, struct.Struct("<d%dxHfff%dx" % (14 * index, 14 * (len(INDEX_FIELDS) - index - 1)))) for index, name in enumerate(INDEX_FIELDS))
+OVERSAMPLE = 4								# Most buckets read per point asked for
+POINTS = 400								# Points when none are asked for, the width of the display's history chart
+MAX_COUNT = 0xFFFF							# Counts are 16 bit, a day of 10 s packets is 8640
+NAN = float('nan')
+
+
+# Function to get the (start, end) of the bucket of period seconds that when is in, a day from local midnight
+def BucketBounds(period, when):
+        if period < 86400:
+                start = when // period * period
+                return start, start + period
+        day = datetime.date.fromtimestamp(when)
+        return datetime.datetime.combine(day, datetime.time()).timestamp(), datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()).timestamp()
+
+
+# Function to make a record from a bucket start and (count, min, max, mean) of each field, NaN where count is 0
+def MakeRecord(start, fields):
+        record = [start]
+        for count, low, high, mean in fields:
+                if count:
+                        record += (min(count, MAX_COUNT), low, high, mean)
+                else:
+                        record += (0, NAN, NAN, NAN)
+        return tuple(record)
+
+
+# Function to make the record of a minute the aggregator closed, None if it had no weather packet
+def MinuteRecord(bucket):
+        fields = []
+        for name in INDEX_FIELDS:
+                stats = bucket.Stats.get(name)
+                fields.append((stats.Count, stats.Min, stats.Max, stats.Mean) if stats is not None and stats.Count else (0, None, None, None))
+        if not any(field[0] for field in fields):
+                return None
+        return MakeRecord(bucket.Key * 60, fields)
+
+
+# Bucket of a level that has not ended yet: a running count, min, max and total of each field
+class OpenBucket():
+        __slots__ = ("Period", "Start", "End", "Sums")
+
+        def __init__(self, period):
+                self.Period = period
+                self.Start = None
+                self.End = None
+                self.Sums = None
+
+# Function to fold in a record of a finer level, returns the record of the bucket this closed or None
+        def Add(self, record):
+                closed = None
+                if self.Start is not None and record[0] >= self.End:
+                        closed = self.Record()
+                        self.Start = None
+                if self.Start is None:
+                        self.Start, self.End = BucketBounds(self.Period, record[0])
+                        self.Sums = [[0, math.inf, -math.inf, 0.0] for name in INDEX_FIELDS]
+                for index, sums in enumerate(self.Sums):
+                        count = record[1 + 4 * index]
+                        if count:
+                                sums[0] += count
+                                sums[1] = min(sums[1], record[2 + 4 * index])
+                                sums[2] = max(sums[2], record[3 + 4 * index])
+                                sums[3] += record[4 + 4 * index] * count
+                return closed
+
+        def Record(self):
+                if self.Start is None:
+                        return None
+                return MakeRecord(self.Start, [(count, low, high, total / count if count else NAN) for count, low, high, total in self.Sums])
+
+
+# One level of the pyramid: its file of records in time order and its open bucket. Indexing it
+# gives the start time of a record, so bisect searches the file without reading it
+class IndexLevel():
+
+        def __init__(self, path, name, period):
+                self.Name = name
+                self.Period = period
+                self.Path = path
+                self.File = open(path, 'a+b', buffering=0)			# Appends always go to the end, reads seek
+                size = os.path.getsize(path)
+                if size % RECORD.size:
+                        self.File.truncate(size - size % RECORD.size)	# Drop a record an append was cut short in
+                self.Count = size // RECORD.size
+                self.Open = OpenBucket(period)
+
+        def __len__(self):
+                return self.Count
+
+        def __getitem__(self, index):
+                if not 0 <= index < self.Count:
+                        raise IndexError(index)
+                self.File.seek(index * RECORD.size)
+                return struct.unpack("<d", self.File.read(8))[0]
+
+        def Write(self, record):
+                self.File.write(RECORD.pack(*record))
+                self.Count += 1
+
+# Function to read records first to last, whole or only (start, count, min, max, mean) of one field
+        def Read(self, first, last, field=None):
+                if last <= first:
+                        return []
+                self.File.seek(first * RECORD.size)
+                data = self.File.read((last - first) * RECORD.size)
+                return list((FIELD_RECORDS[field] if field else RECORD).iter_unpack(data))
+
+        def Close(self):
+                self.File.close()
+
+
+class HistoryIndex():
+
+        def __init__(self, path="Index"):
+                self.Path = path
+                os.makedirs(path, exist_ok=True)
+                self.Lock = threading.Lock()					# Minutes come from the receive loop, ranges are read by the web API too
+                self.Levels = [IndexLevel(os.path.join(path, name + ".bin"), name, period) for name, period in LEVELS]
+                self.Last = None						# Start of the last minute indexed
+                self.Reopen()
+
+# Function to fold each level's records since the last bucket closed above it back into the open bucket, after a restart
+        def Reopen(self):
+                minutes = self.Levels[0]
+                self.Last = minutes[len(minutes) - 1] if len(minutes) else None
+                for lower, level in zip(self.Levels, self.Levels[1:]):
+                        level.Open = OpenBucket(level.Period)
+                        since = BucketBounds(level.Period, level[len(level) - 1])[1] if len(level) else 0
+                        for record in lower.Read(bisect.bisect_left(lower, since), len(lower)):
+                                closed = level.Open.Add(record)
+                                if closed is not None:				# Only if a level above was lost, written now
+                                        level.Write(closed)
+
+# Function to add a minute's record and roll it up the levels. A minute already indexed is ignored
+        def AddMinute(self, record):
+                with self.Lock:
+                        if self.Last is not None and record[0] <= self.Last:
+                                return False
+                        self.Levels[0].Write(record)
+                        self.Last = record[0]
+                        for level in self.Levels[1:]:
+                                record = level.Open.Add(record)
+                                if record is None:
+                                        break
+                                level.Write(record)
+                        return True
+
+# Function to index the minutes in a sample store after the last one indexed and before until, for the
+# minutes that closed while the station was down or while a restore replayed the store. Returns how many
+        def Catchup(self, store, until):
+                since = 0 if self.Last is None else self.Last + 60
+                aggregates = ", ".join("COUNT(%s), MIN(%s), MAX(%s), AVG(%s)" % ((name,) * 4) for name in INDEX_FIELDS)
+                rows = store.Db.execute("SELECT CAST(time / 60 AS INTEGER) * 60 AS minute, %s FROM samples WHERE kind IN ('T', 't') AND time >= ? AND time < ? "
+                                        "GROUP BY minute ORDER BY minute" % aggregates, (since, until)).fetchall()
+                count = 0
+                for row in rows:
+                        count += self.AddMinute(MakeRecord(row[0], [row[index:index + 4] for index in range(1, len(row), 4)]))
+                return count
+
+# Function to get (level name, records) of one field from start to end, each record (start, count, min,
+# max, mean), from the finest level with at most OVERSAMPLE buckets per point. raw(field, start, end)
+# gives the packets' (time, value), for ranges short enough to read them instead
+        def Range(self, field, start, end, points=POINTS, raw=None):
+                if field not in INDEX_FIELDS:
+                        raise KeyError(field)
+                index = INDEX_FIELDS.index(field)
+                span = end - start
+                if raw is not None and span <= RAW_PERIOD * points * OVERSAMPLE:
+                        return "raw", [(when, 1, value, value, value) for when, value in raw(field, start, end) if value is not None]
+                level = next((level for level in self.Levels if span <= level.Period * points * OVERSAMPLE), self.Levels[-1])
+                position = self.Levels.index(level)
+                with self.Lock:
+                        records = level.Read(bisect.bisect_left(level, BucketBounds(level.Period, start)[0]), bisect.bisect_left(level, end), field)
+                        tail = OpenBucket(level.Period)			# The level's open bucket with the ones below it folded in
+                        for lower in self.Levels[position:0:-1]:
+                                record = lower.Open.Record()
+                                if record is not None:
+                                        closed = tail.Add(record)
+                                        if closed is not None:
+                                                records.append(closed[:1] + closed[1 + 4 * index:5 + 4 * index])
+                        record = tail.Record()
+                if record is not None:
+                        records.append(record[:1] + record[1 + 4 * index:5 + 4 * index])
+                return level.Name, [record for record in records if record[1] and record[0] < end and record[0] + level.Period > start]
+
+# Function to get (level name, times, means) of one field from start to end, at most points of them picked by LTTB
+        def Series(self, field, start, end, points=POINTS, raw=None):
+                name, records = self.Range(field, start, end, points, raw)
+                times = [record[0] for record in records]
+                means = [record[4] for record in records]
+                keep = Lttb(times, means, points)
+                return name, [times[index] for index in keep], [means[index] for index in keep]
+
+# Function to bulk load per minute means, a dict of arrays as ColumnArchive.Columns() gives, into an empty index
+        def Load(self, columns):
+                import numpy as np
+                if self.Last is not None:
+                        raise ValueError("%s already holds minutes, only an empty index can be loaded" % self.Path)
+                dtype = RecordDtype()
+                records = np.zeros(len(columns["time"]), dtype)
+                records["time"] = columns["time"]
+                for name in INDEX_FIELDS:
+                        values = np.asarray(columns[name], np.float32)
+                        field = records[name]
+                        field["count"] = ~np.isnan(values)
+                        field["min"] = values
+                        field["max"] = values
+                        field["mean"] = values
+                with self.Lock:
+                        for position, level in enumerate(self.Levels):
+                                if position:
+                                        records = Rollup(records, level.Period)[:-1]	# The last bucket stays open
+                                level.File.write(records.tobytes())
+                                level.Count += len(records)
+                        self.Reopen()
+                return len(columns["time"])
+
+        def Close(self):
+                for level in self.Levels:
+                        level.Close()
+
+
+# Function to get the edges of the buckets LTTB picks one point from: the first point, count - 2
+# points shared out over points - 2 buckets, and the last point
+def LttbBuckets(count, points):
+        edges = [0] + [bucket * (count - 2) // (points - 2) + 1 for bucket in range(points - 1)] + [count]
+        return list(zip(edges, edges[1:]))
+
+
+# Function to pick at most points of a series with Largest Triangle Three Buckets: from each bucket
+# the point making the largest triangle with the point picked before it and the mean of the next
+# bucket. Returns the indices picked, all of them if there are no more than points
+def Lttb(xs, ys, points):
+        count = len(xs)
+        if count <= points or points < 3:
+                return list(range(count))
+        buckets = LttbBuckets(count, points)
+        keep = [0]
+        ax = xs[0]
+        ay = ys[0]
+        for (first, last), (nextfirst, nextlast) in zip(buckets[1:-1], buckets[2:]):
+                cx = sum(xs[nextfirst:nextlast]) / (nextlast - nextfirst) - ax
+                cy = sum(ys[nextfirst:nextlast]) / (nextlast - nextfirst) - ay
+                best = first
+                largest = -1.0
+                for index in range(first, last):
+                        area = abs(cx * (ys[index] - ay) - (xs[index] - ax) * cy)	# Twice the triangle, which picks the same point
+                        if area > largest:
+                                largest = area
+                                best = index
+                keep.append(best)
+                ax = xs[best]
+                ay = ys[best]
+        keep.append(count - 1)
+        return keep
+
+
+# Function to cut records (start, count, min, max, mean) to at most points: LTTB picks the records by
+# their means, and each one's count, min and max are widened over the bucket it was picked from
+def Downsample(records, points):
+        if len(records) <= points or points < 3:
+                return records
+        keep = Lttb([record[0] for record in records], [record[4] for record in records], points)
+        result = []
+        for index, (first, last) in zip(keep, LttbBuckets(len(records), points)):
+                bucket = records[first:last]
+                result.append((records[index][0], sum(record[1] for record in bucket), min(record[2] for record in bucket), max(record[3] for record in bucket), records[index][4]))
+        return result
+
+
+#------------------------------------------------------------------------------------
+# Bulk rollups with NumPy, for Load() and the benchmark
+#------------------------------------------------------------------------------------
+
+# NumPy dtype of RECORD, so a level file can be read as one array
+def RecordDtype():
+        import numpy as np
+        return np.dtype([("time", "<f8")] + [(name, [("count", "<u2"), ("min", "<f4"), ("max", "<f4"), ("mean", "<f4")]) for name in INDEX_FIELDS])
+
+
+# Function to roll records up into buckets of period seconds, as OpenBucket does one at a time
+def Rollup(records, period):
+        import numpy as np
+        from Analytics import LocalMidnights
+        times = records["time"]
+        if len(times) == 0:
+                return records[:0]
+        if period < 86400:
+                keys = times // period * period
+        else:
+                midnights = LocalMidnights(times[0], times[-1])
+                keys = midnights[np.searchsorted(midnights, times, side='right') - 1]
+        starts = np.r_[0, np.nonzero(np.diff(keys))[0] + 1]
+        rolled = np.zeros(len(starts), records.dtype)
+        rolled["time"] = keys[starts]
+        for name in INDEX_FIELDS:
+                field = records[name]
+                count = field["count"].astype(np.int64)
+                counts = np.add.reduceat(count, starts)
+                total = np.add.reduceat(np.where(count > 0, field["mean"].astype(np.float64) * count, 0), starts)
+                out = rolled[name]
+                out["count"] = np.minimum(counts, MAX_COUNT)
+                out["min"] = np.fmin.reduceat(field["min"], starts)
+                out["max"] = np.fmax.reduceat(field["max"], starts)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                        out["mean"] = np.where(counts > 0, total / counts, np.nan)
+        return rolled
+
+
+#------------------------------------------------------------------------------------
+# Benchmark over years of synthetic per minute data
+#------------------------------------------------------------------------------------
+
+def Benchmark(years, points):
+        import tempfile
+        import numpy as np
+        from Analytics import SyntheticColumns
+        from Chart import NewFigure
+        os.environ["TZ"] = "Europe/London"
+        time.tzset()
+        failures = 0
+        workdir = tempfile.mkdtemp()
+        start = datetime.datetime(2015, 1, 1).timestamp()
+        minutes = int(years * 365.25 * 1440)
+        columns = SyntheticColumns(start, minutes)
+        index = HistoryIndex(os.path.join(workdir, "Index"))
+        started = time.perf_counter()
+        index.Load(columns)
+        size = sum(os.path.getsize(level.Path) for level in index.Levels)
+        print("Loaded %.0f years, %d minutes in %.1fs, %.0f MB (%s records)" % (years, minutes, time.perf_counter() - started, size / 1e6, ", ".join("%s %d" % (level.Name, len(level)) for level in index.Levels)))
+
+        # Minutes added one at a time, as the station does, must give the same levels as the bulk load
+        days = 40
+        check = HistoryIndex(os.path.join(workdir, "Check"))
+        bulk = dict((name, values[:days * 1440]) for name, values in columns.items())
+        loaded = HistoryIndex(os.path.join(workdir, "Bulk"))
+        loaded.Load(bulk)
+        rows = np.zeros(days * 1440, RecordDtype())
+        rows["time"] = bulk["time"]
+        for name in INDEX_FIELDS:
+                values = bulk[name]
+                rows[name]["count"] = ~np.isnan(values)
+                rows[name]["min"] = rows[name]["max"] = rows[name]["mean"] = values
+        started = time.perf_counter()
+        for record in rows.tolist():
+                check.AddMinute(MakeRecord(record[0], record[1:]))
+        added = time.perf_counter() - started
+        same = True
+        for position in range(len(LEVELS)):
+                one, other = (np.fromfile(index.Levels[position].Path, RecordDtype()) for index in (check, loaded))
+                same = same and len(one) == len(other) and all(np.allclose(one[name][part], other[name][part], rtol=1e-6, equal_nan=True) for name in INDEX_FIELDS for part in ("count", "min", "max", "mean"))
+        same = same and all(np.allclose(one.Open.Record(), other.Open.Record(), rtol=1e-6, equal_nan=True) for one, other in zip(check.Levels[1:], loaded.Levels[1:]))
+        print("Added %d minutes one at a time in %.2fs, %.1f us a minute, same levels as the bulk load  %s" % (days * 1440, added, added / (days * 1440) * 1e6, "OK" if same else "FAIL"))
+        failures += not same
+
+        # Any range comes back at about the chart's width, in about the same time
+        end = columns["time"][-1] + 60
+        print("%-10s %-7s %8s %8s %9s %9s" % ("range", "level", "records", "points", "Range ms", "Series ms"))
+        for name, span in (("1 hour", 3600), ("6 hours", 6 * 3600), ("1 day", 86400), ("1 week", 7 * 86400), ("1 month", 30 * 86400), ("1 year", 365 * 86400), ("all", end - start)):
+                timings = []
+                for repeat in range(20):
+                        started = time.perf_counter()
+                        level, records = index.Range("temp_out", end - span, end, points)
+                        middle = time.perf_counter()
+                        level, times, means = index.Series("temp_out", end - span, end, points)
+                        timings.append((middle - started, time.perf_counter() - middle))
+                ranged = sorted(timing[0] for timing in timings)[len(timings) // 2]
+                series = sorted(timing[1] for timing in timings)[len(timings) // 2]
+                ok = 0 < len(times) <= points and len(records) <= points * OVERSAMPLE or name == "all"
+                failures += not ok
+                print("%-10s %-7s %8d %8d %9.2f %9.2f  %s" % (name, level, len(records), len(times), ranged * 1000, series * 1000, "OK" if ok else "FAIL"))
+
+        # What drawing a year on the display's chart costs from the minutes and from the index
+        canvas, axes = NewFigure()
+        year = columns["time"] >= end - 365 * 86400
+        for name, x, y in (("a year of minutes", columns["time"][year], columns["temp_out"][year]), ("a year from the index", times, means)):
+                line, = axes.plot(x, y, color='w')
+                axes.set_xlim(end - 365 * 86400, end)
+                axes.set_ylim(-15, 40)
+                started = time.perf_counter()
+                canvas.draw()
+                print("Draw %-22s %8d points %9.1f ms" % (name, len(x), (time.perf_counter() - started) * 1000))
+                line.remove()
+        return 1 if failures else 0
+
+
+# Function to build an index from a per minute archive and the minutes in a sample store after it
+def Build(indexpath, archivepath, dbpath):
+        from SampleStore import SampleStore
+        index = HistoryIndex(indexpath)
+        if index.Last is not None:
+                print("%s already holds minutes up to %s, catching up from the store only" % (indexpath, datetime.datetime.fromtimestamp(index.Last)))
+        elif archivepath and os.path.isdir(archivepath):
+                from Analytics import ColumnArchive
+                print("Loaded %d minutes from %s" % (index.Load(ColumnArchive(archivepath).Columns()), archivepath))
+        if dbpath:
+                print("Added %d minutes from %s" % (index.Catchup(SampleStore(dbpath), time.time() // 60 * 60), dbpath))
+        print(", ".join("%s %d" % (level.Name, len(level)) for level in index.Levels))
+        return 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station multi-resolution history index")
+        parser.add_argument("--build", action="store_true", help="build --index from --archive, then add the minutes in --db after it")
+        parser.add_argument("--index", default="Index", help="history index directory (default: %(default)s)")
+        parser.add_argument("--archive", default="Archive", help="per minute column archive to load an empty index from (default: %(default)s)")
+        parser.add_argument("--db", default="WeatherStation.db", help="sample store to add the minutes since from (default: %(default)s)")
+        parser.add_argument("--benchmark", action="store_true", help="time loading and reading an index of synthetic per minute data")
+        parser.add_argument("--years", type=float, default=10, help="years of synthetic data for --benchmark")
+        parser.add_argument("--points", type=int, default=POINTS, help="points per range for --benchmark")
+        args = parser.parse_args()
+        if args.build:
+                sys.exit(Build(args.index, args.archive, args.db))
+        if args.benchmark:
+                sys.exit(Benchmark(args.years, args.points))
+        parser.print_help()
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+# Link quality of a transmitter, estimated from when its packets arrive
+#
+# The Arduino sends a weather packet every 10 s (and a status packet just behind it), so the
+# gap between two weather packets is a whole number of send cycles and every cycle over one
+# is a lost packet. LinkEstimator learns the actual cadence from the one-cycle gaps, since
+# the Arduino's clock is only ever corrected by the ACK time, and marks each expected cycle
+# received or lost in a ring covering the last hour. Running counts for a five minute and a
+# one hour window are kept as cycles go in and out, so a packet costs a few additions however
+# long the windows are, and a link that has gone quiet counts the cycles it is overdue as lost
+# when asked, with no per-loop work at all.
+#
+# Protocol v2 frames carry a sequence number that goes up by one each send cycle, so for those
+# the gap is counted exactly, whatever the cadence, unless the sketch has restarted since.
+#
+# Where the radio has testRPD() (the nRF24L01+ Received Power Detector, set when the last
+# packet came in above -64 dBm) the share of strong packets is averaged too. At 250 kbps
+# packets still get through 30 dB below that, so a weak RPD only takes off the top bars.
+#
+# Level() grades the link for the display's signal icon:
+#       5  at most 2% lost over five minutes       2  at most 50% lost
+#       4  at most 10% lost, or RPD mostly weak    1  anything received
+#       3  at most 25% lost, or RPD hardly ever    0  nothing for five minutes
+#
+# Run this file directly to time it:
+#       python3 LinkQuality.py --benchmark
+
+import time
+import sys
+import argparse
+
+CADENCE = 10.0								# Seconds between weather packets, MAIN_LOOP_TIME in WeatherStation.ino
+SHORT_WINDOW = 30							# Send cycles in the display's window, five minutes
+LONG_WINDOW = 360							# One hour
+LEVELS = ((0.02, 5), (0.10, 4), (0.25, 3), (0.50, 2))			# (most lost, bars), anything better than all lost is 1
+
+
+class LinkEstimator():
+        __slots__ = ("Cadence", "Slots", "Next", "Filled", "ShortWindow", "ShortLost", "LongLost", "Last", "Sequence", "Received", "Lost", "Rpd")
+
+        def __init__(self, cadence=CADENCE, shortwindow=SHORT_WINDOW, longwindow=LONG_WINDOW):
+                self.Cadence = cadence
+                self.Slots = bytearray(longwindow)				# 1 = lost, one per send cycle, oldest overwritten
+                self.Next = 0
+                self.Filled = 0
+                self.ShortWindow = shortwindow
+                self.ShortLost = 0
+                self.LongLost = 0
+                self.Last = None						# When the last weather packet came
+                self.Sequence = None						# And its sequence number, None before v2
+                self.Received = 0
+                self.Lost = 0
+                self.Rpd = None							# Running share of packets with RPD set, None without testRPD()
+
+# Function to add one send cycle to the windows
+        def Push(self, lost):
+                slots = self.Slots
+                if self.Filled >= self.ShortWindow:
+                        self.ShortLost -= slots[self.Next - self.ShortWindow]	# Negative index wraps round the ring
+                if self.Filled == len(slots):
+                        self.LongLost -= slots[self.Next]
+                else:
+                        self.Filled += 1
+                slots[self.Next] = lost
+                self.ShortLost += lost
+                self.LongLost += lost
+                self.Next += 1
+                if self.Next == len(slots):
+                        self.Next = 0
+
+# Function for every weather packet, returns how many packets were lost just before it
+        def Packet(self, when, rpd=None, sequence=None):
+                lost = 0
+                if self.Last is not None:
+                        cycles = (when - self.Last) / self.Cadence
+                        gap = None
+                        if sequence is not None and self.Sequence is not None:
+                                gap = (sequence - self.Sequence) & 0xFFFF
+                                if gap > cycles + 1.5:
+                                        gap = None					# The sketch restarted, go by the time
+                        if gap is None:
+                                if cycles < 0.5:
+                                        return 0					# Same cycle, a retransmission the ACK missed
+                                gap = int(cycles + 0.5)
+                        elif gap == 0:
+                                return 0
+                        lost = gap - 1
+                        if lost == 0 and cycles < 1.5:
+                                self.Cadence += (when - self.Last - self.Cadence) / 64
+                        for cycle in range(min(lost, len(self.Slots))):
+                                self.Push(1)
+                self.Push(0)
+                self.Last = when
+                self.Sequence = sequence
+                self.Received += 1
+                self.Lost += lost
+                if rpd is not None:
+                        self.Rpd = float(rpd) if self.Rpd is None else self.Rpd + (rpd - self.Rpd) / 16
+                return lost
+
+# Function to get the cycles since the last packet that should have brought another
+        def Overdue(self, now):
+                if self.Last is None:
+                        return 0
+                return max(int((now - self.Last) / self.Cadence - 0.5), 0)
+
+# Function to get the share of packets lost over the display's window, counting the overdue as lost
+        def Loss(self, now):
+                overdue = self.Overdue(now)
+                window = self.ShortWindow
+                if overdue >= window:
+                        return 1.0
+                cycles = min(self.Filled, window)
+                if cycles + overdue == 0:
+                        return 0.0
+                if cycles + overdue > window:					# The overdue push the oldest out
+                        return (overdue + self.ShortLost * (window - overdue) / cycles) / window
+                return (overdue + self.ShortLost) / (cycles + overdue)
+
+# Function to get the share of packets lost over the last hour of cycles heard
+        def LongLoss(self):
+                return self.LongLost / self.Filled if self.Filled else 0.0
+
+# Function to get the estimator as plain values for a checkpoint, and back
+        def State(self):
+                return [list(self.Slots) if name == "Slots" else getattr(self, name) for name in self.__slots__]
+
+        def Restore(self, state):
+                for name, value in zip(self.__slots__, state):
+                        setattr(self, name, bytearray(value) if name == "Slots" else value)
+
+# Function to grade the link 0-5, cheap enough for every pass of the receive loop
+        def Level(self, now):
+                if self.Last is None:
+                        return 0
+                loss = self.Loss(now)
+                if loss >= 1.0:
+                        return 0
+                level = 1
+                for most, bars in LEVELS:
+                        if loss <= most:
+                                level = bars
+                                break
+                if self.Rpd is not None:
+                        if self.Rpd < 0.1:
+                                return min(level, 3)
+                        if self.Rpd < 0.5:
+                                return min(level, 4)
+                return level
+
+
+#------------------------------------------------------------------------------------
+# Benchmark: cost per packet and per loop pass
+#------------------------------------------------------------------------------------
+
+def Benchmark(count):
+        import random
+        rng = random.Random(1)
+        link = LinkEstimator()
+        arrivals = []
+        cycle = 0
+        while len(arrivals) < count:						# Every tenth send lost, 70% above the RPD threshold
+                cycle += 1
+                if rng.random() >= 0.1:
+                        arrivals.append((cycle * CADENCE * 1.001 + rng.uniform(0, 0.25), rng.random() < 0.7))
+        started = time.perf_counter()
+        for when, rpd in arrivals:
+                link.Packet(when, rpd)
+        packet = (time.perf_counter() - started) / count
+        started = time.perf_counter()
+        for index in range(count):
+                link.Level(when + index * 0.01)
+        level = (time.perf_counter() - started) / count
+        print("Packet() %.2f us, Level() %.2f us" % (packet * 1e6, level * 1e6))
+        print("%d packets, %d lost of %d dropped (%.1f%%), last hour %.1f%%, cadence %.3fs, RPD %.2f, level %d" % (link.Received, link.Lost, cycle - count, 100 * link.Lost / (link.Received + link.Lost),
+                                                                                                           100 * link.LongLoss(), link.Cadence, link.Rpd, link.Level(when)))
+        return 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station link quality estimator")
+        parser.add_argument("--benchmark", action="store_true", help="time the estimator over packets with one in ten lost")
+        parser.add_argument("--packets", type=int, default=100000)
+        args = parser.parse_args()
+        if not args.benchmark:
+                parser.print_help()
+                sys.exit(0)
+        sys.exit(Benchmark(args.packets))
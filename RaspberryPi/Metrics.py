@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+
+# Latency histograms and counters for the Weather Station receive loop
+#
+# Timing hooks are written into the hot path as a perf_counter() pair and one Observe() on a
+# Histogram fetched once at start up, so a hook costs well under a microsecond and never
+# allocates. Each histogram is written by one thread only. Counters that the station already
+# keeps (packets per station, ACK writes, upload queue) are not duplicated: Collect() registers
+# a function that is read when the metrics are scraped.
+#
+# Everything is exposed in the Prometheus text format by MetricsServer:
+#       curl http://raspberrypi:9108/metrics
+# and MetricsLog writes a JSON line per interval to a rotating log file, with the counters and
+# the count, mean and p50/p95/p99 of each histogram over that interval.
+#
+# Run this file directly to measure the overhead of a timing hook against a replayed day:
+#       python3 Metrics.py --benchmark
+
+import bisect
+import threading
+import json
+import time
+import os
+import sys
+import argparse
+
+# Bucket upper bounds in seconds: from a fast parse to a ThingSpeak request timing out
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter():
+        __slots__ = ("Value",)
+
+        def __init__(self):
+                self.Value = 0
+
+        def Inc(self, amount=1):
+                self.Value += amount
+
+
+class Histogram():
+        __slots__ = ("Bounds", "Counts", "Sum")
+
+        def __init__(self, bounds):
+                self.Bounds = bounds
+                self.Counts = [0] * (len(bounds) + 1)			# Last one is +Inf
+                self.Sum = 0.0
+
+        def Observe(self, seconds):
+                self.Counts[bisect.bisect_left(self.Bounds, seconds)] += 1
+                self.Sum += seconds
+
+# Function to copy (counts, sum) for a reader on another thread
+        def Read(self):
+                return list(self.Counts), self.Sum
+
+
+# Function to estimate a quantile from bucket counts, as the upper bound of the bucket it falls in
+def Quantile(bounds, counts, q):
+        total = sum(counts)
+        if total == 0:
+                return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(bounds, counts):
+                seen += count
+                if seen >= rank:
+                        return bound
+        return float("inf")
+
+
+def LabelText(labels):
+        if not labels:
+                return ""
+        return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+
+class Metrics():
+
+        def __init__(self, prefix="weatherstation_"):
+                self.Prefix = prefix
+                self.Families = {}						# name -> [kind, help, {labels: Counter, Histogram or function}]
+                self.Lock = threading.Lock()				# Only for registering, never taken by a hook
+
+        def Register(self, name, kind, help, labels, make):
+                name = self.Prefix + name
+                key = tuple(sorted(labels.items()))
+                with self.Lock:
+                        family = self.Families.setdefault(name, [kind, help, {}])
+                        if family[0] != kind:
+                                raise ValueError("%s is already a %s" % (name, family[0]))
+                        if key not in family[2]:
+                                family[2][key] = make()
+                        return family[2][key]
+
+        def Counter(self, name, help, **labels):
+                return self.Register(name, "counter", help, labels, Counter)
+
+        def Histogram(self, name, help, bounds=LATENCY_BUCKETS, **labels):
+                return self.Register(name, "histogram", help, labels, lambda: Histogram(bounds))
+
+# Function to register a counter or gauge whose value is read from function() when scraped
+        def Collect(self, name, kind, help, function, **labels):
+                name = self.Prefix + name
+                key = tuple(sorted(labels.items()))
+                with self.Lock:
+                        self.Families.setdefault(name, [kind, help, {}])[2][key] = function
+
+        def Items(self):
+                with self.Lock:
+                        return [(name, kind, help, list(metrics.items())) for name, (kind, help, metrics) in sorted(self.Families.items())]
+
+        def Value(self, metric):
+                if isinstance(metric, Counter):
+                        return metric.Value
+                return metric()
+
+# Function to render every metric in the Prometheus text exposition format
+        def Exposition(self):
+                lines = []
+                for name, kind, help, metrics in self.Items():
+                        lines.append("# HELP %s %s" % (name, help))
+                        lines.append("# TYPE %s %s" % (name, kind))
+                        for labels, metric in metrics:
+                                if kind != "histogram":
+                                        value = self.Value(metric)
+                                        lines.append("%s%s %s" % (name, LabelText(labels), "NaN" if value is None else value))
+                                        continue
+                                counts, total = metric.Read()
+                                cumulative = 0
+                                for bound, count in zip(metric.Bounds + (float("inf"),), counts):
+                                        cumulative += count
+                                        lines.append("%s_bucket%s %d" % (name, LabelText(labels + (("le", "+Inf" if bound == float("inf") else repr(bound)),)), cumulative))
+                                lines.append("%s_sum%s %r" % (name, LabelText(labels), total))
+                                lines.append("%s_count%s %d" % (name, LabelText(labels), cumulative))
+                return ("\n".join(lines) + "\n").encode('utf-8')
+
+# Function to get the counters and each histogram's (counts, sum), keyed by name and labels
+        def Sample(self):
+                counters = {}
+                histograms = {}
+                for name, kind, help, metrics in self.Items():
+                        for labels, metric in metrics:
+                                key = name[len(self.Prefix):] + LabelText(labels)
+                                if kind == "histogram":
+                                        histograms[key] = (metric.Bounds,) + tuple(metric.Read())
+                                else:
+                                        counters[key] = self.Value(metric)
+                return counters, histograms
+
+
+# Serves /metrics for Prometheus from its own thread
+class MetricsServer():
+
+        def __init__(self, meter, port=9108, host=""):
+                import http.server						# Only needed once the station is running
+
+                class Handler(http.server.BaseHTTPRequestHandler):
+                        protocol_version = "HTTP/1.1"
+
+                        def do_GET(self):
+                                if self.path.split("?")[0] != "/metrics":
+                                        body = b"see /metrics\n"
+                                        self.send_response(404)
+                                else:
+                                        body = meter.Exposition()
+                                        self.send_response(200)
+                                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                                self.send_header("Content-Length", str(len(body)))
+                                self.end_headers()
+                                self.wfile.write(body)
+
+                        def log_message(self, *args):
+                                pass
+
+                self.Server = http.server.ThreadingHTTPServer((host, port), Handler)
+                self.Server.daemon_threads = True
+                self.Thread = None
+
+        def Start(self):
+                self.Thread = threading.Thread(target=self.Server.serve_forever, name="MetricsServer", daemon=True)
+                self.Thread.start()
+
+        def Stop(self):
+                self.Server.shutdown()
+                self.Server.server_close()
+
+
+# Writes one JSON line per interval to a size-rotated log: the counters, and each histogram's
+# count, mean and quantiles over the interval, in milliseconds
+class MetricsLog():
+
+        def __init__(self, meter, path="Metrics.log", interval=60, maxbytes=1000000, backups=5):
+                import logging.handlers
+                self.Meter = meter
+                self.Interval = interval
+                self.Logger = logging.getLogger("WeatherStation.Metrics")
+                self.Logger.propagate = False
+                self.Logger.setLevel(logging.INFO)
+                handler = logging.handlers.RotatingFileHandler(path, maxBytes=maxbytes, backupCount=backups)
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                self.Logger.addHandler(handler)
+                self.Handler = handler
+                self.Previous = {}
+                self.Stopping = threading.Event()
+                self.Thread = None
+
+        def Start(self):
+                self.Previous = self.Meter.Sample()[1]
+                self.Thread = threading.Thread(target=self.Run, name="MetricsLog", daemon=True)
+                self.Thread.start()
+
+        def Stop(self):
+                self.Stopping.set()
+                if self.Thread is not None:
+                        self.Thread.join()
+                self.Write()
+                self.Logger.removeHandler(self.Handler)
+                self.Handler.close()
+
+        def Run(self):
+                while not self.Stopping.wait(self.Interval):
+                        self.Write()
+
+        def Write(self):
+                counters, histograms = self.Meter.Sample()
+                latency = {}
+                for key, (bounds, counts, total) in histograms.items():
+                        previouscounts, previoustotal = self.Previous.get(key, (None, [0] * len(counts), 0.0))[1:]
+                        counts = [count - previous for count, previous in zip(counts, previouscounts)]
+                        observed = sum(counts)
+                        if observed == 0:
+                                continue
+                        latency[key] = {"count": observed, "mean_ms": round((total - previoustotal) / observed * 1000, 3)}
+                        for name, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+                                latency[key][name] = Quantile(bounds, counts, q) * 1000
+                self.Previous = histograms
+                self.Logger.info(json.dumps({"time": round(time.time(), 3), "counters": counters, "latency": latency}))
+
+
+# File for sys.stderr that keeps backups instead of being truncated on every start, and rolls
+# over once it reaches maxbytes so a long outage cannot fill the SD card
+class RotatingStream():
+
+        def __init__(self, path, maxbytes=1000000, backups=3):
+                self.Path = path
+                self.MaxBytes = maxbytes
+                self.Backups = backups
+                self.Lock = threading.Lock()
+                self.File = open(path, 'a', buffering=1)
+                if self.File.tell() > 0:
+                        self.Rotate()					# A fresh file per start, the last run's is kept as .1
+
+        def Rotate(self):
+                self.File.close()
+                for index in range(self.Backups - 1, 0, -1):
+                        if os.path.exists("%s.%d" % (self.Path, index)):
+                                os.replace("%s.%d" % (self.Path, index), "%s.%d" % (self.Path, index + 1))
+                os.replace(self.Path, self.Path + ".1")
+                self.File = open(self.Path, 'a', buffering=1)
+
+        def write(self, text):
+                with self.Lock:
+                        written = self.File.write(text)
+                        if self.File.tell() > self.MaxBytes:
+                                self.Rotate()
+                        return written
+
+        def flush(self):
+                with self.Lock:
+                        self.File.flush()
+
+
+#------------------------------------------------------------------------------------
+# Benchmark: cost of a timing hook, against the time the receive path takes per packet
+#------------------------------------------------------------------------------------
+
+def Benchmark(count, hours):
+        import tempfile
+        import datetime
+        from Simulation import Simulator, GenerateCapture
+        meter = Metrics()
+        histogram = meter.Histogram("benchmark_seconds", "Benchmark")
+        perf_counter = time.perf_counter
+        started = perf_counter()
+        for index in range(count):
+                pass
+        empty = perf_counter() - started
+        started = perf_counter()
+        for index in range(count):
+                hook = perf_counter()
+                histogram.Observe(perf_counter() - hook)
+        hook = (perf_counter() - started - empty) / count
+        print("Timing hook (perf_counter pair + Observe): %.3f us" % (hook * 1e6))
+
+        start = datetime.datetime(2021, 6, 1).timestamp()
+        sim = Simulator(start, os.path.join(tempfile.mkdtemp(), "WeatherStation.db"))
+        packets = list(GenerateCapture(start, hours / 24))
+        started = perf_counter()
+        sim.Replay(packets)
+        elapsed = perf_counter() - started
+        station = sim.Station.Meter
+        counters, histograms = station.Sample()
+        hooks = sum(sum(counts) for bounds, counts, total in histograms.values())
+        print("Replayed %d packets in %.2fs: %.1f us/packet, %.1f timing hooks/packet" % (len(packets), elapsed, elapsed / len(packets) * 1e6, hooks / len(packets)))
+        print("Hook overhead %.2f%% of the receive path" % (hooks * hook / elapsed * 100))
+        exposition = station.Exposition()
+        started = perf_counter()
+        for index in range(100):
+                station.Exposition()
+        print("Prometheus exposition: %d bytes in %.2f ms" % (len(exposition), (perf_counter() - started) * 10))
+        for key, value in sorted(counters.items()):
+                print("  %-48s %s" % (key, value))
+        for key, (bounds, counts, total) in sorted(histograms.items()):
+                if sum(counts):
+                        print("  %-48s count %6d  mean %8.3f ms  p95 <= %g ms" % (key, sum(counts), total / sum(counts) * 1000, Quantile(bounds, counts, 0.95) * 1000))
+        return 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station metrics")
+        parser.add_argument("--benchmark", action="store_true", help="time a timing hook and replay packets through the instrumented receive path")
+        parser.add_argument("--count", type=int, default=1000000, help="timing hooks to time")
+        parser.add_argument("--hours", type=float, default=24, help="hours of packets to replay")
+        args = parser.parse_args()
+        if not args.benchmark:
+                parser.print_help()
+                sys.exit(0)
+        sys.exit(Benchmark(args.count, args.hours))
@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+
+# Parser for the 32 byte radio payloads sent by WeatherStation.ino
+#
+#                 t=Night mode                                      Wind (Av)
+#                 T=Day Mode                                        | | Wind (Gust)
+#                 |  Out T   Hum.  Pressure  Rain (Day) Rain (Hr)   | | | | Wind Dir
+#                 | |     |   | |   |     |   |       |   |     |   | | | | |   |
+# Message Format: | 9 9 . 9 H 9 9 P 9 9 9 9 R 9 9 9 . 9 r 9 9 . 9 W 9 9 9 9 9 9 9
+#                 ---------------------------------------------------------------
+#                 0 0 0 0 0 0 0 0 0 0 1 1 1 1 1 1 1 1 1 1 2 2 2 2 2 2 2 2 2 2 3 3
+#                 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0
+#
+# Status Format:  S 9 9 . 9 9 D + 9 9 9 9 (rest of the buffer is left over from the last weather packet)
+#                 |         |   |       |
+#                 Battery V     RTC clock offset in seconds against the ACK time of the last weather
+#                               packet, only sent once the Arduino has had one (older sketches leave
+#                               weather data here, so it only counts after the D)
+#
+# The payload is never decoded to a str: each field is converted straight from a memoryview
+# slice, so a stray non-ASCII byte only invalidates the field it lands in. Every field has a
+# bit in Reading.Valid instead of being silently set to zero. A field only counts if the
+# markers around it are where they should be, so one that has grown (a 5 character negative
+# temperature) cannot shift the fields after it into valid looking values, and only digits,
+# a sign, a point and the leading spaces dtostrf() pads with are taken (int() and float()
+# would also take '_' and trailing whitespace).
+#
+# Protocol v2 is a binary frame of little-endian fixed-point fields, sent by sketches once the
+# Pi's ACK payload has offered it (" V2" after the Unix time, which older sketches' atol() stops
+# at). The first byte is the version, never a printable character, so both kinds of frame can
+# arrive on the same pipe and are told apart packet by packet:
+#
+#   Header:  0 version (2)   1 kind, bit 7 = night   2 station ID   3-4 sequence, +1 per send cycle
+#            (the station ID is the pipe number, and the receiver drops a frame that comes in on another pipe)
+#   Weather: 5-6 temp int16 0.01 C      7-8 humidity 0.01 %     9-10 pressure 0.1 hPa
+#            11-12 rain 0.01 mm         13-14 rain/hour 0.01 mm 15-16 wind 0.01 mph
+#            17-18 gust 0.01 mph        19-20 direction 0.1 deg 21 gust samples n
+#            22.. n gust samples 0.5 mph, oldest first (the peaks through the send cycle)
+#   Status:  5-6 battery mV             7-8 RTC offset int16 seconds
+#   Last two bytes: CRC-16/CCITT-FALSE (binascii.crc_hqx from 0xFFFF) of everything before.
+#
+# Unsigned fields of 0xFFFF and signed ones of -32768 were not measured and are left invalid.
+# A frame that fails its CRC or has the wrong length is KIND_CORRUPT. Further sensors are new
+# kinds, or fields after the gust samples, since the length says what a frame holds.
+#
+# Run this file directly for the microbenchmark (decode time and airtime of both formats) and
+# the fuzz test:
+#       python3 PayloadParser.py --benchmark
+#       python3 PayloadParser.py --fuzz 2000000
+
+from binascii import crc_hqx
+import random
+import struct
+import time
+import sys
+import argparse
+
+KIND_UNKNOWN = 0
+KIND_WEATHER = 1
+KIND_STATUS = 2
+KIND_CORRUPT = 3							# A v2 frame that failed its CRC or length check
+
+PROTOCOL_ASCII = 1
+PROTOCOL_V2 = 2
+
+# Validity bits, one per field
+VALID_TEMP = 0x01
+VALID_HUMID = 0x02
+VALID_PRESS = 0x04
+VALID_RAIN = 0x08
+VALID_RAINH = 0x10
+VALID_WINDSPEED = 0x20
+VALID_WINDGUST = 0x40
+VALID_WINDDIR = 0x80
+VALID_BATT = 0x100
+VALID_CLOCK = 0x200
+VALID_WEATHER = 0xFF
+
+# Name of the field behind each validity bit, in bit order
+FIELD_NAMES = ("temp_out", "humid_out", "pressure", "rain", "rain_hour", "wind_speed", "wind_gust", "wind_dir", "battery", "clock_offset")
+
+# ((marker position, marker) around it, start, end, type, lowest, highest) for each weather field in Valid bit order
+WEATHER_FIELDS = ((((5, ord('H')),), 1, 5, float, -99.9, 999.9),
+                  (((5, ord('H')), (8, ord('P'))), 6, 8, int, 0, 99),
+                  (((8, ord('P')), (13, ord('R'))), 9, 13, int, 0, 9999),
+                  (((13, ord('R')), (19, ord('r'))), 14, 19, float, 0.0, 999.9),
+                  (((19, ord('r')), (24, ord('W'))), 20, 24, float, 0.0, 99.9),
+                  (((24, ord('W')),), 25, 27, int, 0, 99),
+                  (((24, ord('W')),), 27, 29, int, 0, 99),
+                  (((24, ord('W')),), 29, 32, int, 0, 360))
+NUMBER_BYTES = b"0123456789.+-"
+WEATHER_BYTES = NUMBER_BYTES + b" HPRrW"					# Everything a well formed weather packet holds after the flag
+
+V2_HEADER = struct.Struct("<BBBH")
+V2_WEATHER = struct.Struct("<BBBHhHHHHHHHB")				# Header, the eight weather fields and the gust sample count
+V2_STATUS = struct.Struct("<BBBHHh")
+V2_CRC = struct.Struct("<H")
+V2_NIGHT = 0x80
+V2_MAX_GUSTS = 32 - V2_WEATHER.size - V2_CRC.size			# Within the nRF24's 32 byte payload
+UNMEASURED = 0xFFFF
+UNMEASURED_SIGNED = -32768
+GUST_MPH = tuple(sample * 0.5 for sample in range(256))			# Gust sample byte -> mph
+
+
+class Reading():
+        __slots__ = ("Kind", "Night", "Valid", "TempOut", "HumidOut", "Pressure", "Rain", "RainHour", "WindSpeed", "WindGust", "WindDir", "Battery", "ClockOffset",
+                     "Version", "Station", "Sequence", "Gusts")
+
+        def __init__(self, kind=KIND_UNKNOWN, night=False, valid=0, tempout=0.0, humidout=0, pressure=0, rain=0.0, rainhour=0.0, windspeed=0, windgust=0, winddir=0, battery=0.0, clockoffset=0,
+                     version=PROTOCOL_ASCII, station=None, sequence=None, gusts=()):
+                self.Kind = kind
+                self.Night = night
+                self.Valid = valid
+                self.TempOut = tempout
+                self.HumidOut = humidout
+                self.Pressure = pressure
+                self.Rain = rain
+                self.RainHour = rainhour
+                self.WindSpeed = windspeed
+                self.WindGust = windgust
+                self.WindDir = winddir
+                self.Battery = battery
+                self.ClockOffset = clockoffset
+                self.Version = version
+                self.Station = station						# Station ID and frame sequence number, v2 only
+                self.Sequence = sequence
+                self.Gusts = gusts						# Gust samples through the send cycle in mph, v2 only
+
+        def __repr__(self):
+                return "Reading(%s)" % ", ".join("%s=%r" % (name, getattr(self, name)) for name in self.__slots__)
+
+
+# Function to convert one fixed-width field, returns None if it is not a number in range
+def Field(view, start, end, convert, lowest, highest):
+        if len(view) < end:
+                return None
+        text = view[start:end].tobytes().lstrip(b" ")			# dtostrf() pads with leading spaces, nothing else is
+        if text.translate(None, NUMBER_BYTES):
+                return None
+        try:
+                value = convert(text)
+        except ValueError:
+                return None
+        if lowest <= value <= highest:						# Also rejects nan
+                return value
+        return None
+
+
+def ParsePayload(payload):
+        view = memoryview(payload)
+        if len(view) == 0:
+                return Reading()
+        flag = view[0]
+        if flag == PROTOCOL_V2:
+                return ParseV2(view)
+        if flag == 0x54 or flag == 0x74:					# 'T' or 't'
+                text = view[:32].tobytes()
+                if len(text) == 32 and view[5] == 0x48 and view[8] == 0x50 and view[13] == 0x52 and view[19] == 0x72 and view[24] == 0x57 and \
+                   not text[1:].translate(None, WEATHER_BYTES) and view[4] != 0x20 and view[7] != 0x20 and text.find(b" ", 8) < 0:
+                        try:							# Fast path for a well formed packet, spaces only in front of the temperature and humidity
+                                temp = float(view[1:5])
+                                humid = int(view[6:8])
+                                press = int(view[9:13])
+                                rain = float(view[14:19])
+                                rainhour = float(view[20:24])
+                                windspeed = int(view[25:27])
+                                windgust = int(view[27:29])
+                                winddir = int(view[29:32])
+                        except ValueError:
+                                pass
+                        else:
+                                if -99.9 <= temp <= 999.9 and 0 <= humid <= 99 and 0 <= press <= 9999 and 0.0 <= rain <= 999.9 and 0.0 <= rainhour <= 99.9 and 0 <= windspeed <= 99 and 0 <= windgust <= 99 and 0 <= winddir <= 360:
+                                        return Reading(KIND_WEATHER, flag == 0x74, VALID_WEATHER, temp, humid, press, rain, rainhour, windspeed, windgust, winddir)
+                reading = Reading(KIND_WEATHER, flag == 0x74)
+                values = []							# Something is wrong, check field by field
+                bit = 1
+                for markers, start, end, convert, lowest, highest in WEATHER_FIELDS:
+                        if any(len(view) <= position or view[position] != marker for position, marker in markers):
+                                value = None
+                        else:
+                                value = Field(view, start, end, convert, lowest, highest)
+                        if value is None:
+                                values.append(0)
+                        else:
+                                values.append(value)
+                                reading.Valid |= bit
+                        bit <<= 1
+                reading.TempOut, reading.HumidOut, reading.Pressure, reading.Rain, reading.RainHour, reading.WindSpeed, reading.WindGust, reading.WindDir = values
+                return reading
+        if flag == 0x53:							# 'S'
+                reading = Reading(KIND_STATUS)
+                value = Field(view, 1, 6, float, 0.0, 99.99)
+                if value is not None:
+                        reading.Valid = VALID_BATT
+                        reading.Battery = value
+                if len(view) >= 12 and view[6] == 0x44:				# 'D'
+                        value = Field(view, 7, 12, int, -9999, 9999)
+                        if value is not None:
+                                reading.Valid |= VALID_CLOCK
+                                reading.ClockOffset = value
+                return reading
+        return Reading()
+
+
+# Function to decode a protocol v2 frame
+def ParseV2(view):
+        length = len(view)
+        if length < V2_STATUS.size + V2_CRC.size or crc_hqx(view[:-2], 0xFFFF) != V2_CRC.unpack_from(view, length - 2)[0]:
+                return Reading(KIND_CORRUPT, version=PROTOCOL_V2)
+        kind = view[1] & 0x7F
+        night = view[1] & V2_NIGHT != 0
+        if kind == KIND_WEATHER and length >= V2_WEATHER.size + V2_CRC.size:
+                version, flags, station, sequence, temp, humid, press, rain, rainhour, windspeed, windgust, winddir, count = V2_WEATHER.unpack_from(view)
+                if length != V2_WEATHER.size + count + V2_CRC.size:
+                        return Reading(KIND_CORRUPT, version=PROTOCOL_V2)
+                gusts = tuple([GUST_MPH[sample] for sample in view[V2_WEATHER.size:length - 2]]) if count else ()
+                if temp != UNMEASURED_SIGNED and humid <= 10000 and press != UNMEASURED and rain != UNMEASURED and rainhour != UNMEASURED and windspeed != UNMEASURED and windgust != UNMEASURED and winddir <= 3600:
+                        return Reading(KIND_WEATHER, night, VALID_WEATHER, temp / 100, humid / 100, press / 10, rain / 100, rainhour / 100, windspeed / 100, windgust / 100, winddir / 10,
+                                       version=PROTOCOL_V2, station=station, sequence=sequence, gusts=gusts)
+                reading = Reading(KIND_WEATHER, night, version=PROTOCOL_V2, station=station, sequence=sequence, gusts=gusts)
+                bit = 1
+                for value, valid, scale, name in ((temp, temp != UNMEASURED_SIGNED, 100, "TempOut"), (humid, humid <= 10000, 100, "HumidOut"), (press, press != UNMEASURED, 10, "Pressure"),
+                                                  (rain, rain != UNMEASURED, 100, "Rain"), (rainhour, rainhour != UNMEASURED, 100, "RainHour"), (windspeed, windspeed != UNMEASURED, 100, "WindSpeed"),
+                                                  (windgust, windgust != UNMEASURED, 100, "WindGust"), (winddir, winddir <= 3600, 10, "WindDir")):
+                        if valid:
+                                setattr(reading, name, value / scale)
+                                reading.Valid |= bit
+                        bit <<= 1
+                return reading
+        if kind == KIND_STATUS and length == V2_STATUS.size + V2_CRC.size:
+                version, flags, station, sequence, battery, clockoffset = V2_STATUS.unpack_from(view)
+                reading = Reading(KIND_STATUS, version=PROTOCOL_V2, station=station, sequence=sequence)
+                if battery != UNMEASURED:
+                        reading.Valid = VALID_BATT
+                        reading.Battery = battery / 1000
+                if clockoffset != UNMEASURED_SIGNED:
+                        reading.Valid |= VALID_CLOCK
+                        reading.ClockOffset = clockoffset
+                return reading
+        return Reading(KIND_UNKNOWN, version=PROTOCOL_V2)
+
+
+# Build a weather payload the way WeatherStation.ino does
+def WeatherPayload(temp, humid, press, rain, rainhour, windspeed, windgust, winddir, night=False):
+        return ("%s%4.1fH%02dP%04dR%05.1fr%04.1fW%02d%02d%03d" % ('t' if night else 'T', temp, humid, press, rain, rainhour, windspeed, windgust, winddir)).encode('ascii')
+
+
+def StatusPayload(battery, clockoffset=None):
+        if clockoffset is None:
+                return ("S%4.2f" % battery).encode('ascii').ljust(32, b'0')
+        return ("S%4.2fD%+05d" % (battery, max(-9999, min(clockoffset, 9999)))).encode('ascii').ljust(32, b'0')
+
+
+# Build the v2 frames the way WeatherStation.ino does once the Pi has offered v2, None = not measured
+def FixedPoint(value, scale, highest):
+        if value is None:
+                return UNMEASURED
+        return max(0, min(int(round(value * scale)), highest))
+
+
+def V2Frame(body):
+        return body + V2_CRC.pack(crc_hqx(body, 0xFFFF))
+
+
+def WeatherPayloadV2(temp, humid, press, rain, rainhour, windspeed, windgust, winddir, night=False, station=1, sequence=0, gusts=()):
+        gusts = gusts[-V2_MAX_GUSTS:]
+        body = V2_WEATHER.pack(PROTOCOL_V2, KIND_WEATHER | (V2_NIGHT if night else 0), station, sequence & 0xFFFF,
+                               UNMEASURED_SIGNED if temp is None else max(-32767, min(int(round(temp * 100)), 32767)), FixedPoint(humid, 100, 10000), FixedPoint(press, 10, 0xFFFE),
+                               FixedPoint(rain, 100, 0xFFFE), FixedPoint(rainhour, 100, 0xFFFE), FixedPoint(windspeed, 100, 0xFFFE), FixedPoint(windgust, 100, 0xFFFE), FixedPoint(winddir, 10, 3600), len(gusts))
+        return V2Frame(body + bytes(max(0, min(int(round(gust * 2)), 255)) for gust in gusts))
+
+
+def StatusPayloadV2(battery, clockoffset=None, station=1, sequence=0):
+        return V2Frame(V2_STATUS.pack(PROTOCOL_V2, KIND_STATUS, station, sequence & 0xFFFF, FixedPoint(battery, 1000, 0xFFFE),
+                                      UNMEASURED_SIGNED if clockoffset is None else max(-32767, min(clockoffset, 32767))))
+
+
+#------------------------------------------------------------------------------------
+# Microbenchmark and fuzz test
+#------------------------------------------------------------------------------------
+
+# The parsing the receive loop used to do, kept here as the benchmark baseline
+def OldParse(receive_payload):
+        values = []
+        for start, end, convert in ((1,5,float),(6,8,int),(9,13,int),(14,19,float),(20,24,float),(25,27,int),(27,29,int),(29,32,int)):
+                try:
+                        values.append(convert(receive_payload.decode('utf-8')[start:end]))
+                except:
+                        values.append(0)
+        return values
+
+
+# Time on air at 250 kbps of one Enhanced ShockBurst packet: preamble, 5 byte address, 9 bit
+# packet control field, payload and 2 byte CRC, 4 us a bit
+def Airtime(length):
+        return ((1 + 5 + length + 2) * 8 + 9) * 4e-6
+
+
+def Benchmark(count):
+        payload = WeatherPayload(21.5, 55, 1013, 1.2, 0.0, 3, 5, 270)
+        gusts = (4.5, 6.0, 5.5, 7.0, 5.0)
+        frame = WeatherPayloadV2(21.53, 55.2, 1013.4, 1.2, 0.0, 3.4, 7.0, 270, gusts=gusts)
+        for name, parse, packet in (("decode per field", OldParse, payload), ("memoryview", ParsePayload, payload),
+                                    ("v2 struct + CRC", ParsePayload, WeatherPayloadV2(21.53, 55.2, 1013.4, 1.2, 0.0, 3.4, 7.0, 270)), ("v2 + 5 gusts", ParsePayload, frame)):
+                start = time.perf_counter()
+                for index in range(count):
+                        parse(packet)
+                elapsed = time.perf_counter() - start
+                print("%-18s %8.2f us/packet" % (name, elapsed / count * 1e6))
+        print("%-18s %8s %8s %10s %12s" % ("airtime, 250 kbps", "weather", "status", "per cycle", "per reading"))
+        for name, weather, status, readings in (("ASCII", payload, StatusPayload(12.5, 3), 1),
+                                                ("v2", WeatherPayloadV2(21.53, 55.2, 1013.4, 1.2, 0.0, 3.4, 7.0, 270), StatusPayloadV2(12.5, 3), 1),
+                                                ("v2 + 5 gusts", frame, StatusPayloadV2(12.5, 3), 1 + len(gusts))):
+                cycle = Airtime(len(weather)) + Airtime(len(status))
+                print("%-18s %6dB %6dB %8.0f us %10.0f us" % (name, len(weather), len(status), cycle * 1e6, cycle / readings * 1e6))
+
+
+def RandomPayload(rng):
+        if rng.random() < 0.4:
+                return bytes(rng.getrandbits(8) for index in range(rng.randint(0, 33)))
+        if rng.random() < 0.3:
+                payload = bytearray(WeatherPayloadV2(rng.uniform(-40, 50), rng.uniform(0, 100), rng.uniform(900, 1100), rng.uniform(0, 99), rng.uniform(0, 30), rng.uniform(0, 60), rng.uniform(0, 99), rng.uniform(0, 359.9),
+                                                     sequence=rng.getrandbits(16), gusts=[rng.uniform(0, 99) for index in range(rng.randint(0, V2_MAX_GUSTS))]))
+                for mutation in range(rng.randint(1, 3)):
+                        payload[rng.randrange(1, len(payload))] ^= 1 << rng.randrange(8)	# The CRC catches any 1-3 bit errors in a frame this short
+                return bytes(payload)
+        payload = bytearray(WeatherPayload(rng.uniform(-9.9, 99.9), rng.randint(0, 99), rng.randint(900, 1100), rng.uniform(0, 999.9), rng.uniform(0, 99.9), rng.randint(0, 99), rng.randint(0, 99), rng.randint(0, 360)))
+        for mutation in range(rng.randint(1, 3)):
+                payload[rng.randrange(32)] = rng.getrandbits(8)
+        return bytes(payload)
+
+
+def Fuzz(count, seed):
+        rng = random.Random(seed)
+        ranges = dict(zip(("TempOut", "HumidOut", "Pressure", "Rain", "RainHour", "WindSpeed", "WindGust", "WindDir"), ((field[4], field[5]) for field in WEATHER_FIELDS)))
+        start = time.perf_counter()
+        for payload, valid in ((b"T-10.5H55P1013R000.0r00.0W0305270", 0),			# A grown field must not shift the rest into range
+                               (b"T21.5H5 P1013R000.0r00.0W0305270", VALID_WEATHER & ~VALID_HUMID),
+                               (b"T21.5H55P1013R000.0r00.0W03052_7", VALID_WEATHER & ~VALID_WINDDIR),
+                               (b"T21.5H55P1013R000.0r00.0W0305\t70", VALID_WEATHER & ~VALID_WINDDIR)):
+                reading = ParsePayload(payload)
+                if reading.Valid != valid:
+                        print("FAIL: %r parsed as %r" % (payload, reading))
+                        return 1
+        for index in range(count):
+                if index % 10 == 0:						# Clean payloads must round trip exactly
+                        values = (round(rng.uniform(-9.9, 99.9), 1), rng.randint(0, 99), rng.randint(0, 9999), round(rng.uniform(0, 999.9), 1), round(rng.uniform(0, 99.9), 1), rng.randint(0, 99), rng.randint(0, 99), rng.randint(0, 360))
+                        reading = ParsePayload(WeatherPayload(*values))
+                        if reading.Valid != VALID_WEATHER or (reading.TempOut, reading.HumidOut, reading.Pressure, reading.Rain, reading.RainHour, reading.WindSpeed, reading.WindGust, reading.WindDir) != values:
+                                print("FAIL: %r parsed as %r" % (WeatherPayload(*values), reading))
+                                return 1
+                        continue
+                if index % 10 == 5:						# Clean v2 frames must round trip to their fixed point
+                        values = (rng.uniform(-40, 50), rng.uniform(0, 100), rng.uniform(900, 1100), rng.uniform(0, 650), rng.uniform(0, 650), rng.uniform(0, 650), rng.uniform(0, 650), rng.uniform(0, 360))
+                        gusts = tuple(rng.randint(0, 255) / 2 for count in range(rng.randint(0, V2_MAX_GUSTS)))
+                        sequence = rng.getrandbits(16)
+                        reading = ParsePayload(WeatherPayloadV2(*values, sequence=sequence, gusts=gusts))
+                        decoded = (reading.TempOut, reading.HumidOut, reading.Pressure, reading.Rain, reading.RainHour, reading.WindSpeed, reading.WindGust, reading.WindDir)
+                        if reading.Valid != VALID_WEATHER or reading.Sequence != sequence or reading.Gusts != gusts or any(abs(got - sent) > 0.051 for got, sent in zip(decoded, values)):
+                                print("FAIL: v2 %r decoded as %r" % (values, reading))
+                                return 1
+                        continue
+                payload = RandomPayload(rng)
+                reading = ParsePayload(payload)
+                if reading.Version == PROTOCOL_V2:
+                        if reading.Kind != KIND_CORRUPT and crc_hqx(payload[:-2], 0xFFFF) != V2_CRC.unpack_from(payload, len(payload) - 2)[0]:
+                                print("FAIL: corrupted v2 frame %r accepted as %r" % (payload, reading))
+                                return 1
+                        continue
+                for bit, name in enumerate(ranges):
+                        lowest, highest = ranges[name]
+                        value = getattr(reading, name)
+                        if reading.Valid & (1 << bit) and not (lowest <= value <= highest):
+                                print("FAIL: %r gave %s=%r" % (payload, name, value))
+                                return 1
+                        if not reading.Valid & (1 << bit) and value != 0:
+                                print("FAIL: %r gave invalid %s=%r" % (payload, name, value))
+                                return 1
+        print("OK: %d payloads in %.1fs" % (count, time.perf_counter() - start))
+        return 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station payload parser")
+        parser.add_argument("--benchmark", action="store_true", help="time the old and new parsers")
+        parser.add_argument("--fuzz", type=int, default=0, metavar="N", help="parse N synthetic payloads and check the results")
+        parser.add_argument("--seed", type=int, default=1)
+        args = parser.parse_args()
+        if args.benchmark:
+                Benchmark(200000)
+        if args.fuzz:
+                sys.exit(Fuzz(args.fuzz, args.seed))
+        if not (args.benchmark or args.fuzz):
+                parser.print_help()
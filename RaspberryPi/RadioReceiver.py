@@ -0,0 +1,451 @@
+#!/usr/bin/python3
+
+# Radio receive path for the Weather Station
+#
+# Two ways of getting packets off the nRF24 are supported:
+#   Polling - the original behaviour, radio.available() is checked on every Tk tick (10ms)
+#   IRQ     - the nRF24 IRQ line (active low) wakes a receiver thread, which reads the
+#             packet and hands it to the Tk thread through a queue.
+# In IRQ mode all SPI traffic happens on the receiver thread, so the Tk thread must not
+# touch the radio once the receiver has been started.
+#
+# ACK payloads (the Unix time the Arduino syncs its clock from) are preloaded by an
+# AckScheduler. The nRF24 TX FIFO holds three payloads, each tagged with a pipe, and a packet
+# on a pipe takes the first payload for that pipe with its ACK. With up to five transmitters
+# there are more pipes than slots, so the scheduler only loads a pipe's payload once a packet
+# has used the last one and the pipe's next weather packet is due within a few seconds. The
+# status packet right behind each weather packet then goes without (the Arduino ignores its
+# ACK payload anyway), which halves the SPI writes and keeps the time fresher. The payload is
+# encoded at most once a second, and the RTC offset the Arduino reports in its status packet
+# is corrected for the age of the ACK it was measured against, giving each RTC's drift.
+# Status packets are handled on the Tk thread, so the scheduler's state is kept under a lock.
+#
+# Run this file directly to compare the CPU time used by both modes against a simulated radio,
+# or ACK scheduling against simulated Arduinos with drifting clocks:
+#       python3 RadioReceiver.py --benchmark
+#       python3 RadioReceiver.py --ack-benchmark --stations 5
+
+import threading
+import queue
+import time
+import sys
+import argparse
+
+
+# IRQ source using RPi.GPIO edge detection on the nRF24 IRQ pin
+class GPIOIrqSource():
+
+        def __init__(self, pin):
+                import RPi.GPIO as GPIO
+                self.GPIO = GPIO
+                self.Pin = pin
+
+        def Start(self, callback):
+                self.GPIO.setmode(self.GPIO.BCM)
+                self.GPIO.setup(self.Pin, self.GPIO.IN, pull_up_down=self.GPIO.PUD_UP)
+                self.GPIO.add_event_detect(self.Pin, self.GPIO.FALLING, callback=lambda channel: callback())
+
+        def Stop(self):
+                self.GPIO.remove_event_detect(self.Pin)
+
+
+# IRQ source for testing - whoever plays the radio calls Trigger() when a packet is ready
+class FakeIrqSource():
+
+        def __init__(self):
+                self.Callback = None
+
+        def Start(self, callback):
+                self.Callback = callback
+
+        def Stop(self):
+                self.Callback = None
+
+        def Trigger(self):
+                if self.Callback is not None:
+                        self.Callback()
+
+
+# Keeps the ACK payloads in the TX FIFO for the pipes expected to transmit next
+class AckScheduler():
+
+        def __init__(self, radio, pipes, payloadfunction, cadence=10.0, depth=3, lead=3.0):
+                self.Radio = radio
+                self.Pipes = list(pipes)
+                self.PayloadFunction = payloadfunction				# Returns the bytes to preload for a given Unix second
+                self.Cadence = cadence						# Seconds between weather packets from one Arduino
+                self.Depth = depth						# TX FIFO slots
+                self.Lead = lead						# Seconds before a weather packet is due to load its payload, None = as soon as a slot is free
+                self.Last = dict.fromkeys(self.Pipes)				# Time of each pipe's last packet
+                self.Interval = dict.fromkeys(self.Pipes, cadence)		# Smoothed time between each pipe's packet cycles
+                self.Loaded = {}						# Pipe -> Unix second in its payload, for payloads still in the FIFO
+                self.PayloadSecond = None
+                self.Payload = b""
+                self.Synced = {}						# Pipe -> (ACK second, time received) for its last weather packet, None if it had no ACK
+                self.Offset = dict.fromkeys(self.Pipes)				# Pipe -> RTC minus station clock in seconds, as last reported
+                self.Drift = dict.fromkeys(self.Pipes)				# Pipe -> RTC drift in seconds per day
+                self.DriftFit = {}						# Pipe -> [start, n, sum t, sum offset, sum t*t, sum t*offset] since the RTC was last set
+                self.Writes = 0
+                self.Sent = 0							# Payloads that went out with a packet
+                self.Flushes = 0
+                self.SyncAcks = 0						# Weather packets that took a payload
+                self.SyncAge = 0.0						# Their total age in seconds when taken
+                self.Lock = threading.Lock()					# ClockReport() may come from another thread than Service()
+
+# Function to empty the FIFO of anything left over, before the first Service()
+        def Start(self):
+                with self.Lock:
+                        self.Radio.flush_tx()
+                        self.Loaded.clear()
+
+# When the pipe's next packet is expected. A pipe not heard from yet is due now
+        def Due(self, pipe, now):
+                last = self.Last[pipe]
+                if last is None:
+                        return now
+                return last + self.Interval[pipe]
+
+# Function to get the payload for a Unix second, encoded once however many slots it fills
+        def PayloadFor(self, second):
+                if second != self.PayloadSecond:
+                        self.PayloadSecond = second
+                        self.Payload = self.PayloadFunction(second)
+                return self.Payload
+
+# Function to note a packet on a pipe, which took that pipe's payload out of the FIFO
+        def PacketReceived(self, pipe, when):
+                with self.Lock:
+                        second = self.Loaded.pop(pipe, None)
+                        if second is not None:
+                                self.Sent += 1
+                        if pipe not in self.Last:
+                                return							# Not one of ours
+                        last = self.Last[pipe]
+                        if last is None or when - last > self.Cadence / 2:		# The status packet follows close behind the weather packet
+                                if last is not None:
+                                        self.Interval[pipe] += (min(when - last, 6 * self.Cadence) - self.Interval[pipe]) / 8
+                                self.Synced[pipe] = None if second is None else (second, when)
+                                if second is not None:
+                                        self.SyncAcks += 1
+                                        self.SyncAge += when - second
+                        self.Last[pipe] = when
+
+# Function to take the RTC offset reported in a status packet, which the Arduino measured against the ACK
+# time of its weather packet. Returns the offset from the station clock, None if that packet had no ACK
+        def ClockReport(self, pipe, offset, when):
+                with self.Lock:
+                        synced = self.Synced.get(pipe)
+                        if synced is None:
+                                return None
+                        second, received = synced
+                        offset -= received - second					# The ACK time was already this old when it arrived
+                        fit = self.DriftFit.get(pipe)
+                        if fit is None or abs(offset - self.Offset[pipe]) > 30:		# First report, or the Arduino has just set its RTC
+                                fit = self.DriftFit[pipe] = [when, 0, 0.0, 0.0, 0.0, 0.0]
+                                self.Drift[pipe] = None
+                        days = (when - fit[0]) / 86400
+                        fit[1] += 1
+                        fit[2] += days
+                        fit[3] += offset
+                        fit[4] += days * days
+                        fit[5] += days * offset
+                        if days >= 1 / 24:						# Least squares slope, the whole-second offsets need a while to average out
+                                n, t, o, tt, to = fit[1:]
+                                self.Drift[pipe] = (n * to - t * o) / (n * tt - t * t)
+                        self.Offset[pipe] = offset
+                        return offset
+
+# Function to fill free FIFO slots with payloads for the pipes due soonest, called when the radio is idle
+        def Service(self, now):
+                with self.Lock:
+                        if len(self.Loaded) >= self.Depth:
+                                waiting = [pipe for pipe in self.Pipes if pipe not in self.Loaded and self.Due(pipe, now) <= now + (self.Cadence if self.Lead is None else self.Lead)]
+                                silent = [pipe for pipe in self.Loaded if now - self.Due(pipe, now) > 2 * self.Interval[pipe]]
+                                if not (waiting and silent):
+                                        return
+                                self.Radio.flush_tx()					# A silent station is holding a slot another one needs
+                                self.Loaded.clear()
+                                self.Flushes += 1
+                        waiting = [pipe for pipe in self.Pipes if pipe not in self.Loaded and (self.Lead is None or self.Due(pipe, now) - self.Lead <= now)]
+                        if not waiting:
+                                return
+                        waiting.sort(key=lambda pipe: self.Due(pipe, now))
+                        second = int(now)
+                        for pipe in waiting[:self.Depth - len(self.Loaded)]:
+                                if not self.Radio.writeAckPayload(pipe, self.PayloadFor(second)):
+                                        self.Radio.flush_tx()				# FIFO not as we thought, start again on the next call
+                                        self.Loaded.clear()
+                                        self.Flushes += 1
+                                        return
+                                self.Loaded[pipe] = second
+                                self.Writes += 1
+
+
+# Receiver thread woken by the IRQ line
+class RadioReceiver():
+
+        def __init__(self, radio, irqsource, acks, waittimeout=1.0, clock=time.time):
+                self.Radio = radio
+                self.IrqSource = irqsource
+                self.Acks = acks						# AckScheduler, only ClockReport() is called from other threads once started
+                self.Clock = clock						# The station's clock, for receive times and the ACK deadlines
+                self.WaitTimeout = waittimeout					# Safety net in case an edge is ever missed
+                self.Packets = queue.Queue()
+                self.ReadRpd = hasattr(radio, "testRPD")
+                self.Wakeup = threading.Event()
+                self.Stopping = threading.Event()
+                self.Thread = None
+
+        def Start(self):
+                self.Radio.maskIRQ(True, True, False)				# Only interrupt on RX_DR, not on sent ACK payloads
+                self.Acks.Start()
+                self.Acks.Service(self.Clock())
+                self.IrqSource.Start(self.Wakeup.set)
+                self.Thread = threading.Thread(target=self.Run, name="RadioReceiver", daemon=True)
+                self.Thread.start()
+
+        def Stop(self):
+                self.Stopping.set()
+                self.Wakeup.set()
+                self.IrqSource.Stop()
+                if self.Thread is not None:
+                        self.Thread.join()
+
+        def Run(self):
+                while not self.Stopping.is_set():
+                        self.Wakeup.wait(self.WaitTimeout)
+                        self.Wakeup.clear()
+                        while not self.Stopping.is_set():
+                                available, pipe = self.Radio.available_pipe()
+                                if not available:
+                                        break
+                                length = self.Radio.getDynamicPayloadSize()
+                                payload = self.Radio.read(length)
+                                rpd = self.Radio.testRPD() if self.ReadRpd else None	# Only means anything straight after the read
+                                now = self.Clock()
+                                self.Packets.put((now, pipe, bytes(payload), rpd))
+                                self.Acks.PacketReceived(pipe, now)
+                        self.Acks.Service(self.Clock())				# Refill what the packets used
+
+# Function for the Tk thread to collect the (time, pipe, payload, RPD or None) received since the last call
+        def GetPackets(self):
+                packets = []
+                while True:
+                        try:
+                                packets.append(self.Packets.get_nowait())
+                        except queue.Empty:
+                                return packets
+
+
+#------------------------------------------------------------------------------------
+# Simulated radio and benchmark
+#------------------------------------------------------------------------------------
+
+# Minimal stand-in for the RF24 object. Packets queued with Deliver() become available()
+# and the IRQ source (if any) is triggered. Each delivered packet takes the first ACK payload
+# loaded for its pipe, like the real TX FIFO. Every call costs SpiCost seconds of CPU to
+# approximate an SPI transaction on the Pi.
+class SimulatedRadio():
+
+        def __init__(self, irqsource=None, spicost=0.00002):
+                self.IrqSource = irqsource
+                self.SpiCost = spicost
+                self.Fifo = []							# (pipe, payload, RPD) waiting to be read
+                self.Rpd = False						# RPD of the last packet read
+                self.Lock = threading.Lock()
+                self.SpiTransactions = 0
+                self.AckFifo = []						# (pipe, payload), 3 deep
+                self.AcksSent = []						# (pipe, payload) that went out with a packet
+
+        def Spi(self):
+                self.SpiTransactions += 1
+                end = time.perf_counter() + self.SpiCost
+                while time.perf_counter() < end:
+                        pass
+
+        def Deliver(self, payload, pipe=1, rpd=True):
+                with self.Lock:
+                        self.Fifo.append((pipe, bytes(payload), rpd))
+                        for index, (ackpipe, ack) in enumerate(self.AckFifo):
+                                if ackpipe == pipe:
+                                        self.AcksSent.append(self.AckFifo.pop(index))
+                                        break
+                if self.IrqSource is not None:
+                        self.IrqSource.Trigger()
+
+        def maskIRQ(self, tx_ok, tx_fail, rx_ready):
+                self.Spi()
+
+        def available(self):
+                self.Spi()
+                with self.Lock:
+                        return len(self.Fifo) > 0
+
+        def available_pipe(self):
+                self.Spi()
+                with self.Lock:
+                        if self.Fifo:
+                                return True, self.Fifo[0][0]
+                        return False, 0
+
+        def getDynamicPayloadSize(self):
+                self.Spi()
+                with self.Lock:
+                        return len(self.Fifo[0][1])
+
+        def read(self, length):
+                self.Spi()
+                with self.Lock:
+                        pipe, payload, self.Rpd = self.Fifo.pop(0)
+                        return bytearray(payload[:length])
+
+        def testRPD(self):
+                self.Spi()
+                return self.Rpd
+
+        def writeAckPayload(self, pipe, buf):
+                self.Spi()
+                with self.Lock:
+                        if len(self.AckFifo) >= 3:
+                                return False					# Full, the chip ignores the write
+                        self.AckFifo.append((pipe, bytes(buf)))
+                return True
+
+        def flush_tx(self):
+                self.Spi()
+                with self.Lock:
+                        self.AckFifo = []
+
+
+def BenchmarkAck(second):
+        return bytes(str(second), 'utf-8')
+
+
+# Send a 'T' weather packet followed by an 'S' status packet every cadence seconds, like the Arduino
+def BenchmarkSender(radio, cadence, stop):
+        while not stop.wait(cadence):
+                radio.Deliver(b"T21.5H55P1013R001.2r00.0W0305270")
+                radio.Deliver(b"S12.61")
+
+
+def BenchmarkPolling(seconds, cadence):
+        radio = SimulatedRadio()
+        stop = threading.Event()
+        sender = threading.Thread(target=BenchmarkSender, args=(radio, cadence, stop), daemon=True)
+        received = 0
+        start = time.time()
+        startcpu = time.process_time()
+        sender.start()
+        while time.time() - start < seconds:					# Same work as the old 10ms Get_Weather_Updates tick
+                if radio.available():
+                        radio.read(radio.getDynamicPayloadSize())
+                        received += 1
+                else:
+                        radio.writeAckPayload(1, BenchmarkAck(int(time.time())))
+                time.sleep(0.01)
+        cpu = time.process_time() - startcpu
+        stop.set()
+        return cpu, time.time() - start, received, radio.SpiTransactions
+
+
+def BenchmarkIrq(seconds, cadence):
+        irq = FakeIrqSource()
+        radio = SimulatedRadio(irq)
+        receiver = RadioReceiver(radio, irq, AckScheduler(radio, [1], BenchmarkAck))
+        stop = threading.Event()
+        sender = threading.Thread(target=BenchmarkSender, args=(radio, cadence, stop), daemon=True)
+        received = 0
+        start = time.time()
+        startcpu = time.process_time()
+        receiver.Start()
+        sender.start()
+        while time.time() - start < seconds:					# Tk thread only drains the queue
+                received += len(receiver.GetPackets())
+                time.sleep(0.25)
+        cpu = time.process_time() - startcpu
+        stop.set()
+        receiver.Stop()
+        return cpu, time.time() - start, received, radio.SpiTransactions
+
+
+def Benchmark(seconds, cadence):
+        print("Simulated radio, packet pair every %.1fs, %.0fs per mode" % (cadence, seconds))
+        for name, run in (("Polling", BenchmarkPolling), ("IRQ", BenchmarkIrq)):
+                cpu, elapsed, received, spi = run(seconds, cadence)
+                print("%-8s CPU %7.2f s/hour   SPI %8.0f /hour   packets %d" % (name, cpu / elapsed * 3600, spi / elapsed * 3600, received))
+
+
+# Simulated Arduinos on the real receive path (see Simulation.py). Each one's RTC starts a few
+# seconds out and drifts at its own rate, and its status packet reports the RTC offset against
+# the ACK time its weather packet took, as WeatherStation.ino does
+def AckBenchmark(stations, days, lead):
+        import heapq
+        import tempfile
+        import datetime
+        import os
+        from Simulation import Simulator
+        from PayloadParser import WeatherPayload, StatusPayload
+        start = datetime.datetime(2021, 6, 1).timestamp()
+        pipes = list(range(1, stations + 1))
+        sim = Simulator(start, os.path.join(tempfile.mkdtemp(), "WeatherStation.db"), pipes=pipes)
+        acks = sim.Station.Acks
+        acks.Lead = lead
+        radio = sim.Radio
+        offset = dict((pipe, 2.0 * pipe) for pipe in pipes)			# RTC minus true time at the start
+        drift = dict((pipe, 1.5 * (pipe - 3)) for pipe in pipes)		# Seconds per day
+        reported = {}
+        events = [(start + 2.0 * pipe, pipe, True) for pipe in pipes]
+        packets = 0
+        weather = 0
+        synced = 0
+        while events:
+                when, pipe, isweather = heapq.heappop(events)
+                if when >= start + days * 86400:
+                        continue
+                sim.RunUntil(when)
+                sent = len(radio.AcksSent)
+                if isweather:
+                        radio.Deliver(WeatherPayload(15.0, 60, 1012, 0.0, 0.0, 3, 6, 200), pipe)
+                        weather += 1
+                        if len(radio.AcksSent) > sent:
+                                synced += 1
+                                rtc = int(when + offset[pipe] + drift[pipe] * (when - start) / 86400)
+                                reported[pipe] = rtc - int(radio.AcksSent[-1][1].split()[0])	# atol() as the sketch does
+                        heapq.heappush(events, (when + 0.2, pipe, False))
+                else:
+                        radio.Deliver(StatusPayload(12.5, reported.get(pipe)), pipe)
+                        heapq.heappush(events, (when - 0.2 + 10, pipe, True))
+                packets += 1
+                while radio.Fifo:
+                        sim.Station.PollRadio()
+        print("Lead %s, %d stations, %.1f days: %d packets" % ("none" if lead is None else "%.1fs" % lead, stations, days, packets))
+        print("  SPI transactions %.2f/packet, ACK writes %.2f/weather packet, flushes %d" % (radio.SpiTransactions / packets, acks.Writes / weather, acks.Flushes))
+        print("  Weather packets with an ACK time %.1f%%, ACK time age %.2fs mean, status packets with one %d" % (synced * 100.0 / weather, acks.SyncAge / max(acks.SyncAcks, 1), acks.Sent - acks.SyncAcks))
+        failures = 0
+        for pipe in pipes:
+                end = offset[pipe] + drift[pipe] * days
+                estimate = acks.Drift[pipe]
+                ok = estimate is not None and abs(estimate - drift[pipe]) < max(0.5, 2.0 / days) and abs(acks.Offset[pipe] - end) < 1.5
+                failures += not ok
+                print("  pipe %d RTC offset %6.2fs (true %6.2fs), drift %s s/day (true %+.2f)  %s" % (pipe, acks.Offset[pipe] or 0, end, "  none" if estimate is None else "%+6.2f" % estimate, drift[pipe], "OK" if ok else "FAIL"))
+        return failures
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station radio receive benchmark")
+        parser.add_argument("--benchmark", action="store_true", help="compare CPU time of the polling and IRQ receive modes")
+        parser.add_argument("--seconds", type=float, default=20, help="wall time to run each mode for")
+        parser.add_argument("--cadence", type=float, default=5, help="seconds between simulated packet pairs")
+        parser.add_argument("--ack-benchmark", action="store_true", help="compare ACK scheduling with and without the lead time against simulated Arduinos")
+        parser.add_argument("--stations", type=int, default=5, choices=range(1, 6), help="simulated Arduinos for --ack-benchmark, one per pipe")
+        parser.add_argument("--days", type=float, default=3, help="days to simulate for --ack-benchmark")
+        args = parser.parse_args()
+        if args.benchmark:
+                Benchmark(args.seconds, args.cadence)
+        elif args.ack_benchmark:
+                failures = 0
+                for lead in (None, 3.0):					# Refill as soon as a slot is free, then the lead time
+                        failures += AckBenchmark(args.stations, args.days, lead)
+                sys.exit(1 if failures else 0)
+        else:
+                parser.print_help()
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+# Local time-series store for every packet the Weather Station receives
+#
+# SQLite in WAL mode with synchronous=NORMAL: each packet is one small append to the WAL,
+# an application crash or power cut never corrupts the database, and the fsync only happens
+# when the WAL is checkpointed. Size is kept bounded by rolling raw samples up into hourly
+# and daily rows and then pruning them:
+#       samples - every packet, kept for RawDays
+#       hourly  - one row per hour, kept for HourlyDays
+#       daily   - one row per local day, kept forever (a few KB per year)
+#
+# Each weather packet also records the link quality: how many packets the LinkEstimator thinks
+# were lost just before it, and the nRF24's RPD bit where the radio has one. The rollups keep
+# the packets lost and the share with a strong RPD. A v2 frame's gust samples are kept as their
+# highest, gust_peak. Columns added since a store was created are added to it when it is opened.
+#
+# A read-only SampleStore on the same file (the web API's) reads alongside the station's
+# writes without ever blocking them, which is what WAL mode is for.
+#
+# History.py imports packets in batches through AppendRows(), rolls the days they land in up
+# again with RollupDays(), and exports tables through Chunks().
+
+import sqlite3
+import datetime
+from PayloadParser import KIND_WEATHER, KIND_STATUS
+from PayloadParser import VALID_TEMP, VALID_HUMID, VALID_PRESS, VALID_RAIN, VALID_RAINH, VALID_WINDSPEED, VALID_WINDGUST, VALID_WINDDIR, VALID_BATT
+
+# Columns of the samples table after time and kind, in the order Append() writes them
+SAMPLE_COLUMNS = ("temp_out", "humid_out", "pressure", "rain", "rain_hour", "wind_speed", "wind_gust", "wind_dir", "battery", "temp_in", "humid_in", "lost", "rpd", "gust_peak")
+
+# Aggregates kept in the hourly and daily tables, computed from the samples table
+ROLLUP_COLUMNS = (("samples", "COUNT(*)"),
+                  ("temp_out_max", "MAX(temp_out)"),
+                  ("temp_out_min", "MIN(temp_out)"),
+                  ("temp_out_avg", "AVG(temp_out)"),
+                  ("humid_out_avg", "AVG(humid_out)"),
+                  ("pressure_max", "MAX(pressure)"),
+                  ("pressure_min", "MIN(pressure)"),
+                  ("pressure_avg", "AVG(pressure)"),
+                  ("rain", "MAX(rain)"),						# Daily bucket is cumulative, reset at midnight by the Arduino
+                  ("rain_hour_max", "MAX(rain_hour)"),
+                  ("wind_speed_avg", "AVG(wind_speed)"),
+                  ("wind_gust_max", "MAX(wind_gust)"),
+                  ("battery_avg", "AVG(battery)"),
+                  ("temp_in_max", "MAX(temp_in)"),
+                  ("temp_in_min", "MIN(temp_in)"),
+                  ("temp_in_avg", "AVG(temp_in)"),
+                  ("humid_in_avg", "AVG(humid_in)"),
+                  ("packets_lost", "TOTAL(lost)"),
+                  ("rpd_strong", "AVG(rpd)"),
+                  ("gust_peak_max", "MAX(gust_peak)"))
+
+# Key column of each table, and the column whose total changes whenever a row in a range is rewritten
+TABLE_KEYS = {"samples": ("time", "time"), "hourly": ("hour", "samples"), "daily": ("day", "samples")}
+
+
+class SampleStore():
+
+        def __init__(self, path="WeatherStation.db", rawdays=31, hourlydays=731, readonly=False):
+                self.RawDays = rawdays
+                self.HourlyDays = hourlydays
+                if readonly:							# Queries only, from any thread, the caller serialises them
+                        self.Db = sqlite3.connect("file:%s?mode=ro" % path, uri=True, check_same_thread=False)
+                        return
+                self.Db = sqlite3.connect(path)
+                self.Db.execute("PRAGMA journal_mode=WAL")
+                self.Db.execute("PRAGMA synchronous=NORMAL")
+                self.Db.execute("CREATE TABLE IF NOT EXISTS samples (time REAL NOT NULL, kind TEXT NOT NULL, %s)" % ", ".join(SAMPLE_COLUMNS))
+                self.Db.execute("CREATE INDEX IF NOT EXISTS samples_time ON samples (time)")
+                rollup = ", ".join(name for name, aggregate in ROLLUP_COLUMNS)
+                self.Db.execute("CREATE TABLE IF NOT EXISTS hourly (hour INTEGER PRIMARY KEY, %s)" % rollup)
+                self.Db.execute("CREATE TABLE IF NOT EXISTS daily (day TEXT PRIMARY KEY, %s)" % rollup)
+                for table, columns in (("samples", SAMPLE_COLUMNS), ("hourly", [name for name, aggregate in ROLLUP_COLUMNS]), ("daily", [name for name, aggregate in ROLLUP_COLUMNS])):
+                        existing = set(row[1] for row in self.Db.execute("PRAGMA table_info(%s)" % table))
+                        for name in columns:
+                                if name not in existing:
+                                        self.Db.execute("ALTER TABLE %s ADD COLUMN %s" % (table, name))
+                self.Db.commit()
+                self.InsertSQL = "INSERT INTO samples VALUES (?, ?, %s)" % ", ".join("?" * len(SAMPLE_COLUMNS))
+
+# Function to append one decoded packet. Fields that did not parse are stored as NULL
+        def Append(self, when, reading, tempin=None, humidin=None, lost=None, rpd=None):
+                self.Db.execute(self.InsertSQL, SampleRow(when, reading, tempin, humidin, lost, rpd))
+                self.Db.commit()
+
+# Function to append many rows as SampleRow() makes them in one transaction, for imports. Returns how many
+        def AppendRows(self, rows):
+                cursor = self.Db.executemany(self.InsertSQL, rows)
+                self.Db.commit()
+                return cursor.rowcount
+
+# Function to get the times already stored from start to end inclusive, to the millisecond a capture keeps
+        def Times(self, start, end):
+                return set(round(row[0], 3) for row in self.Db.execute("SELECT time FROM samples WHERE time >= ? AND time <= ?", (start, end)))
+
+# Function to roll the raw samples of the hour starting at hourstart (a local datetime) into the hourly table
+        def RollupHour(self, hourstart):
+                start = hourstart.replace(minute=0, second=0, microsecond=0).timestamp()
+                self.Rollup("hourly", int(start), start, start + 3600)
+
+# Function to roll up one local calendar day, then prune anything past its retention
+        def RollupDay(self, day, now):
+                start = datetime.datetime.combine(day, datetime.time()).timestamp()
+                end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()).timestamp()	# 23 or 25 hours across DST
+                self.Rollup("daily", day.isoformat(), start, end)
+                self.Prune(now)
+
+# Function to roll up every local hour and the whole of each given day again, after rows were imported into them
+        def RollupDays(self, days):
+                for day in sorted(days):
+                        start = datetime.datetime.combine(day, datetime.time()).timestamp()
+                        end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()).timestamp()
+                        for hour in range(int(start), int(end), 3600):
+                                self.RollupHour(datetime.datetime.fromtimestamp(hour))
+                        self.Rollup("daily", day.isoformat(), start, end)
+
+        def Rollup(self, table, key, start, end):
+                aggregates = ", ".join(aggregate for name, aggregate in ROLLUP_COLUMNS)
+                row = self.Db.execute("SELECT %s FROM samples WHERE time >= ? AND time < ?" % aggregates, (start, end)).fetchone()
+                if row[0] == 0:
+                        return
+                self.Db.execute("INSERT OR REPLACE INTO %s VALUES (?, %s)" % (table, ", ".join("?" * len(ROLLUP_COLUMNS))), (key,) + tuple(row))
+                self.Db.commit()
+
+        def Prune(self, now):
+                self.Db.execute("DELETE FROM samples WHERE time < ?", (now - self.RawDays * 86400,))
+                self.Db.execute("DELETE FROM hourly WHERE hour < ?", (now - self.HourlyDays * 86400,))
+                self.Db.commit()
+
+# Function to get (day, outdoor max, outdoor min) for up to count days before the given date, oldest first
+        def DailyHistory(self, count, before):
+                rows = self.Db.execute("SELECT day, temp_out_max, temp_out_min FROM daily WHERE day < ? AND temp_out_max IS NOT NULL ORDER BY day DESC LIMIT ?", (before.isoformat(), count)).fetchall()
+                rows.reverse()
+                return rows
+
+# Function to record a day known only by its extremes, used to import the old Config.ini history
+        def ImportDaily(self, day, tempmax, tempmin):
+                self.Db.execute("INSERT OR IGNORE INTO daily (day, temp_out_max, temp_out_min) VALUES (?, ?, ?)", (day.isoformat(), tempmax, tempmin))
+                self.Db.commit()
+
+# Function to get (time, value) of one column for the weather packets with start <= time < end, oldest first
+        def Samples(self, column, start, end):
+                if column not in SAMPLE_COLUMNS:
+                        raise KeyError(column)
+                return self.Db.execute("SELECT time, %s FROM samples WHERE kind IN ('T', 't') AND time >= ? AND time < ? ORDER BY time" % column, (start, end)).fetchall()
+
+# Function to get (column names, rows) of a table with start <= key < end, oldest first
+        def Range(self, table, start, end, limit):
+                key = TABLE_KEYS[table][0]
+                cursor = self.Db.execute("SELECT * FROM %s WHERE %s >= ? AND %s < ? ORDER BY %s LIMIT ?" % (table, key, key, key), (start, end, limit))
+                return [column[0] for column in cursor.description], cursor.fetchall()
+
+# Generator of (column names, rows) of a table with start <= key < end, oldest first, size rows at a time. Each
+# chunk is its own short query carrying on from the last (key, rowid), so no read is held open between chunks
+        def Chunks(self, table, start, end, size=5000):
+                key = TABLE_KEYS[table][0]
+                cursor = self.Db.execute("SELECT rowid, * FROM %s WHERE %s >= ? AND %s < ? ORDER BY %s, rowid LIMIT ?" % (table, key, key, key), (start, end, size))
+                columns = [column[0] for column in cursor.description][1:]
+                rows = cursor.fetchall()
+                while rows:
+                        yield columns, [row[1:] for row in rows]
+                        if len(rows) < size:
+                                return
+                        last = rows[-1]
+                        rows = self.Db.execute("SELECT rowid, * FROM %s WHERE %s >= ? AND (%s > ? OR rowid > ?) AND %s < ? ORDER BY %s, rowid LIMIT ?" % (table, key, key, key, key),
+                                               (last[1], last[1], last[0], end, size)).fetchall()
+
+# Function to get a cheap fingerprint of the same range that changes whenever its rows do, used for ETags
+        def RangeVersion(self, table, start, end):
+                key, total = TABLE_KEYS[table]
+                return self.Db.execute("SELECT COUNT(*), MIN(%s), MAX(%s), TOTAL(%s) FROM %s WHERE %s >= ? AND %s < ?" % (key, key, total, table, key, key), (start, end)).fetchone()
+
+        def Close(self):
+                self.Db.close()
+
+
+# Function to get the samples table row of one decoded packet: time, kind, then SAMPLE_COLUMNS
+def SampleRow(when, reading, tempin=None, humidin=None, lost=None, rpd=None):
+        valid = reading.Valid
+        if reading.Kind == KIND_WEATHER:
+                kind = 't' if reading.Night else 'T'
+        elif reading.Kind == KIND_STATUS:
+                kind = 'S'
+        else:
+                kind = '?'
+        return (when, kind,
+                reading.TempOut if valid & VALID_TEMP else None,
+                reading.HumidOut if valid & VALID_HUMID else None,
+                reading.Pressure if valid & VALID_PRESS else None,
+                reading.Rain if valid & VALID_RAIN else None,
+                reading.RainHour if valid & VALID_RAINH else None,
+                reading.WindSpeed if valid & VALID_WINDSPEED else None,
+                reading.WindGust if valid & VALID_WINDGUST else None,
+                reading.WindDir if valid & VALID_WINDDIR else None,
+                reading.Battery if valid & VALID_BATT else None,
+                tempin, humidin, lost, rpd,
+                max(reading.Gusts) if reading.Gusts else None)
@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+
+# Record/replay harness and hardware-free simulation mode for the Weather Station receiver
+#
+# On the station, WeatherStation.py --record FILE appends every received payload to a capture
+# file, one packet per line: Unix time, a space, the raw payload in hex and, for any pipe other
+# than 1, a space and the pipe number.
+#
+# Anywhere else, the Simulator runs the real receive path from WeatherStation.py (PollRadio,
+# ProcessPacket, Housekeeping and the aggregator/store behind them) with a simulated radio,
+# a fake DHT22, a recording uploader, no display and a simulated clock, replaying a capture
+# at real speed, N times faster, or as fast as possible.
+#
+#       python3 Simulation.py --generate capture.txt --days 3 [--protocol 2]
+#       python3 Simulation.py --replay capture.txt --speed 60
+#       python3 Simulation.py --check
+#       python3 Simulation.py --startup-benchmark 10
+
+import datetime
+import importlib
+import tempfile
+import math
+import time
+import os
+import sys
+import argparse
+from RadioReceiver import SimulatedRadio
+from DHTSampler import DHTSampler
+from SampleStore import SampleStore
+from Stations import StationState, StationFile
+import History
+from PayloadParser import ParsePayload, WeatherPayload, StatusPayload, WeatherPayloadV2, StatusPayloadV2, KIND_WEATHER, PROTOCOL_ASCII, PROTOCOL_V2
+
+
+# Appends received payloads to a capture file
+class PacketRecorder():
+
+        def __init__(self, path):
+                self.File = open(path, 'a', buffering=1)			# Line buffered so a crash loses at most one packet
+
+        def Write(self, when, payload, pipe=1):
+                if pipe == 1:
+                        self.File.write("%.3f %s\n" % (when, bytes(payload).hex()))
+                else:
+                        self.File.write("%.3f %s %d\n" % (when, bytes(payload).hex(), pipe))
+
+        def Close(self):
+                self.File.close()
+
+
+# Generator of (time, payload, pipe) from a capture file, skipping lines that do not parse
+def ReadCapture(path):
+        with open(path) as capture:
+                for line in capture:
+                        fields = line.split()
+                        try:
+                                yield float(fields[0]), bytes.fromhex(fields[1]), int(fields[2]) if len(fields) > 2 else 1
+                        except (ValueError, IndexError):
+                                continue
+
+
+# Synthetic capture: a weather and a status packet every cadence seconds, with a daily temperature
+# cycle peaking at 15:00, a slow pressure wave and a shower every afternoon, all from one pipe,
+# as ASCII payloads or protocol v2 frames
+def GenerateCapture(start, days, cadence=10, pipe=1, protocol=PROTOCOL_ASCII):
+        when = start
+        sequence = 0
+        while when < start + days * 86400:
+                local = datetime.datetime.fromtimestamp(when)
+                hour = local.hour + local.minute / 60 + local.second / 3600
+                day = (when - start) // 86400
+                temp = 10 + 2 * day + 5 * math.sin(2 * math.pi * (hour - 9) / 24)
+                humid = 70 - 20 * math.sin(2 * math.pi * (hour - 9) / 24)
+                press = 1010 + 20 * math.sin(2 * math.pi * (when - start) / (3 * 86400))
+                rain = max(0.0, min(hour - 14, 1.0)) * 4.0
+                rainhour = 4.0 if 14 <= hour < 15 else 0.0
+                wind = 5 + int(4 * math.sin(when / 900))
+                battery = 12.0 + 0.8 * math.sin(2 * math.pi * (hour - 6) / 24)
+                if protocol == PROTOCOL_V2:
+                        yield when, WeatherPayloadV2(temp, humid, press, rain, rainhour, wind, wind + 6, int(when / 60) % 90 + 180, station=pipe, sequence=sequence,
+                                                     gusts=tuple(wind + (sample * 7 + int(when)) % 6 for sample in range(5))), pipe
+                        yield when + 0.2, StatusPayloadV2(battery, station=pipe, sequence=sequence), pipe
+                else:
+                        yield when, WeatherPayload(temp, int(humid), int(press), rain, rainhour, wind, wind + 6, int(when / 60) % 90 + 180), pipe
+                        yield when + 0.2, StatusPayload(battery), pipe
+                when += cadence
+                sequence += 1
+
+
+class SimClock():
+
+        def __init__(self, start):
+                self.Now = start
+
+        def Time(self):
+                return self.Now
+
+
+# Stands in for Adafruit_DHT.read_retry: a gentle daily cycle, before calibration
+class FakeDHT():
+
+        def __init__(self, clock):
+                self.Clock = clock
+
+        def Read(self):
+                hour = datetime.datetime.fromtimestamp(self.Clock.Time()).hour
+                return 50.0, 20.0 + math.sin(2 * math.pi * hour / 24)
+
+
+# Stands in for the Tk Display, counting what would have been redrawn
+class NullDisplay():
+
+        def __init__(self):
+                self.DisplayUpdates = 0
+                self.HistoryUpdates = 0
+                self.Signal = 0
+                self.State = None
+
+        def UpdateDisplay(self, State):
+                self.DisplayUpdates += 1
+                self.State = State
+
+        def UpdateTempHistory(self, State):
+                self.HistoryUpdates += 1
+
+        def UpdateSignal(self, SignalLevel):
+                self.Signal = SignalLevel
+
+
+# Stands in for the ThingSpeak uploader, keeping what would have been sent
+class RecordingUploader():
+
+        def __init__(self):
+                self.Submissions = []
+
+        def Submit(self, values, when=None):
+                self.Submissions.append((when, dict(values)))
+
+        def Packet(self, values, when=None):
+                pass
+
+        def Start(self):
+                pass
+
+        def Stop(self):
+                pass
+
+
+class Simulator():
+
+        def __init__(self, start, dbpath, configfile="", speed=0, tick=1.0, pipes=(1,), checkpoint=None, index=None):
+                import WeatherStation
+                self.Station = WeatherStation
+                self.Clock = SimClock(start)
+                self.Speed = speed						# 0 = as fast as possible, 1 = real time, N = N times real time
+                self.Tick = tick						# Simulated seconds between idle radio polls
+                self.Radio = SimulatedRadio(spicost=0)
+                self.Sampler = DHTSampler(FakeDHT(self.Clock).Read)
+                self.Stations = [StationState(pipe, "Station %d" % pipe, SampleStore(StationFile(dbpath, pipe)), RecordingUploader(), checkpoint=StationFile(checkpoint, pipe) if checkpoint else None,
+                                         index=StationFile(index, pipe) if index else None) for pipe in pipes]
+                self.Store = self.Stations[0].Store				# The station on the display
+                self.Upload = self.Stations[0].Upload
+                self.Display = NullDisplay()
+                self.Station.Initialise(self.Radio, self.Sampler, self.Stations, self.Clock.Time, configfile, self.Display)
+                self.Station.ReadINI()
+                self.Station.RestoreState()
+                self.NextSample = start
+                self.Dropped = []						# Packets Replay() lost on purpose
+
+# Function to let simulated time pass up to when, polling the radio and sampling the DHT22 as the station would
+        def RunUntil(self, when):
+                while self.Clock.Now < when:
+                        step = min(self.Tick, when - self.Clock.Now)
+                        if self.Speed:
+                                time.sleep(step / self.Speed)
+                        self.Clock.Now += step
+                        if self.Clock.Now >= self.NextSample:
+                                self.Sampler.Sample()			# Sampler thread work, done inline so runs are deterministic
+                                self.NextSample = self.Clock.Now + self.Sampler.Interval
+                        self.Station.PollRadio()
+
+# Function to replay packets through the radio, losing each with probability drop as a bad link would
+        def Replay(self, packets, drop=0.0, seed=1):
+                import random
+                rng = random.Random(seed)
+                count = 0
+                for when, payload, pipe in packets:
+                        self.RunUntil(when)
+                        if drop and rng.random() < drop:
+                                self.Dropped.append((when, payload, pipe))
+                                continue
+                        self.Radio.Deliver(payload, pipe)
+                        while self.Radio.Fifo:
+                                self.Station.PollRadio()
+                        count += 1
+                return count
+
+
+#------------------------------------------------------------------------------------
+# Deterministic check of midnight rollover, pressure trend and history persistence
+#------------------------------------------------------------------------------------
+
+def Check():
+        os.environ["TZ"] = "Europe/London"
+        time.tzset()
+        workdir = tempfile.mkdtemp()
+        dbpath = os.path.join(workdir, "WeatherStation.db")
+        start = datetime.datetime(2021, 6, 1).timestamp()
+        packets = list(GenerateCapture(start, 3))
+        failures = []
+
+        def Expect(name, ok):
+                print("%-44s %s" % (name, "OK" if ok else "FAIL"))
+                if not ok:
+                        failures.append(name)
+
+        expected = {}								# What the display should show as each day's max/min
+        for when, payload, pipe in packets:
+                reading = ParsePayload(payload)
+                if reading.Kind == KIND_WEATHER:
+                        day = datetime.date.fromtimestamp(when)
+                        high, low = expected.get(day, (-999, 999))
+                        expected[day] = (max(high, reading.TempOut), min(low, reading.TempOut))
+        days = sorted(expected)
+
+        sim = Simulator(start, dbpath, os.path.join(workdir, "Config.ini"), index=os.path.join(workdir, "Index"))
+        station = sim.Station
+        started = time.perf_counter()
+        sim.Replay(packets)
+        signal = sim.Display.Signal						# Before the quiet minute after the last packet
+        sim.RunUntil(start + 3 * 86400 + 60)
+        elapsed = time.perf_counter() - started
+        history = list(zip(station.Primary.HistoryMax.Values()[-3:], station.Primary.HistoryMin.Values()[-3:]))
+        Expect("Three midnights rolled over", sim.Display.HistoryUpdates == 3)
+        Expect("History holds each day's max/min", history == [expected[day] for day in days])
+        Expect("Daily rows written to the store", [row[1:] for row in sim.Store.DailyHistory(6, days[-1] + datetime.timedelta(days=1))] == history)
+        Expect("A ThingSpeak upload per minute", abs(len(sim.Upload.Submissions) - 3 * 1440) <= 1)
+        Expect("Signal at 5 bars, no packets lost", signal == 5 and station.Primary.Link.Lost == 0)
+        index = station.Primary.Index
+        days = [(low, high) for when, count, low, high, mean in index.Range("temp_out", start, start + 3 * 86400, 3)[1]]
+        Expect("Index days hold each day's max/min", len(days) == 3 and all(abs(high - day[0]) < 1e-4 and abs(low - day[1]) < 1e-4 for (low, high), day in zip(days, history)))
+        level, times, temps = index.Series("temp_out", start, start + 3 * 86400, 400)
+        trace = station.HistoryTrace(station.Primary, start + 3 * 86400 + 60)
+        Expect("3 days charted at 400 points from 10 minutes", level == "10min" and len(times) == 400 and times[-1] >= start + 3 * 86400 - 600 and len(trace[0]) == 400)
+
+        # The same packets imported from a capture file, and the store exported and imported again
+        capture = os.path.join(workdir, "capture.txt")
+        recorder = PacketRecorder(capture)
+        for when, payload, pipe in packets:
+                recorder.Write(when, payload, pipe)
+        recorder.Close()
+        keep = int((time.time() - start) / 86400) + 2				# Nothing pruned for being years old
+        History.Import(capture, "capture", os.path.join(workdir, "imported.db"), workers=2, rawdays=keep)
+        daily = "SELECT day, samples, temp_out_max, temp_out_min, pressure_avg, rain, wind_gust_max FROM daily ORDER BY day"
+        imported = SampleStore(os.path.join(workdir, "imported.db"), rawdays=keep)
+        Expect("Imported capture rolls up as received", imported.Db.execute(daily).fetchall() == sim.Store.Db.execute(daily).fetchall())
+        History.Export("samples", "csv", 0, math.inf, os.path.join(workdir, "imported.db"), None, os.path.join(workdir, "samples.csv"))
+        again = History.Import(os.path.join(workdir, "samples.csv"), "csv", os.path.join(workdir, "imported.db"), rawdays=keep)
+        Expect("CSV export imports back as duplicates", again.Added == 0 and again.Duplicates == len(packets))
+
+        # A link that loses one packet in ten, then goes quiet
+        importlib.reload(station)
+        sim = Simulator(start, os.path.join(workdir, "lossy.db"))
+        lossy = [packet for packet in packets if packet[0] < start + 6 * 3600]
+        sim.Replay(lossy, drop=0.1)
+        link = sim.Station.Primary.Link
+        lost = set(sim.Dropped)
+        received = [when for when, payload, pipe in lossy if ParsePayload(payload).Kind == KIND_WEATHER and (when, payload, pipe) not in lost]
+        dropped = [when for when, payload, pipe in sim.Dropped if ParsePayload(payload).Kind == KIND_WEATHER and received[0] < when < received[-1]]
+        Expect("Every dropped weather packet counted lost", link.Lost == len(dropped))
+        Expect("Lost packets recorded in the store", sim.Store.Db.execute("SELECT TOTAL(lost) FROM samples").fetchone()[0] == len(dropped))
+        Expect("Signal below 5 bars at %.0f%% loss" % (100 * link.LongLoss()), 0 < sim.Display.Signal < 5 and 0.05 < link.LongLoss() < 0.15)
+        sim.RunUntil(lossy[-1][0] + 30)
+        Expect("Signal at 0 bars once the link goes quiet", sim.Display.Signal == 0)
+
+        # Protocol v2 frames on the same receive path, one lossy and one failing its CRC, then an old sketch
+        importlib.reload(station)
+        sim = Simulator(start, os.path.join(workdir, "v2.db"))
+        frames = list(GenerateCapture(start, 0.25, cadence=10.04, protocol=PROTOCOL_V2))
+        sim.Replay(frames, drop=0.1)
+        link = sim.Station.Primary.Link
+        dropped = [when for when, payload, pipe in sim.Dropped if ParsePayload(payload).Kind == KIND_WEATHER and link.Last is not None and frames[0][0] < when < link.Last]
+        Expect("v2 frames decoded", sim.Station.Frames[PROTOCOL_V2].Value > 0 and sim.Station.Primary.HumidOut != int(sim.Station.Primary.HumidOut))
+        Expect("v2 sequence counts every lost frame", link.Lost == len(dropped) and link.Sequence is not None)
+        stored = sim.Store.Db.execute("SELECT MAX(gust_peak), COUNT(gust_peak) FROM samples").fetchone()
+        peaks = [max(ParsePayload(payload).Gusts) for when, payload, pipe in frames if ParsePayload(payload).Kind == KIND_WEATHER and (when, payload, pipe) not in sim.Dropped]
+        day = sim.Station.Primary.Stats.Stats("day", "gust_peak")
+        Expect("v2 gust samples aggregated and stored", stored == (max(peaks), len(peaks)) and day.Count == 5 * len(peaks) and day.Max == max(peaks))
+        received = sim.Station.Primary.Packets
+        sim.Replay([(frames[-1][0] + 5, WeatherPayloadV2(30.0, 50, 1000, 0.0, 0.0, 1, 2, 90, station=2, sequence=9999), 1)])
+        Expect("v2 frame for another pipe dropped", sim.Station.Primary.Packets == received and sim.Station.ParseFailures["station"].Value == 1)
+        Expect("ACK payloads offer v2", len(sim.Radio.AcksSent) > 0 and all(payload.endswith(b" V2") for pipe, payload in sim.Radio.AcksSent))
+        corrupt = bytearray(frames[-2][1])
+        corrupt[6] ^= 0x10
+        received = sim.Station.Primary.Packets
+        sim.Replay([(frames[-1][0] + 10, bytes(corrupt), 1)])
+        ignored = sim.Station.Primary.Packets == received and sim.Station.Primary.LastReceive < frames[-1][0] + 10 and sim.Store.Db.execute("SELECT COUNT(*) FROM samples WHERE kind = '?'").fetchone()[0] == 0
+        sim.Replay([(frames[-1][0] + 20, WeatherPayload(30.0, 50, 1000, 0.0, 0.0, 1, 2, 90), 1)])
+        Expect("Corrupt v2 frame rejected, ASCII still taken", ignored and sim.Station.ParseFailures["crc"].Value == 1 and sim.Station.Primary.TempOut == 30.0)
+
+        # Pressure wave (3 day period) rises through day 0 and falls through day 1
+        for hour, trend in ((start + 6 * 3600, 1), (start + 36 * 3600, -1)):
+                importlib.reload(station)
+                sim = Simulator(start, os.path.join(workdir, "trend%d.db" % trend))
+                sim.Replay(packet for packet in packets if packet[0] < hour + 1800)
+                Expect("Pressure trend %+d at %s" % (trend, datetime.datetime.fromtimestamp(hour + 1800).strftime("%d %H:%M")), sim.Station.PressureTrend() == trend)
+
+        # A restart late morning: from the last periodic checkpoint, from the store when the checkpoint is
+        # corrupt, and not at all once the checkpoint is from yesterday
+        importlib.reload(station)
+        checkpoint = os.path.join(workdir, "Checkpoint.dat")
+        sim = Simulator(start, os.path.join(workdir, "restart.db"), checkpoint=checkpoint, index=os.path.join(workdir, "RestartIndex"))
+        sim.Replay(packet for packet in packets if packet[0] < start + 35.5 * 3600)
+        before = (sim.Station.TodayRange('temp_out'), sim.Station.PressureTrend())
+        restart = sim.Clock.Now + 60
+        path = StationFile(checkpoint, 1)
+        with open(path, 'rb') as saved:
+                good = saved.read()
+        for source, data in (("checkpoint", good), ("store", good[:100] + b"\xff\xff" + good[102:])):
+                with open(path, 'wb') as saved:
+                        saved.write(data)
+                importlib.reload(station)
+                sim = Simulator(restart, os.path.join(workdir, "restart.db"), checkpoint=checkpoint, index=os.path.join(workdir, "RestartIndex"))
+                after = (sim.Station.TodayRange('temp_out'), sim.Station.PressureTrend())
+                Expect("Restart restores the day from the %s" % source, sim.Station.Restored[1][0] == source and after == before)
+        minutes = sim.Store.Db.execute("SELECT COUNT(DISTINCT CAST(time / 60 AS INTEGER)) FROM samples WHERE kind IN ('T', 't') AND time < ?", (restart // 60 * 60,)).fetchone()[0]
+        Expect("Index caught up after the restarts", len(sim.Stations[0].Index.Levels[0]) == minutes)
+        with open(path, 'wb') as saved:
+                saved.write(good)
+        importlib.reload(station)
+        sim = Simulator(start + 49 * 3600, os.path.join(workdir, "restart.db"), checkpoint=checkpoint)
+        Expect("Yesterday's checkpoint discarded", sim.Station.Restored[1] == ("store", 0, "stale") and sim.Station.TodayRange('temp_out') is None)
+
+        importlib.reload(station)							# Fresh globals, as after a power cycle
+        sim = Simulator(start + 3 * 86400 + 120, dbpath)
+        Expect("History read back after a restart", list(zip(sim.Station.Primary.HistoryMax.Values()[-3:], sim.Station.Primary.HistoryMin.Values()[-3:])) == history)
+
+        print("Replayed %d packets (3 days) in %.1fs, %.0fx real time" % (len(packets), elapsed, 3 * 86400 / elapsed))
+        return 1 if failures else 0
+
+
+#------------------------------------------------------------------------------------
+# Startup benchmark: cold starts of WeatherStation.py --simulate --profile-startup
+#------------------------------------------------------------------------------------
+
+def StartupBenchmark(runs):
+        import subprocess
+        import statistics
+        workdir = tempfile.mkdtemp()
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "WeatherStation.py")
+        command = [sys.executable, script, "--simulate", "--profile-startup", "--db", os.path.join(workdir, "WeatherStation.db"), "--socket", os.path.join(workdir, "WeatherStation.sock")]
+        if not os.environ.get("DISPLAY"):
+                command.append("--headless")				# No X server, so no GUI build phase
+        phases = {}
+        wall = []
+        for run in range(runs):
+                started = time.perf_counter()
+                result = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+                wall.append(time.perf_counter() - started)
+                if result.returncode != 0:
+                        print("Station failed to start")
+                        return 1
+                for line in result.stdout.splitlines():
+                        name, milliseconds, unit = line.rsplit(None, 2)
+                        phases.setdefault(name, []).append(float(milliseconds))
+        print("%-14s %10s %10s" % ("phase", "median ms", "max ms"))
+        for name, times in phases.items():
+                print("%-14s %10.1f %10.1f" % (name, statistics.median(times), max(times)))
+        print("%-14s %10.1f %10.1f" % ("process", statistics.median(wall) * 1000, max(wall) * 1000))
+        return 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station record/replay simulator")
+        parser.add_argument("--generate", metavar="FILE", help="write a synthetic capture to FILE")
+        parser.add_argument("--days", type=float, default=3, help="days of synthetic capture to generate")
+        parser.add_argument("--protocol", type=int, choices=(PROTOCOL_ASCII, PROTOCOL_V2), default=PROTOCOL_ASCII, help="payload format of the synthetic capture, 2 = binary v2")
+        parser.add_argument("--replay", metavar="FILE", help="replay a capture through the receive path")
+        parser.add_argument("--speed", type=float, default=0, help="replay speed, 1 = real time, 0 = as fast as possible")
+        parser.add_argument("--db", default=None, help="sample store for the replay (default: a temporary file)")
+        parser.add_argument("--check", action="store_true", help="run the deterministic rollover/trend/persistence checks")
+        parser.add_argument("--startup-benchmark", type=int, default=0, metavar="N", help="time N cold starts of the station with the hardware simulated")
+        args = parser.parse_args()
+        if args.generate:
+                recorder = PacketRecorder(args.generate)
+                start = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+                for when, payload, pipe in GenerateCapture(start, args.days, protocol=args.protocol):
+                        recorder.Write(when, payload, pipe)
+                recorder.Close()
+        elif args.replay:
+                packets = list(ReadCapture(args.replay))
+                if not packets:
+                        sys.exit("No packets in " + args.replay)
+                sim = Simulator(packets[0][0], args.db or os.path.join(tempfile.mkdtemp(), "WeatherStation.db"), speed=args.speed)
+                started = time.perf_counter()
+                count = sim.Replay(packets)
+                print("Replayed %d packets covering %.1f hours in %.1fs" % (count, (packets[-1][0] - packets[0][0]) / 3600, time.perf_counter() - started))
+                print("Display updates %d, history redraws %d, uploads %d" % (sim.Display.DisplayUpdates, sim.Display.HistoryUpdates, len(sim.Upload.Submissions)))
+        elif args.check:
+                sys.exit(Check())
+        elif args.startup_benchmark:
+                sys.exit(StartupBenchmark(args.startup_benchmark))
+        else:
+                parser.print_help()
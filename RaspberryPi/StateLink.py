@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+# Link between a headless Weather Station and a separate GUI process
+#
+# WeatherStation.py --headless runs acquisition, storage and upload only, and hands a
+# StateServer to Initialise() in place of the Tk Display. Every display update is published
+# as one JSON line on a Unix socket:
+#       {"event": "display", "data": <Snapshot()>}
+#       {"event": "history", "data": <Snapshot()>}
+#       {"event": "signal", "data": 0..5}
+# WeatherStation.py --attach is the GUI: a StateClient reads those lines and the Tk loop
+# feeds them to Display.
+#
+# Each subscriber has its own sender thread and only the latest message of each event is
+# kept for it, so a slow or stalled GUI drops intermediate states instead of delaying the
+# radio. A subscriber that connects gets the latest state straight away.
+
+import json
+import queue
+import socket
+import threading
+import time
+import os
+
+
+class Subscriber():
+
+        def __init__(self, connection, pending):
+                self.Connection = connection
+                self.Pending = dict(pending)				# event -> encoded line, newest only
+                self.Ready = threading.Condition()
+                self.Open = True
+
+        def Offer(self, event, line):
+                with self.Ready:
+                        self.Pending[event] = line
+                        self.Ready.notify()
+
+        def Run(self):
+                while self.Open:
+                        with self.Ready:
+                                while self.Open and not self.Pending:
+                                        self.Ready.wait()
+                                lines = list(self.Pending.values())
+                                self.Pending.clear()
+                        try:
+                                self.Connection.sendall(b"".join(lines))
+                        except OSError:
+                                self.Close()
+
+        def Close(self):
+                with self.Ready:
+                        self.Open = False
+                        self.Ready.notify()
+                self.Connection.close()
+
+
+# Stands in for the Display in the headless station, publishing what it would have shown
+class StateServer():
+
+        def __init__(self, path="WeatherStation.sock"):
+                self.Path = path
+                self.Latest = {}
+                self.Subscribers = []
+                self.Lock = threading.Lock()
+                self.Signal = None
+                if os.path.exists(path):
+                        os.unlink(path)					# Left behind by a station that did not shut down cleanly
+                self.Listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.Listener.bind(path)
+                self.Listener.listen(4)
+                self.Thread = threading.Thread(target=self.Accept, name="StateServer", daemon=True)
+                self.Thread.start()
+
+        def Accept(self):
+                while True:
+                        try:
+                                connection, address = self.Listener.accept()
+                        except OSError:
+                                return					# Listener closed
+                        with self.Lock:
+                                subscriber = Subscriber(connection, self.Latest)
+                                self.Subscribers.append(subscriber)
+                        threading.Thread(target=subscriber.Run, name="StateSubscriber", daemon=True).start()
+
+# Function to send an event to every subscriber without waiting for any of them
+        def Publish(self, event, data):
+                line = (json.dumps({"event": event, "data": data}) + "\n").encode('utf-8')
+                with self.Lock:
+                        self.Latest[event] = line
+                        self.Subscribers = [subscriber for subscriber in self.Subscribers if subscriber.Open]
+                        for subscriber in self.Subscribers:
+                                subscriber.Offer(event, line)
+
+        def UpdateDisplay(self, State):
+                self.Publish("display", State)
+
+        def UpdateTempHistory(self, State):
+                self.Publish("history", State)
+
+        def UpdateSignal(self, SignalLevel):
+                if SignalLevel != self.Signal:				# Called for every packet, only changes are worth sending
+                        self.Signal = SignalLevel
+                        self.Publish("signal", SignalLevel)
+
+        def Close(self):
+                self.Listener.close()
+                with self.Lock:
+                        for subscriber in self.Subscribers:
+                                subscriber.Close()
+                if os.path.exists(self.Path):
+                        os.unlink(self.Path)
+
+
+# GUI side: keeps connecting to the station and queues the (event, data) it publishes
+class StateClient():
+
+        def __init__(self, path="WeatherStation.sock", retry=2.0):
+                self.Path = path
+                self.Retry = retry
+                self.Messages = queue.Queue()
+                self.Running = False
+                self.Thread = None
+
+        def Start(self):
+                self.Running = True
+                self.Thread = threading.Thread(target=self.Run, name="StateClient", daemon=True)
+                self.Thread.start()
+
+        def Stop(self):
+                self.Running = False
+
+        def Run(self):
+                while self.Running:
+                        try:
+                                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                                connection.connect(self.Path)
+                        except OSError:
+                                connection.close()
+                                time.sleep(self.Retry)			# Station not started yet
+                                continue
+                        with connection, connection.makefile('rb') as lines:
+                                for line in lines:
+                                        try:
+                                                message = json.loads(line)
+                                        except ValueError:
+                                                continue
+                                        self.Messages.put((message["event"], message["data"]))
+                                        if not self.Running:
+                                                break
+                        self.Messages.put(("signal", 0))			# Lost the station, show no signal until it is back
+
+# Function to get every message received since the last call, oldest first
+        def GetMessages(self):
+                messages = []
+                while True:
+                        try:
+                                messages.append(self.Messages.get_nowait())
+                        except queue.Empty:
+                                return messages
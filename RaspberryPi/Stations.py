@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+# Per-station state for a receiver listening to several WeatherStation.ino transmitters
+#
+# The nRF24 receives on up to five data pipes (1-5), one transmitter each. Pipe 1 listens on
+# ReadPipe, the address in WeatherStation.ino. Pipes 2-5 must share its upper four bytes and
+# differ only in the last one, so a second sensor head runs the same sketch with WritePipe
+# ending 7D, a third 7E and so on (see PipeAddress).
+#
+# Every station has its own latest readings, day history, aggregator, sample store file,
+# archive and uploader, and the receiver picks the station from the pipe radio.available_pipe() reports.
+# The first configured station is the one the display shows.
+#
+# A station's memory is fixed when it is built: the last six days' max/min and the last 24 h of
+# weather packets are ring buffers of typed arrays, so a new day or packet overwrites the oldest
+# in place. The receive loop updates a station under its lock, and other threads (the web API)
+# read it through Snapshot() and RecentSamples(), which copy under the same lock.
+#
+# Run this file directly to benchmark throughput with interleaved packets from every pipe:
+#       python3 Stations.py --benchmark --stations 5
+
+import os
+import time
+import sys
+import array
+import bisect
+import threading
+import argparse
+from Aggregator import StreamingAggregator
+from LinkQuality import LinkEstimator
+
+PIPES = (1, 2, 3, 4, 5)
+HISTORY_DAYS = 6							# Days of max/min on the display's chart
+RECENT_PACKETS = 24 * 3600 // 10					# 24 h of weather packets, one every 10 s
+NAN = float('nan')
+RECENT_FIELDS = ("temp_out", "humid_out", "pressure", "rain", "rain_hour", "wind_speed", "wind_gust", "wind_dir", "temp_in", "humid_in")
+
+
+# Address of a data pipe: pipes 2-5 take pipe 1's address with the last byte counted up
+def PipeAddress(base, pipe):
+        return (base & ~0xFF) | ((base + pipe - 1) & 0xFF)
+
+
+# Per-station file name: pipe 1 keeps the original name, so an existing store and backlog carry on
+def StationFile(path, pipe):
+        if pipe == 1:
+                return path
+        root, extension = os.path.splitext(path)
+        return "%s-%d%s" % (root, pipe, extension)
+
+
+# Fixed size array of the last len(Data) values, appending overwrites the oldest
+class RingBuffer():
+        __slots__ = ("Data", "Next", "Count")
+
+        def __init__(self, typecode, size, fill=0, full=False):
+                self.Data = array.array(typecode, [fill]) * size
+                self.Next = 0
+                self.Count = size if full else 0
+
+        def __len__(self):
+                return self.Count
+
+        def Append(self, value):
+                self.Data[self.Next] = value
+                self.Next += 1
+                if self.Next == len(self.Data):
+                        self.Next = 0
+                if self.Count < len(self.Data):
+                        self.Count += 1
+
+# Function to append many values, in at most two slice copies however many there are
+        def Extend(self, values):
+                size = len(self.Data)
+                values = array.array(self.Data.typecode, values)
+                if len(values) > size:
+                        self.Next = (self.Next + len(values) - size) % size
+                        values = values[-size:]
+                first = min(len(values), size - self.Next)
+                self.Data[self.Next:self.Next + first] = values[:first]
+                self.Data[:len(values) - first] = values[first:]
+                self.Next = (self.Next + len(values)) % size
+                self.Count = min(self.Count + len(values), size)
+
+# Function to get the values as a list, oldest first
+        def Values(self):
+                start = self.Next - self.Count
+                if start >= 0:
+                        return self.Data[start:self.Next].tolist()
+                return self.Data[start:].tolist() + self.Data[:self.Next].tolist()
+
+# Function to get the newest count values as a list, oldest first
+        def Last(self, count):
+                count = min(count, self.Count)
+                start = self.Next - count
+                if start >= 0:
+                        return self.Data[start:self.Next].tolist()
+                return self.Data[start:].tolist() + self.Data[:self.Next].tolist()
+
+        def Bytes(self):
+                return sys.getsizeof(self.Data)
+
+
+# The last size weather packets: receive time and RECENT_FIELDS, NaN for a field that did not parse
+class SampleRing():
+        __slots__ = ("Times", "Columns")
+
+        def __init__(self, size):
+                self.Times = RingBuffer('d', size)
+                self.Columns = tuple(RingBuffer('f', size) for name in RECENT_FIELDS)
+
+        def __len__(self):
+                return len(self.Times)
+
+        def Append(self, when, values):
+                self.Times.Append(when)
+                for name, column in zip(RECENT_FIELDS, self.Columns):
+                        column.Append(values.get(name, NAN))
+
+# Function to append many samples at once, columns in RECENT_FIELDS order with NaN for a missing value
+        def Extend(self, times, columns):
+                self.Times.Extend(times)
+                for values, column in zip(columns, self.Columns):
+                        column.Extend(values)
+
+# Function to copy the samples received at or after since, returns (times, [values per RECENT_FIELDS])
+        def Since(self, since):
+                times = self.Times.Values()
+                count = len(times) - bisect.bisect_left(times, since)
+                return times[len(times) - count:], [column.Last(count) for column in self.Columns]
+
+        def Bytes(self):
+                return self.Times.Bytes() + sum(column.Bytes() for column in self.Columns)
+
+
+class StationState():
+        __slots__ = ("Pipe", "Name", "Store", "Upload", "ArchivePath", "Archive", "CheckpointPath", "IndexPath", "Index", "Stats", "Lock",
+                     "TempOut", "HumidOut", "TempIn", "HumidIn", "Pressure", "Rain", "RainHour", "WindSpeed", "WindGust", "WindDir", "GustPeak", "Battery",
+                     "HistoryMax", "HistoryMin", "Samples", "Link", "LastReceive", "Packets", "SignalLost", "SignalLosses")
+
+        def __init__(self, pipe, name, store, upload, archive=None, checkpoint=None, index=None):
+                self.Pipe = pipe
+                self.Name = name
+                self.Store = store
+                self.Upload = upload
+                self.ArchivePath = archive						# Per minute column archive the day is added to at midnight, see Analytics.py
+                self.Archive = None
+                self.CheckpointPath = checkpoint					# Where the live state is saved every few minutes, see Checkpoint.py
+                self.IndexPath = index						# Multi-resolution history for the charts, opened by the station at start up, see HistoryIndex.py
+                self.Index = None
+                self.Stats = StreamingAggregator()				# Running min/max/mean/percentiles per minute, hour, day and month
+                self.Lock = threading.Lock()					# Held by the receive loop while it updates the readings
+                self.TempOut = 0
+                self.HumidOut = 0
+                self.TempIn = 0							# From the receiver's own DHT22 when the station's last packet came, None if it had nothing recent
+                self.HumidIn = 0
+                self.Pressure = 0
+                self.Rain = 0
+                self.RainHour = 0
+                self.WindSpeed = 0
+                self.WindGust = 0
+                self.WindDir = 0
+                self.GustPeak = 0						# Peak of the last v2 frame's gust samples
+                self.Battery = 0
+                # History of the last six days max/min, oldest first. Start with something that is
+                # displayable on the chart until the history is read from the sample store
+                self.HistoryMax = RingBuffer('d', HISTORY_DAYS, 1, full=True)
+                self.HistoryMin = RingBuffer('d', HISTORY_DAYS, -1, full=True)
+                self.Samples = SampleRing(RECENT_PACKETS)
+                self.Link = LinkEstimator()					# Packet loss and RPD, for the signal icon and the store
+                self.LastReceive = None
+                self.Packets = 0
+                self.SignalLost = False						# Nothing heard for longer than the signal timeout
+                self.SignalLosses = 0
+
+# Function to add a day's max/min to the history, dropping the oldest
+        def AddDay(self, tempmax, tempmin):
+                with self.Lock:
+                        self.HistoryMax.Append(tempmax)
+                        self.HistoryMin.Append(tempmin)
+
+# Function to copy the latest readings and the day history, for any thread
+        def Snapshot(self):
+                with self.Lock:
+                        return {"station": self.Name,
+                                "pipe": self.Pipe,
+                                "temp_out": self.TempOut,
+                                "humid_out": self.HumidOut,
+                                "temp_in": self.TempIn,
+                                "humid_in": self.HumidIn,
+                                "pressure": self.Pressure,
+                                "rain": self.Rain,
+                                "rain_hour": self.RainHour,
+                                "wind_speed": self.WindSpeed,
+                                "wind_gust": self.WindGust,
+                                "wind_dir": self.WindDir,
+                                "gust_peak": self.GustPeak,
+                                "battery": self.Battery,
+                                "history_max": self.HistoryMax.Values(),
+                                "history_min": self.HistoryMin.Values()}
+
+# Function to copy the weather packets received at or after since, for any thread. Returns (columns, rows)
+        def RecentSamples(self, since):
+                with self.Lock:
+                        times, columns = self.Samples.Since(since)
+                rows = [[when] + [None if value != value else round(value, 3) for value in row] for when, row in zip(times, zip(*columns))]	# float32 back to the reading
+                return ("time",) + RECENT_FIELDS, rows
+
+# Bytes held by the ring buffers, the same from the first packet on
+        def Footprint(self):
+                return self.HistoryMax.Bytes() + self.HistoryMin.Bytes() + self.Samples.Bytes()
+
+
+#------------------------------------------------------------------------------------
+# Throughput benchmark: interleaved packets from every pipe through the receive path
+#------------------------------------------------------------------------------------
+
+def Benchmark(count, hours):
+        import tempfile
+        import datetime
+        from Simulation import Simulator, GenerateCapture
+        start = datetime.datetime(2021, 6, 1).timestamp()
+        pipes = PIPES[:count]
+        packets = []
+        for pipe in pipes:							# Each Arduino on its own phase of the 10 s cycle
+                packets.extend(GenerateCapture(start + 2.0 * pipe, hours / 24, pipe=pipe))
+        packets.sort(key=lambda packet: packet[0])
+        sim = Simulator(start, os.path.join(tempfile.mkdtemp(), "WeatherStation.db"), pipes=pipes)
+        footprints = [station.Footprint() for station in sim.Stations]
+        started = time.perf_counter()
+        sim.Replay(packets)
+        elapsed = time.perf_counter() - started
+        radio = sim.Radio
+        print("%d stations, %d packets in %.2fs: %.0f packets/s, %.0f us/packet" % (count, len(packets), elapsed, len(packets) / elapsed, elapsed / len(packets) * 1e6))
+        print("SPI transactions %.1f/packet, ACK writes %d, ACKs sent with a packet %d, packets without an ACK %d" % (radio.SpiTransactions / len(packets), sim.Station.Acks.Writes, len(radio.AcksSent), len(packets) - len(radio.AcksSent)))
+        failures = 0
+        for station, footprint in zip(sim.Stations, footprints):
+                stored = station.Store.Db.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+                expected = sum(1 for packet in packets if packet[2] == station.Pipe)
+                ok = stored == expected == station.Packets and station.Footprint() == footprint
+                failures += not ok
+                print("  pipe %d %-10s %6d packets, %6d stored, %5d uploads, %d of %d recent kept in %d KB  %s" % (station.Pipe, station.Name, station.Packets, stored, len(station.Upload.Submissions),
+                                                                                                       len(station.Samples), RECENT_PACKETS, station.Footprint() // 1024, "OK" if ok else "FAIL"))
+        return 1 if failures else 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station multi-station receiver")
+        parser.add_argument("--benchmark", action="store_true", help="replay interleaved packets from several simulated transmitters")
+        parser.add_argument("--stations", type=int, default=5, choices=range(1, 6), help="number of transmitters, one per pipe")
+        parser.add_argument("--hours", type=float, default=6, help="hours of packets from each transmitter")
+        args = parser.parse_args()
+        if not args.benchmark:
+                parser.print_help()
+                sys.exit(0)
+        sys.exit(Benchmark(args.stations, args.hours))
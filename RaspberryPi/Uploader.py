@@ -0,0 +1,690 @@
+#!/usr/bin/python3
+
+# Background upload sinks for the Weather Station
+#
+# Every destination is a sink with its own worker thread, bounded queue, batching, rate limit
+# and backoff, so a slow or dead uplink never holds up the display, the radio or another sink.
+# A station hands its readings to an UploadFanOut, which only appends them to the queues of the
+# sinks that want them: the means of every minute (ThingSpeak, InfluxDB, CSV by default) or
+# every weather packet (MQTT by default).
+#
+#       ThingSpeakUploader - ThingSpeak update/bulk_update, at most one request per 15s
+#       MqttSink           - JSON message per sample to an MQTT 3.1.1 broker, QoS 1
+#       InfluxSink         - InfluxDB line protocol over HTTP, /write (1.x) or /api/v2/write
+#       CsvSink            - one CSV file per local day, the oldest deleted past keep days
+#
+# Anything a sink with a backlog file cannot send is kept on disk and retried with an
+# exponential backoff that new samples do not cut short. A batch the destination refuses
+# outright (a 4xx reply other than 408 or 429) is not retried: it is halved until the samples
+# it will not take are found, and those are dropped and counted as rejected. Once the link
+# is back ThingSpeak's backlog goes out through bulk_update (needs the channel ID), or one
+# update at a time with created_at if no channel ID is configured.
+#
+# The sinks are configured in Sinks.ini (start from Sinks.ini.example), one section per sink
+# named by its kind, optionally with a label and the pipe of the only station that feeds it:
+# [thingspeak:1], [mqtt], [csv.backup]. The keys are the constructor arguments below.
+#
+# Run this file directly to exercise every sink against local stand-in servers, ThingSpeak's
+# slow and failing at first:
+#       python3 Uploader.py --demo
+
+import threading
+import collections
+import itertools
+import urllib.parse
+import datetime
+import json
+import time
+import os
+import sys
+import argparse
+
+BULK_LIMIT = 960							# Most updates ThingSpeak accepts in one bulk_update
+MINUTE_FEED = "minute"
+PACKET_FEED = "packet"
+REJECTED = "rejected"							# Deliver's answer for a batch no retry will get accepted
+
+# Readings a sink is given, in ThingSpeak's field1..field8 order
+FIELDS = ("temp_out", "humid_out", "pressure", "wind_speed", "wind_gust", "wind_dir", "rain", "rain_hour")
+
+
+class UploadSink():
+
+        def __init__(self, name, feed=MINUTE_FEED, backlogfile=None, maxbacklog=10000, batch=1, mininterval=0, linger=0, minbackoff=5, maxbackoff=600, timer=None):
+                self.Name = name
+                self.Feed = feed						# MINUTE_FEED or PACKET_FEED
+                self.BackupFile = backlogfile					# None keeps unsent samples in memory only
+                self.BatchLimit = batch						# Most samples in one request
+                self.MinInterval = mininterval					# Least time between the starts of two requests
+                self.Linger = linger						# Time a sample waits for others to go with it
+                self.MinBackoff = minbackoff
+                self.MaxBackoff = maxbackoff
+                self.Backoff = 0
+                self.RetryAt = 0						# time.monotonic() before which a failed send is not retried
+                self.LastSend = -mininterval
+                self.Lock = threading.Lock()
+                self.Wakeup = threading.Event()
+                self.Stopping = threading.Event()
+                self.Pending = collections.deque(maxlen=maxbacklog)		# Oldest samples drop off when full
+                self.BacklogOnDisk = False
+                self.Changes = 0						# Samples added to or taken off Pending
+                self.SavedChanges = 0						# Changes when the backlog file was last written
+                self.Thread = None
+                self.Sent = 0
+                self.Failed = 0
+                self.Dropped = 0
+                self.Rejected = 0
+                self.Split = 0							# Batch size while looking for samples the destination refuses
+                self.LastLatency = 0.0
+                self.TotalLatency = 0.0
+                self.Requests = 0
+                self.Timer = timer							# Called with each request's latency in seconds, e.g. Histogram.Observe
+                self.LoadBacklog()
+
+# Function for the packet handler to queue one sample: a dict of readings, see FIELDS
+        def Submit(self, station, values, when=None):
+                if when is None:
+                        when = time.time()
+                sample = dict(values, time=when, station=station)
+                with self.Lock:
+                        if len(self.Pending) == self.Pending.maxlen:
+                                self.Dropped += 1
+                        self.Pending.append(sample)
+                        self.Changes += 1
+                self.Wakeup.set()
+
+        def Start(self):
+                if self.Thread is None:						# Sinks shared by several stations are started by each
+                        self.Thread = threading.Thread(target=self.Run, name=self.Name, daemon=True)
+                        self.Thread.start()
+
+        def Stop(self):
+                self.Stopping.set()
+                self.Wakeup.set()
+                if self.Thread is not None:
+                        self.Thread.join()
+                with self.Lock:
+                        batch = list(self.Pending)
+                if batch and self.BackupFile is None:				# Nowhere to keep them, so one last try
+                        accepted = self.Send(batch)
+                        if accepted:
+                                self.Pending.clear()
+                        if accepted is REJECTED:
+                                self.Reject(batch)
+                with self.Lock:
+                        if len(self.Pending) > 0:
+                                self.SaveBacklog()
+                self.Close()
+
+        def Metrics(self):
+                with self.Lock:
+                        depth = len(self.Pending)
+                return {"queue_depth": depth,
+                        "sent": self.Sent,
+                        "failed": self.Failed,
+                        "dropped": self.Dropped,
+                        "rejected": self.Rejected,
+                        "backoff": self.Backoff,
+                        "last_latency": self.LastLatency,
+                        "mean_latency": self.TotalLatency / self.Requests if self.Requests else 0.0}
+
+        def Run(self):
+                while not self.Stopping.is_set():
+                        wait = self.RetryAt - time.monotonic()
+                        if wait > 0:
+                                self.Stopping.wait(wait)			# New samples do not bring the retry forward
+                                continue
+                        if not self.Backoff:
+                                self.Wakeup.wait()
+                        self.Wakeup.clear()
+                        if self.Linger and len(self.Pending) < self.BatchLimit:
+                                self.Stopping.wait(self.Linger)
+                        while not self.Stopping.is_set():
+                                with self.Lock:
+                                        batch = list(itertools.islice(self.Pending, self.Split or self.BatchLimit))
+                                if not batch:
+                                        break
+                                wait = self.LastSend + self.MinInterval - time.monotonic()
+                                if wait > 0 and self.Stopping.wait(wait):
+                                        break
+                                self.LastSend = time.monotonic()
+                                accepted = self.Send(batch)
+                                if accepted is REJECTED and len(batch) > 1:
+                                        self.Split = len(batch) // 2		# Halve it until the refused samples are on their own
+                                        continue
+                                if accepted:
+                                        with self.Lock:
+                                                for sample in batch:
+                                                        if self.Pending and self.Pending[0] is sample:
+                                                                self.Pending.popleft()
+                                                                self.Changes += 1
+                                                if self.BacklogOnDisk:
+                                                        self.SaveBacklog()
+                                        if accepted is REJECTED:
+                                                self.Reject(batch)
+                                                self.Split = 0
+                                        else:
+                                                self.Sent += len(batch)
+                                        self.Backoff = 0
+                                else:
+                                        self.Failed += 1
+                                        self.Backoff = min(max(self.Backoff * 2, self.MinBackoff), self.MaxBackoff)
+                                        self.RetryAt = time.monotonic() + self.Backoff
+                                        with self.Lock:
+                                                self.SaveBacklog()
+                                        break
+
+# Function to send one batch, returns True if the destination took it, REJECTED if it never will
+        def Send(self, batch):
+                start = time.perf_counter()
+                accepted = self.Deliver(batch)
+                self.LastLatency = time.perf_counter() - start
+                self.TotalLatency += self.LastLatency
+                self.Requests += 1
+                if self.Timer is not None:
+                        self.Timer(self.LastLatency)
+                if not accepted:
+                        print("%s upload fail!" % self.Name)
+                return accepted
+
+        def Reject(self, batch):
+                self.Rejected += len(batch)
+                print("%s upload rejected, dropped %d samples" % (self.Name, len(batch)))
+
+# Function for each kind of sink to send a batch on the worker thread, returns as Send
+        def Deliver(self, batch):
+                raise NotImplementedError
+
+        def Close(self):
+                pass
+
+# Backlog is only written while there is something unsent, so a healthy link costs no SD card writes
+        def SaveBacklog(self):
+                if self.BackupFile is None:
+                        return
+                if len(self.Pending) == 0:
+                        if self.BacklogOnDisk:
+                                os.remove(self.BackupFile)
+                                self.BacklogOnDisk = False
+                        return
+                if self.BacklogOnDisk and self.Changes == self.SavedChanges:
+                        return							# A failed retry of the same samples costs no write
+                tempfile = self.BackupFile + ".tmp"
+                with open(tempfile, 'w') as backlog:
+                        json.dump(list(self.Pending), backlog)
+                os.replace(tempfile, self.BackupFile)
+                self.BacklogOnDisk = True
+                self.SavedChanges = self.Changes
+
+        def LoadBacklog(self):
+                if self.BackupFile is None:
+                        return
+                try:
+                        with open(self.BackupFile) as backlog:
+                                self.Pending.extend(json.load(backlog))
+                        self.BacklogOnDisk = True
+                except (OSError, ValueError):
+                        pass
+
+
+# Sink that sends over one kept-alive HTTP(S) connection to the host of url
+class HttpSink(UploadSink):
+
+        def __init__(self, name, url, timeout=10, **options):
+                parts = urllib.parse.urlsplit(url)
+                self.Secure = (parts.scheme == "https")
+                self.Host = parts.netloc
+                self.Path = parts.path
+                self.Query = parts.query
+                self.Timeout = timeout
+                self.Connection = None
+                UploadSink.__init__(self, name, **options)
+
+# Function to make one request, returns (status, reply body), or (None, None) if the connection failed
+        def Request(self, method, path, body=None, headers={}):
+                import http.client						# Deferred to the sink thread, it is slow to import on a Pi
+                try:
+                        if self.Connection is None:
+                                if self.Secure:
+                                        self.Connection = http.client.HTTPSConnection(self.Host, timeout=self.Timeout)
+                                else:
+                                        self.Connection = http.client.HTTPConnection(self.Host, timeout=self.Timeout)
+                        self.Connection.request(method, path, body, headers)
+                        response = self.Connection.getresponse()
+                        return response.status, response.read()
+                except (OSError, http.client.HTTPException):
+                        self.Close()
+                        return None, None
+
+# Function to tell a reply no retry will change from a busy or broken server
+        def Refused(self, status):
+                return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+        def Close(self):
+                if self.Connection is not None:
+                        self.Connection.close()
+                        self.Connection = None
+
+
+class ThingSpeakUploader(HttpSink):
+
+        def __init__(self, apikey, channel=None, baseurl="https://api.thingspeak.com", backlogfile="UploadBacklog.json", name="thingspeak", mininterval=15, **options):
+                self.ApiKey = apikey
+                self.Channel = channel
+                HttpSink.__init__(self, name, baseurl, backlogfile=backlogfile, batch=BULK_LIMIT if channel else 1, mininterval=mininterval, **options)	# ThingSpeak rejects updates closer than 15s apart
+
+# Function to turn a sample into a ThingSpeak update, with field1..field8 in FIELDS order
+        def Update(self, sample):
+                if "created_at" in sample:
+                        return sample						# Backlog saved before there were other sinks
+                update = {"created_at": datetime.datetime.fromtimestamp(sample["time"], datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
+                for index, name in enumerate(FIELDS):
+                        if sample.get(name) is not None:
+                                update["field%d" % (index+1)] = sample[name]
+                return update
+
+        def Deliver(self, batch):
+                if len(batch) > 1:
+                        status, reply = self.Request("POST", "/channels/%s/bulk_update.json" % self.Channel,
+                                                     json.dumps({"write_api_key": self.ApiKey, "updates": [self.Update(sample) for sample in batch]}),
+                                                     {"Content-Type": "application/json"})
+                else:
+                        status, reply = self.Request("GET", "/update?" + urllib.parse.urlencode(dict(self.Update(batch[0]), api_key=self.ApiKey)))
+                if self.Refused(status):
+                        return REJECTED
+                return (status in (200, 202)) and (reply.strip() not in (b"0", b"-1"))
+
+
+# Line protocol, one line per sample: weather,station=Garden temp_out=12.3,humid_out=55 1622505600
+class InfluxSink(HttpSink):
+
+        def __init__(self, url="http://localhost:8086/write?db=weather", token=None, measurement="weather", name="influx", **options):
+                options.setdefault("batch", 5000)				# InfluxDB's recommended batch size
+                HttpSink.__init__(self, name, url, **options)
+                query = urllib.parse.parse_qs(self.Query)
+                query["precision"] = ["s"]
+                self.Target = self.Path + "?" + urllib.parse.urlencode(query, doseq=True)
+                self.Headers = {"Content-Type": "text/plain; charset=utf-8"}
+                if token:
+                        self.Headers["Authorization"] = "Token %s" % token
+                self.Measurement = measurement
+
+        def Line(self, sample):
+                fields = ",".join("%s=%r" % (name, float(sample[name])) for name in FIELDS + ("temp_in", "humid_in") if sample.get(name) is not None)
+                if not fields:
+                        return None
+                station = str(sample["station"]).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+                return "%s,station=%s %s %d" % (self.Measurement, station, fields, round(sample["time"]))
+
+        def Deliver(self, batch):
+                body = "\n".join(line for line in map(self.Line, batch) if line is not None)
+                if not body:
+                        return True
+                status, reply = self.Request("POST", self.Target, body.encode('utf-8'), self.Headers)
+                if self.Refused(status):
+                        return REJECTED
+                return status in (200, 204)
+
+
+# JSON message per sample on topic (where {station} is replaced by the station name), at QoS 1 so
+# a sample only leaves the queue once the broker has acknowledged it
+class MqttSink(UploadSink):
+
+        def __init__(self, host="localhost", port=1883, topic="weatherstation/{station}", clientid="weatherstation", username=None, password=None, retain=False, timeout=10, name="mqtt", **options):
+                options.setdefault("feed", PACKET_FEED)
+                options.setdefault("batch", 100)
+                options.setdefault("maxbacklog", 1000)
+                UploadSink.__init__(self, name, **options)
+                self.Host = host
+                self.Port = port
+                self.Topic = topic
+                self.ClientId = clientid
+                self.Username = username
+                self.Password = password
+                self.Retain = retain
+                self.Timeout = timeout
+                self.Socket = None
+                self.PacketId = 0
+
+        def Connect(self):
+                import socket
+                self.Socket = socket.create_connection((self.Host, self.Port), timeout=self.Timeout)
+                flags = 0x02							# Clean session
+                payload = MqttString(self.ClientId)
+                if self.Username:
+                        flags |= 0x80
+                        payload += MqttString(self.Username)
+                        if self.Password:
+                                flags |= 0x40
+                                payload += MqttString(self.Password)
+                self.Socket.sendall(MqttPacket(0x10, MqttString("MQTT") + bytes((4, flags, 0, 0)) + payload))	# Level 4 = 3.1.1, no keep alive
+                kind, body = MqttRead(self.Socket)
+                if kind != 0x20 or len(body) != 2 or body[1] != 0:
+                        raise ConnectionRefusedError("MQTT broker refused the connection (%02x %s)" % (kind, body.hex()))
+
+        def Deliver(self, batch):
+                try:
+                        if self.Socket is None:
+                                self.Connect()
+                        waiting = set()
+                        for sample in batch:
+                                self.PacketId = self.PacketId % 0xFFFF + 1
+                                waiting.add(self.PacketId)
+                                message = json.dumps(dict((name, value) for name, value in sample.items() if name != "station" and value is not None)).encode('utf-8')
+                                self.Socket.sendall(MqttPacket(0x32 | self.Retain, MqttString(self.Topic.format(station=sample["station"])) + self.PacketId.to_bytes(2, 'big') + message))
+                        while waiting:
+                                kind, body = MqttRead(self.Socket)
+                                if kind == 0x40:					# PUBACK
+                                        waiting.discard(int.from_bytes(body[:2], 'big'))
+                        return True
+                except (OSError, IndexError, ValueError):			# Lost link or a reply that is not MQTT
+                        self.Close()
+                        return False
+
+        def Close(self):
+                if self.Socket is not None:
+                        try:
+                                self.Socket.sendall(b"\xe0\x00")			# DISCONNECT
+                        except OSError:
+                                pass
+                        self.Socket.close()
+                        self.Socket = None
+
+
+def MqttString(text):
+        data = text.encode('utf-8')
+        return len(data).to_bytes(2, 'big') + data
+
+def MqttPacket(header, body):
+        length = bytearray()
+        remaining = len(body)
+        while True:
+                digit = remaining % 128
+                remaining //= 128
+                length.append(digit | 0x80 if remaining else digit)
+                if not remaining:
+                        return bytes((header,)) + bytes(length) + body
+
+# Function to read one control packet, returns (packet type, variable header and payload)
+def MqttRead(connection):
+        header = MqttReceive(connection, 1)[0]
+        remaining = 0
+        for shift in range(0, 28, 7):
+                digit = MqttReceive(connection, 1)[0]
+                remaining |= (digit & 0x7F) << shift
+                if digit < 0x80:
+                        break
+        return header & 0xF0, MqttReceive(connection, remaining)
+
+def MqttReceive(connection, count):
+        data = b""
+        while len(data) < count:
+                chunk = connection.recv(count - len(data))
+                if not chunk:
+                        raise ConnectionResetError("MQTT connection closed")
+                data += chunk
+        return data
+
+
+# Rolling CSV: path Weather.csv is written as Weather-2021-06-01.csv and so on, by local day of the sample
+class CsvSink(UploadSink):
+
+        def __init__(self, path="Weather.csv", keep=31, name="csv", **options):
+                options.setdefault("batch", 10000)
+                options.setdefault("linger", 60)				# One SD card write a minute however often samples come
+                UploadSink.__init__(self, name, **options)
+                self.Root, self.Extension = os.path.splitext(path)
+                self.Keep = keep
+
+        def Deliver(self, batch):
+                import csv
+                try:
+                        for day, samples in itertools.groupby(batch, lambda sample: time.strftime("%Y-%m-%d", time.localtime(sample["time"]))):
+                                path = "%s-%s%s" % (self.Root, day, self.Extension)
+                                new = not os.path.exists(path)
+                                with open(path, 'a', newline='') as output:
+                                        writer = csv.writer(output)
+                                        if new:
+                                                writer.writerow(("time", "station") + FIELDS)
+                                        for sample in samples:
+                                                writer.writerow([time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(sample["time"])), sample["station"]] + [sample.get(name, "") for name in FIELDS])
+                                if new:
+                                        self.Prune()
+                        return True
+                except OSError:
+                        return False
+
+        def Prune(self):
+                import glob
+                files = sorted(glob.glob(glob.escape(self.Root) + "-????-??-??" + glob.escape(self.Extension)))
+                for old in files[:-self.Keep]:
+                        os.remove(old)
+
+
+# A station's samples to the sinks that want them: Submit() for the means of a minute, Packet() for
+# every weather packet. Appending to a queue is all either does on the caller's thread
+class UploadFanOut():
+
+        def __init__(self, station, sinks):
+                self.Station = station
+                self.Sinks = list(sinks)
+                self.MinuteSinks = [sink for sink in self.Sinks if sink.Feed == MINUTE_FEED]
+                self.PacketSinks = [sink for sink in self.Sinks if sink.Feed == PACKET_FEED]
+
+        def Submit(self, values, when=None):
+                for sink in self.MinuteSinks:
+                        sink.Submit(self.Station, values, when)
+
+        def Packet(self, values, when=None):
+                for sink in self.PacketSinks:
+                        sink.Submit(self.Station, values, when)
+
+        def Start(self):
+                for sink in self.Sinks:
+                        sink.Start()
+
+        def Stop(self):
+                for sink in self.Sinks:
+                        sink.Stop()
+
+
+SINK_KINDS = {"thingspeak": ThingSpeakUploader, "mqtt": MqttSink, "influx": InfluxSink, "csv": CsvSink}
+
+# Function to build the sinks in a Sinks.ini, returns [(pipe, sink)], pipe None for a sink every station feeds
+def ReadSinks(configfile):
+        import configparser
+        from Stations import StationFile
+        config = configparser.ConfigParser(interpolation=None)
+        if not config.read(configfile):
+                print("%s not found, nothing will be uploaded (see Sinks.ini.example)" % configfile, file=sys.stderr)
+        sinks = []
+        for section in config.sections():
+                name, pipe = section.partition(":")[::2]
+                kind = name.partition(".")[0]
+                if kind not in SINK_KINDS:
+                        raise ValueError("%s: unknown sink kind in [%s], expected one of %s" % (configfile, section, ", ".join(sorted(SINK_KINDS))))
+                pipe = int(pipe) if pipe else None
+                options = dict((key, ConfigValue(value)) for key, value in config[section].items())
+                if kind in ("thingspeak", "influx") and "backlogfile" not in options:
+                        if kind == "thingspeak" and pipe is not None:
+                                options["backlogfile"] = StationFile("UploadBacklog.json", pipe)	# Pipe 1 carries on with the original backlog
+                        else:
+                                options["backlogfile"] = "UploadBacklog-%s.json" % section.replace(":", "-")
+                sinks.append((pipe, SINK_KINDS[kind](name=section, **options)))
+        return sinks
+
+def ConfigValue(text):
+        if text == "":
+                return None
+        for convert in (int, float):
+                try:
+                        return convert(text)
+                except ValueError:
+                        pass
+        if text.lower() in ("true", "false"):
+                return text.lower() == "true"
+        return text
+
+
+#------------------------------------------------------------------------------------
+# Local stand-ins for ThingSpeak, InfluxDB and an MQTT broker
+#------------------------------------------------------------------------------------
+
+# Accepts /update and /channels/<id>/bulk_update.json like ThingSpeak does, but fails the
+# first FailCount requests so the backlog and retry path can be watched, and takes delay
+# seconds over every request
+def StandIn(failcount, delay=0):
+        import http.server
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+                protocol_version = "HTTP/1.1"
+                Received = []
+                FailCount = failcount
+
+                def Reply(self, status, text):
+                        time.sleep(delay)
+                        body = text.encode('utf-8')
+                        self.send_response(status)
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+
+                def do_GET(self):
+                        if Handler.FailCount > 0:
+                                Handler.FailCount -= 1
+                                self.Reply(500, "0")
+                                return
+                        Handler.Received.append(dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query)))
+                        self.Reply(200, str(len(Handler.Received)))
+
+                def do_POST(self):
+                        body = self.rfile.read(int(self.headers["Content-Length"]))
+                        if Handler.FailCount > 0:
+                                Handler.FailCount -= 1
+                                self.Reply(500, "0")
+                                return
+                        Handler.Received.extend(json.loads(body)["updates"])
+                        self.Reply(202, '{"success":true}')
+
+                def log_message(self, *args):
+                        pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, Handler
+
+# Takes line protocol on /write like InfluxDB 1.x, keeping the lines
+def InfluxStandIn():
+        import http.server
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+                protocol_version = "HTTP/1.1"
+                Received = []
+
+                def do_POST(self):
+                        body = self.rfile.read(int(self.headers["Content-Length"]))
+                        Handler.Received.extend(body.decode('utf-8').splitlines())
+                        self.send_response(204)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+
+                def log_message(self, *args):
+                        pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, Handler
+
+# Minimal MQTT broker: accepts any CONNECT, acknowledges QoS 1 PUBLISH and keeps (topic, message)
+def MqttStandIn():
+        import socketserver
+
+        class Handler(socketserver.BaseRequestHandler):
+                Received = []
+
+                def handle(self):
+                        try:
+                                while True:
+                                        kind, body = MqttRead(self.request)
+                                        if kind == 0x10:
+                                                self.request.sendall(b"\x20\x02\x00\x00")
+                                        elif kind == 0x30:
+                                                length = int.from_bytes(body[:2], 'big')
+                                                topic = body[2:2 + length].decode('utf-8')
+                                                Handler.Received.append((topic, json.loads(body[4 + length:])))
+                                                self.request.sendall(b"\x40\x02" + body[2 + length:4 + length])
+                                        elif kind == 0xE0:
+                                                return
+                        except OSError:
+                                pass
+
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, Handler
+
+
+# Feeds a station's fan-out a weather packet every step seconds and the minute means every sixth,
+# with ThingSpeak's stand-in slow and failing at first, then times how long each sink took to
+# catch up and what the longest hand-over cost the caller
+def Demo(minutes, failcount, delay, step):
+        import tempfile
+        workdir = tempfile.mkdtemp()
+        thingspeak, thingspeakhandler = StandIn(failcount, delay)
+        influx, influxhandler = InfluxStandIn()
+        broker, brokerhandler = MqttStandIn()
+        sinks = [ThingSpeakUploader("DEMOKEY", channel=12345, baseurl="http://127.0.0.1:%d" % thingspeak.server_port, backlogfile=os.path.join(workdir, "UploadBacklog.json"), mininterval=step * 6, minbackoff=0.2, maxbackoff=1),
+                 MqttSink("127.0.0.1", broker.server_address[1]),
+                 InfluxSink("http://127.0.0.1:%d/write?db=weather" % influx.server_port, linger=step * 3),
+                 CsvSink(os.path.join(workdir, "Weather.csv"), linger=step * 6)]
+        received = {"thingspeak": thingspeakhandler.Received, "mqtt": brokerhandler.Received, "influx": influxhandler.Received, "csv": None}
+        fanout = UploadFanOut("Demo Garden", sinks)
+        fanout.Start()
+        expected = {}
+        slowest = 0
+        started = time.perf_counter()
+        when = time.time() // 60 * 60
+        for packet in range(minutes * 6):
+                values = dict(zip(FIELDS, (20.0 + packet / 100, 55, 1013, 3, 5, 270, 1.2, 0.0)))
+                handover = time.perf_counter()
+                fanout.Packet(values, when + packet * 10)
+                if packet % 6 == 5:
+                        fanout.Submit(values, when + packet * 10 - 50)
+                slowest = max(slowest, time.perf_counter() - handover)
+                time.sleep(step)
+        for sink in sinks:
+                expected[sink.Name] = minutes * 6 if sink.Feed == PACKET_FEED else minutes
+        finished = {}
+        while len(finished) < len(sinks) and time.perf_counter() - started < 60:
+                for sink in sinks:
+                        if sink.Name not in finished and sink.Metrics()["queue_depth"] == 0 and sink.Sent == expected[sink.Name]:
+                                finished[sink.Name] = time.perf_counter() - started
+                time.sleep(0.01)
+        fanout.Stop()
+        for server in (thingspeak, influx, broker):
+                server.shutdown()
+        csvrows = sum(len(open(os.path.join(workdir, name)).readlines()) - 1 for name in os.listdir(workdir) if name.endswith(".csv"))
+        print("Fed %d packets and %d minutes over %.1fs, longest hand-over to the fan-out %.0f us" % (minutes * 6, minutes, minutes * 6 * step, slowest * 1e6))
+        failures = 0
+        for sink in sinks:
+                metrics = sink.Metrics()
+                got = len(received[sink.Name]) if received[sink.Name] is not None else csvrows
+                ok = got == expected[sink.Name]
+                failures += not ok
+                print("  %-10s %-6s %4d of %4d delivered in %5.1fs, %3d requests, %d failed, mean %5.1f ms  %s" % (sink.Name, sink.Feed, got, expected[sink.Name], finished.get(sink.Name, float('nan')),
+                                                                                                                  sink.Requests, metrics["failed"], metrics["mean_latency"] * 1000, "OK" if ok else "FAIL"))
+        return 1 if failures else 0
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station upload sinks")
+        parser.add_argument("--demo", action="store_true", help="upload to local stand-ins for every sink, ThingSpeak's slow and failing the first requests")
+        parser.add_argument("--minutes", type=int, default=10, help="simulated minutes of packets")
+        parser.add_argument("--fail", type=int, default=3, help="number of requests the ThingSpeak stand-in rejects")
+        parser.add_argument("--delay", type=float, default=1.0, help="seconds the ThingSpeak stand-in takes over every request")
+        parser.add_argument("--step", type=float, default=0.05, help="real seconds between simulated packets")
+        args = parser.parse_args()
+        if not args.demo:
+                parser.print_help()
+                sys.exit(0)
+        sys.exit(Demo(args.minutes, args.fail, args.delay, args.step))
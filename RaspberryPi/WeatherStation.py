@@ -1,519 +1,505 @@
 #!/usr/bin/python3
 
-import math
-import threading
-from flask import Flask, render_template
 import time
+StartupClock = time.perf_counter()					# Start of the imports phase for --profile-startup
 import datetime
-from RF24 import *
-import RPi.GPIO as GPIO
-import tkinter as tk
-from pandas import DataFrame
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import configparser
-import Adafruit_DHT
-import urllib
+import bisect
 import os
 import sys
+import argparse
+from RadioReceiver import RadioReceiver, GPIOIrqSource, AckScheduler
+from Uploader import UploadFanOut, ReadSinks
+from DHTSampler import DHTSampler, AdafruitReader
+from PayloadParser import ParsePayload, FIELD_NAMES, PROTOCOL_ASCII, PROTOCOL_V2, KIND_WEATHER, KIND_STATUS, KIND_CORRUPT
+from PayloadParser import VALID_TEMP, VALID_HUMID, VALID_PRESS, VALID_RAIN, VALID_RAINH, VALID_WINDSPEED, VALID_WINDGUST, VALID_WINDDIR, VALID_WEATHER, VALID_BATT, VALID_CLOCK
+from SampleStore import SampleStore
+from Aggregator import MINUTE, HOUR, DAY, MONTH
+from Stations import StationState, PipeAddress, StationFile, HISTORY_DAYS
+from Metrics import Metrics, MetricsServer, MetricsLog, RotatingStream
+from Checkpoint import CheckpointWriter, EncodeCheckpoint, RestoreCheckpoint, CHECKPOINT_INTERVAL
+from HistoryIndex import HistoryIndex, MinuteRecord, POINTS
+# Everything else (tkinter, matplotlib, RF24, RPi.GPIO, Adafruit_DHT) is imported by the function that needs it
+
+# Startup phases and how long each took in seconds, for --profile-startup
+StartupTimes = []
+
+# Function to record the time since the last phase ended as the duration of the named phase
+def StartupPhase(Name):
+        global StartupClock
+        Now = time.perf_counter()
+        StartupTimes.append((Name, Now - StartupClock))
+        StartupClock = Now
+
+StartupPhase("imports")
 
-MyAPI = "6TVY1HJ7Q89CRK66"
 irq_gpio_pin = None
-
-# Class for all display functions
-
-class Display():
-
-        def __init__(self, main):
-                self.Unit = False					# False = metric, True = Imperial
-                self.TempHumidOut_Text = tk.StringVar()
-                self.TempHumidOut_Text.set("-")
-
-                self.TempHumidIn_Text = tk.StringVar()
-                self.TempHumidIn_Text.set("-")
-
-                self.TempOutMinMax_Text = tk.StringVar()
-                self.TempOutMinMax_Text.set("-")
-
-                self.TempInMinMax_Text = tk.StringVar()
-                self.TempInMinMax_Text.set("-")
-
-                self.Pressure_Text = tk.StringVar()
-                self.Pressure_Text.set("-")
-
-                self.PressureMinMax_Text = tk.StringVar()
-                self.PressureMinMax_Text.set("-")
-
-                self.Rainfall_Text = tk.StringVar()
-                self.Rainfall_Text.set("-")
-
-                self.RainHour_Text = tk.StringVar()
-                self.RainHour_Text.set("-")
-
-                self.CurrentTime = tk.StringVar()
-                self.CurrentTime.set("-")
-
-                self.BattLevel_Text = tk.StringVar()
-                self.BattLevel_Text.set("--.-V")
-
-                os.chdir(os.path.dirname(__file__))
-
-                self.ThermInPic = tk.PhotoImage(file="ThermHumidIn.gif")
-                self.ThermOutPic = tk.PhotoImage(file="ThermHumidOut.gif")
-                self.PressurePic = tk.PhotoImage(file="Pressure.gif")
-                self.RainPic = tk.PhotoImage(file="RainFall.gif")
-                self.Signal5Pic = tk.PhotoImage(file="Signal5.gif")
-                self.Signal0Pic = tk.PhotoImage(file="Signal0.gif")
-                self.WindPic = tk.PhotoImage(file="WindSpeed.gif")
-                self.TempRangePic = tk.PhotoImage(file="TempRange.gif")			# Dummy to set 100 pixel height
-                self.OtherRangePic = tk.PhotoImage(file="OtherRange.gif")		# Dummy to set 60 pixel height
-                self.BattHighPic = tk.PhotoImage(file="BattHigh.gif")
-                self.BattMidPic = tk.PhotoImage(file="BattMid.gif")
-                self.BattLowPic = tk.PhotoImage(file="BattLow.gif")
-                self.weather = main
-                self.weatherframe = tk.Frame(self.weather, bg="black", width=800, height=480, relief=tk.RAISED, padx=2, pady=2, borderwidth=5)
-                self.weatherframe.grid(row=0, column=0)
-                self.weatherframe.grid_propagate(0)
-                self.weatherframe.grid_rowconfigure(1, weight=27)
-                self.weatherframe.grid_rowconfigure(2, weight=17)
-                self.weatherframe.grid_rowconfigure(3, weight=17)
-                self.weatherframe.grid_rowconfigure(4, weight=17)
-                self.weatherframe.grid_rowconfigure(5, weight=17)
-
-                self.currentlabel = tk.Label(self.weatherframe, textvariable=self.CurrentTime, bg="black", fg="white", font = "Verdana 12 bold")
-                self.currentlabel.grid(row=0, column=0, columnspan=4, sticky="n")
-
-                self.temphumidoutlabel = tk.Label(self.weatherframe, image=self.ThermOutPic, compound=tk.LEFT, bg="black", fg="white", textvariable=self.TempHumidOut_Text, anchor="w", relief=tk.SUNKEN, width=260, borderwidth=5, font = "Verdana 25 bold")
-                self.temphumidoutlabel.grid(row=1, column=0, sticky="w")
-
-                self.tempoutrangelabel = tk.Label(self.weatherframe, bg="black", fg="white", width=120, image=self.TempRangePic, compound=tk.RIGHT, textvariable=self.TempOutMinMax_Text, relief=tk.SUNKEN, borderwidth=5, font = "Verdana 16 bold")
-                self.tempoutrangelabel.grid(row=1,column=1, sticky="w")
-
-                self.temphumidinlabel = tk.Label(self.weatherframe, image=self.ThermInPic, compound=tk.LEFT, bg="black", fg="white", textvariable=self.TempHumidIn_Text, anchor="w", relief=tk.SUNKEN, borderwidth=5, width = 260, font = "Verdana 25 bold")
-                self.temphumidinlabel.grid(row=2, column=0, sticky="w")
-
-                self.tempinrangelabel = tk.Label(self.weatherframe, bg="black", fg="white", width=120, image=self.TempRangePic, compound=tk.LEFT, textvariable=self.TempInMinMax_Text, relief=tk.SUNKEN, borderwidth=5, font = "Verdana 16 bold")
-                self.tempinrangelabel.grid(row=2,column=1, sticky="w")
-
-                self.pressurelabel = tk.Label(self.weatherframe, image=self.PressurePic, compound=tk.LEFT, bg="black", fg="white", textvariable=self.Pressure_Text, anchor="w", relief=tk.SUNKEN, borderwidth=5, width = 260, font = "Verdana 20 bold")
-                self.pressurelabel.grid(row=3, column=0, sticky="w")
-
-                self.pressurerangelabel = tk.Label(self.weatherframe, bg="black", fg="white", width=120, image=self.OtherRangePic, compound=tk.LEFT, textvariable=self.PressureMinMax_Text, relief=tk.SUNKEN, borderwidth=5, font = "Verdana 16 bold")
-                self.pressurerangelabel.grid(row=3,column=1, sticky="w")
-
-                self.rainlabel = tk.Label(self.weatherframe, image=self.RainPic, compound=tk.LEFT, bg="black", fg="white", textvariable=self.Rainfall_Text, anchor="w", relief=tk.SUNKEN, borderwidth=5, width = 260, font = "Verdana 20 bold")
-                self.rainlabel.grid(row=4, column=0, sticky="w")
-
-                self.rainhourlabel = tk.Label(self.weatherframe, bg="black", fg="white", width=120, image=self.OtherRangePic, compound=tk.LEFT, textvariable=self.RainHour_Text, relief=tk.SUNKEN, borderwidth=5, font = "Verdana 16 bold")
-                self.rainhourlabel.grid(row=4,column=1, sticky="w")
-
-                self.signallabel = tk.Label(self.weatherframe, image=self.Signal0Pic)
-                self.signallabel.grid(row=0, column=3, sticky="en")
-
-                self.battlabel = tk.Label(self.weatherframe, image=self.BattHighPic, compound=tk.CENTER, fg="black", textvariable=self.BattLevel_Text, font = "Verdana 12 bold")
-                self.battlabel.grid(row=0, column=0, sticky="wn")
-
-                self.windcanvas = tk.Canvas(self.weatherframe, bg="black", width=350, height=280, relief=tk.SUNKEN, borderwidth=5)
-                self.windcanvas.grid(row=2,column=2, columnspan=2, rowspan=3)
-
-                self.wind_circle = self.windcanvas.create_oval(60,25,300,265,outline='white', width=5)
-
-                self.coords = self.CalculateWindTriangle(0,180,145)
-                self.winddirection = self.windcanvas.create_polygon(self.coords[0], self.coords[1], self.coords[2], self.coords[3], self.coords[4], self.coords[5], width=2, outline = "white", fill="blue")
-                self.winddirectiontail = self.windcanvas.create_line(self.coords[6], self.coords[7], self.coords[8], self.coords[9], width= 2, fill="white")
-                self.windspeed = self.windcanvas.create_text(180,130,text="0", justify=tk.CENTER, fill="white", font="Verdana 20 bold")
-                self.windgust = self.windcanvas.create_text(180,160,text="(0)", justify=tk.CENTER, fill="white", font="Verdana 20 bold")
-                self.northtext = self.windcanvas.create_text(180,15,text="N", fill="white", font="Verdana 12 bold")
-                self.northeasttext = self.windcanvas.create_text(280,53,text="NE", fill="white", font="Verdana 12 bold")
-                self.easttext = self.windcanvas.create_text(310,145,text="E", fill="white", font="Verdana 12 bold")
-                self.southeasttext = self.windcanvas.create_text(280,240,text="SE", fill="white", font="Verdana 12 bold")
-                self.southtext = self.windcanvas.create_text(180,275,text="S", fill="white", font="Verdana 12 bold")
-                self.southwesttext = self.windcanvas.create_text(75,235,text="SW", fill="white", font="Verdana 12 bold")
-                self.westtext = self.windcanvas.create_text(48,145,text="W", fill="white", font="Verdana 12 bold")
-                self.northwesttext = self.windcanvas.create_text(75,53,text="NW", fill="white", font="Verdana 12 bold")
-                self.mph = self.windcanvas.create_text(180,190,text="MPH", fill="white", font="Verdana 12 bold")
-
-                self.temphistorycanvas = tk.Canvas(self.weatherframe, bg="black", width=400, bd=5, height=100)
-                self.temphistorycanvas.grid(row=1, column=2, columnspan=2)
-                self.weather.bind('<Key>',self.Close)
-
-                self.figure1 = plt.Figure(figsize=(3.8,1.1), dpi=100)
-                self.TempPlot = self.figure1.add_subplot(111)
-                self.TempPlot.set_facecolor("black")
-                self.figure1.patch.set_facecolor("black")
-                self.TempPlot.spines['bottom'].set_color('white')
-                self.TempPlot.tick_params(axis='x',colors='white')
-                self.TempPlot.spines['left'].set_color('white')
-                self.TempPlot.tick_params(axis='y',colors='white')
-
-                self.figure1.subplots_adjust(left=0.1,bottom=0.3,right=0.95)
-                self.TempHistGraph = FigureCanvasTkAgg(self.figure1, self.temphistorycanvas)
-                self.TempHistGraph.get_tk_widget().grid(row=0, column=0)
-                self.UpdateDisplay()
-                self.UpdateTempHistory()
-
-
-        def Close(self,event):
-                self.weather.destroy()
-
-
-        def CalculateWindTriangle(self,degrees,CentreXCoord,CentreYCoord):
-                TipRadians = math.radians(degrees)					# Convert Triangle Tip angle to Radians
-                LeftRadians = math.radians(degrees - 18)				# Convert Triangle Left Tip angle to Radians
-                RightRadians = math.radians(degrees + 18)				# Convert Triangle Right Tip angle to Radians
-                TipXOffsetFromCentre = math.sin(TipRadians) * 115			# 120 = length of radius, but circle is not true on display so fudge it!
-                TipYOffsetFromCentre = math.cos(TipRadians) * 115
-                LeftXOffsetFromCentre = math.sin(LeftRadians) * 63			# 63 = length of radius to left/right triangle tip
-                LeftYOffsetFromCentre = math.cos(LeftRadians) * 63
-                RightXOffsetFromCentre = math.sin(RightRadians) * 63
-                RightYOffsetFromCentre = math.cos(RightRadians) * 63
-                TipXCoord = CentreXCoord + TipXOffsetFromCentre
-                TipYCoord = CentreYCoord - TipYOffsetFromCentre
-                LeftXCoord = CentreXCoord + LeftXOffsetFromCentre
-                LeftYCoord = CentreYCoord - LeftYOffsetFromCentre
-                RightXCoord = CentreXCoord + RightXOffsetFromCentre
-                RightYCoord = CentreYCoord - RightYOffsetFromCentre
-                TailEndRadians = math.radians((degrees+180)%360)
-                TailStartXOffsetFromCentre = math.sin(TailEndRadians) * 63
-                TailStartYOffsetFromCentre = math.cos(TailEndRadians) * 63
-                TailStartXCoord = CentreXCoord + TailStartXOffsetFromCentre
-                TailStartYCoord = CentreYCoord - TailStartYOffsetFromCentre
-                TailEndXOffsetFromCentre = math.sin(TailEndRadians) * 115
-                TailEndYOffsetFromCentre = math.cos(TailEndRadians) * 115
-                TailEndXCoord = CentreXCoord + TailEndXOffsetFromCentre
-                TailEndYCoord = CentreYCoord - TailEndYOffsetFromCentre
-                return (TipXCoord, TipYCoord, LeftXCoord, LeftYCoord, RightXCoord, RightYCoord, TailStartXCoord, TailStartYCoord, TailEndXCoord, TailEndYCoord)
-
-# Function to update the temperature history chart
-        def UpdateTempHistory(self):
-                global GTempOutMaxFloat
-                global GTempOutMinFloat
-                global GITempOutMaxFloat
-                global GITempOutMinFloat
-                self.DayNow = datetime.datetime.now()
-                self.CurrentDOW = self.DayNow.weekday()
-                if (self.CurrentDOW == 6):
-                        self.CurrentDOW = 0						# If it's Sunday then set the history start to previous Monday
-                else:
-                        self.CurrentDOW += 1						# Otherwise just set the history start to 6 days ago
-                self.DOW = ['Mo','Tu','We','Th','Fr','Sa','Su']				# List of days for display
-                self.DOW = self.DOW[self.CurrentDOW:] + self.DOW[:self.CurrentDOW] 	# Rotate according to current day of week
-                self.TempPlot.clear()
-                if not self.Unit:							# Metric
-                        MaxTemp = max(GTempOutMaxFloat[1:7])
-                        MaxAxisTemp = MaxTemp + (MaxTemp/100.0*10)
-                        MinTemp = min(GTempOutMinFloat[1:7])
-                        MinAxisTemp = MinTemp - (MinTemp/100.0*10)
-                        self.TempPlot.axis([0,5,MinAxisTemp,MaxAxisTemp])
-                        self.TempPlot.plot(GTempOutMaxFloat[1:7], color='r')
-                        self.TempPlot.plot(GTempOutMinFloat[1:7], color='b')
-                else:									# Imperial
-                        MaxTemp = max(GITempOutMaxFloat[1:7])
-                        MaxAxisTemp = MaxTemp + (MaxTemp/100.0*10)
-                        MinTemp = min(GITempOutMinFloat[1:7])
-                        MinAxisTemp = MinTemp - (MinTemp/100.0*10)
-                        self.TempPlot.axis([0,5,MinAxisTemp,MaxAxisTemp])
-                        self.TempPlot.plot(GITempOutMaxFloat[1:7], color='r')
-                        self.TempPlot.plot(GITempOutMinFloat[1:7], color='b')
-                self.TempPlot.set_yticks([round(MinTemp,-1),round((MaxTemp-MinTemp)/4,-1),round((MaxTemp-MinTemp)/2,-1),round((MaxTemp-MinTemp)*3/4,-1),round(MaxTemp,-1)])
-                self.TempPlot.set_xticks([0,1,2,3,4,5])
-                self.TempPlot.set_xticklabels(self.DOW[0:6])				# Show rotated days of week
-                self.TempPlot.grid()
-                self.TempHistGraph.draw()
-
-# Function which dynamically updates all Text and Image variables
-        def UpdateDisplay(self):
-                global GTempOutFloat
-                global GTempInFloat
-                global GHumidOutInt
-                global GHumidInInt
-                global GPressInt
-                global GRainFloat
-                global GRainHFloat
-                global GTempInMaxFloat
-                global GTempInMinFloat
-                global GTempOutMaxFloat
-                global GTempOutMinFloat
-                global GHumidMaxInt
-                global GHumidMinInt
-                global GPressMaxInt
-                global GPressMinInt
-                global GITempInMaxFloat
-                global GITempInMinFloat
-                global GITempOutMaxFloat
-                global GITempOutMinFloat
-                global GWindSpeedInt
-                global GWindGustInt
-                global GWindDirInt
-                global GPressAvThisHour
-                global GPressAvLastHour
-                global GBattVoltageFloat
-
-                self.CurrentDT = datetime.datetime.now()
-                self.CurrentTime.set("Weather Station\n" + self.CurrentDT.strftime("%d-%m-%Y %H:%M"))
-                if not self.Unit:
-                        self.TempHumidOut_Text.set(' {:.1f}'.format(GTempOutFloat) + u'\N{DEGREE SIGN}C\n(' + str(GHumidOutInt) + '%)')
-                        self.TempHumidIn_Text.set(' {:.1f}'.format(GTempInFloat) + u'\N{DEGREE SIGN}C\n(' + str(GHumidInInt) + '%)')
-                        self.TempOutMinMax_Text.set('{:.1f}'.format(GTempOutMaxFloat[0]) + "\n\n" + '{:.1f}'.format(GTempOutMinFloat[0]))
-                        self.TempInMinMax_Text.set('{:.1f}'.format(GTempInMaxFloat) + "\n\n" + '{:.1f}'.format(GTempInMinFloat))
-                        self.PressureMinMax_Text.set(str(GPressMaxInt) + "\n" + str(GPressMinInt))
-                        if (GPressAvThisHour > (GPressAvLastHour+1)):
-                                self.Pressure_Text.set(str(GPressInt) + " hPa (+)")
-                        elif (GPressAvThisHour < (GPressAvLastHour-1)):
-                                self.Pressure_Text.set(str(GPressInt) + " hPa (-)")
-                        else:
-                                self.Pressure_Text.set(str(GPressInt) + " hPa")
-
-                        self.Rainfall_Text.set('{:.1f}'.format(GRainFloat) + " mm")
-                        self.RainHour_Text.set('{:.1f}'.format(GRainHFloat) + "/H")
-                else:
-                        ITempOutFloat = (GTempOutFloat / 5 * 9) + 32
-                        ITempInFloat = (GTempInFloat /5 *9) + 32
-                        for index in range(7):
-                                GITempOutMaxFloat[index] = ((GTempOutMaxFloat[index] /5 * 9) + 32)
-                                GITempOutMinFloat[index] = ((GTempOutMinFloat[index] /5 * 9) + 32)
-                        GITempInMaxFloat = (GTempInMaxFloat /5 * 9) + 32
-                        GITempInMinFloat = (GTempInMinFloat /5 * 9) + 32
-                        IPressFloat = GPressInt * 0.03
-                        IPressMaxFloat = GPressMaxInt * 0.03
-                        IPressMinFloat = GPressMinInt * 0.03
-                        IRainFloat = GRainFloat / 25.4
-                        IRainHFloat = GRainHFloat / 25.4
-                        self.TempHumidOut_Text.set(' {:.1f}'.format(ITempOutFloat) + u'\N{DEGREE SIGN}F\n(' + str(GHumidOutInt) + '%)')
-                        self.TempHumidIn_Text.set(' {:.1f}'.format(ITempInFloat) + u'\N{DEGREE SIGN}F\n(' + str(GHumidInInt) + '%)')
-                        self.TempOutMinMax_Text.set(' {:.1f}'.format(GITempOutMaxFloat[0]) + "\n\n" + '{:.1f}'.format(GITempOutMinFloat[0]))
-                        self.TempInMinMax_Text.set(' {:.1f}'.format(GITempInMaxFloat) + "\n\n" + '{:.1f}'.format(GITempInMinFloat))
-                        if (GPressAvThisHour > (GPressAvLastHour+1)):
-                                self.Pressure_Text.set('{:.2f}'.format(IPressFloat) + " inHg (+)")
-                        elif (GPressAvThisHour < (GPressAvLastHour-1)):
-                                self.Pressure_Text.set('{:.2f}'.format(IPressFloat) + " inHg (-)")
-                        else:
-                                self.Pressure_Text.set('{:.2f}'.format(IPressFloat) + " inHg")
-                        self.PressureMinMax_Text.set('{:.1f}'.format(IPressMaxFloat) + "\n" + '{:.1f}'.format(IPressMinFloat))
-                        self.Rainfall_Text.set('{:.1f}'.format(IRainFloat) + " in")
-                        self.RainHour_Text.set('{:.1f}'.format(IRainHFloat) + "/H")
-                if GBattVoltageFloat > 12.5:
-                        self.battlabel.config(image=self.BattHighPic)
-                elif GBattVoltageFloat > 11.5:
-                        self.battlabel.config(image=self.BattMidPic)
-                else:
-                        self.battlabel.config(image=self.BattLowPic)
-                self.BattLevel_Text.set('{:.1f}'.format(GBattVoltageFloat) + "V")
-
-                self.coords = self.CalculateWindTriangle(((GWindDirInt+180)%360),180,145)
-                self.windcanvas.itemconfigure(self.windspeed, text=str(GWindSpeedInt))
-                self.windcanvas.itemconfigure(self.windgust, text="("+str(GWindGustInt)+")")
-                if (GWindSpeedInt == 0 and GWindGustInt == 0):
-                         self.windcanvas.itemconfigure(self.winddirection, outline='black')
-                         self.windcanvas.itemconfigure(self.winddirection, fill='black')
-                else:
-                         self.windcanvas.itemconfigure(self.winddirection, outline='white')
-                         self.windcanvas.itemconfigure(self.winddirection, fill='blue')
-                self.windcanvas.coords(self.winddirection, self.coords[0], self.coords[1], self.coords[2], self.coords[3], self.coords[4], self.coords[5], self.coords[0], self.coords[1])
-                self.windcanvas.coords(self.winddirectiontail, self.coords[6], self.coords[7], self.coords[8], self.coords[9])
-                self.weatherframe.update()
-
-# Function to show the signal strength icon
-        def UpdateSignal(self,SignalLevel):
-                if SignalLevel == 5:
-                        self.signallabel.config(image=self.Signal5Pic)
-                else:
-                        self.signallabel.config(image=self.Signal0Pic)
-
-#------------------------------------------------------------------------------------
-# End of Display Class
-#------------------------------------------------------------------------------------
-
+WebPort = 8080								# Local HTTP/JSON API for dashboards, 0 = off
+MetricsPort = 9108							# Prometheus /metrics, 0 = off
+ArchiveDir = "Archive"							# Per minute column archive of the pipe 1 station, see Analytics.py
+CheckpointFile = "Checkpoint.dat"					# Live state of the pipe 1 station for a restart, see Checkpoint.py
+IndexDir = "Index"							# Multi-resolution history of the pipe 1 station for the charts, see HistoryIndex.py
+MetricsLogFile = "Metrics.log"						# Rotating JSON log of the metrics, one line a minute
+SinksFile = "Sinks.ini"							# ThingSpeak keys and the other upload sinks, see Sinks.ini.example
+
+# Transmitters, one per nRF24 data pipe: pipe -> name. Pipe 1 is the original sensor head and is
+# the one on the display; see Stations.py for pipes 2-5. Where each one uploads to is in SinksFile.
+STATIONS = {1: "Garden"}
 
 # Function to get the history values from disk after a power cycle
 def ReadINI():
-        global GTempOutMaxFloat
-        global GTempOutMinFloat
+        Today = LocalNow().date()
+        for Station in Stations.values():
+                History = Station.Store.DailyHistory(HISTORY_DAYS, Today)
+                if not History and Station is Primary:
+                        ImportINI(Today)					# Config.ini only ever held the original station
+                        History = Station.Store.DailyHistory(HISTORY_DAYS, Today)
+                for Day, TempMax, TempMin in History:			# Oldest first, pushing out the placeholders
+                        Station.AddDay(TempMax, TempMin)
+
+# Function to bring each station's live state back after a restart: today's extremes, the trend and the readings
+def RestoreState():
+        global NextCheckpoint
+        global RestoreTime
+        Started = time.perf_counter()
+        TimeNow = Clock()
+        for Station in Stations.values():
+                Restored[Station.Pipe] = RestoreCheckpoint(Station, Station.CheckpointPath, TimeNow)
+                SavedPackets[Station.Pipe] = Station.Packets
+                if Station.IndexPath is not None:				# Minutes closed while down or during the restore come from the store
+                        Station.Index = HistoryIndex(Station.IndexPath)
+                        Station.Index.Catchup(Station.Store, TimeNow // 60 * 60)
+        NextCheckpoint = TimeNow + CHECKPOINT_INTERVAL
+        RestoreTime = time.perf_counter() - Started
+
+# Function to checkpoint every station that has had packets since its last checkpoint, written on the writer's thread
+def SaveState(TimeNow):
+        for Station in Stations.values():
+                if Station.CheckpointPath is None or Station.Packets == SavedPackets.get(Station.Pipe):
+                        continue
+                Started = time.perf_counter()
+                Data = EncodeCheckpoint(Station, TimeNow)
+                CheckpointEncodeTime.Observe(time.perf_counter() - Started)
+                Checkpoints.Submit(Station.CheckpointPath, Data)
+                SavedPackets[Station.Pipe] = Station.Packets
+
+# Function to bring the history from an old Config.ini into the sample store on first start
+def ImportINI(Today):
+        import configparser
         config = configparser.ConfigParser()
-        config.read('Config.ini')
+        if not config.read(INIFile):
+                return
         for index in range(1,7):
-                GTempOutMaxFloat[index] = float(config['TempMax'][str(index)])
-                GTempOutMinFloat[index] = float(config['TempMin'][str(index)])
+                Day = Today - datetime.timedelta(days=7-index)			# Config.ini [6] is yesterday, [1] six days ago
+                Primary.Store.ImportDaily(Day, float(config['TempMax'][str(index)]), float(config['TempMin'][str(index)]))
 
-# Function that writes the history values to disk at midnight every day
-def WriteINI():
-        global GTempOutMaxFloat
-        global GTempOutMinFloat
-        config = configparser.ConfigParser()
-        config['TempMax'] = {}
-        config['TempMin'] = {}
-        for index in range(1,7):
-                config['TempMax'][str(index)] = str(GTempOutMaxFloat[index])
-                config['TempMin'][str(index)] = str(GTempOutMinFloat[index])
-        with open('Config.ini','w') as configfile:
-                config.write(configfile)
+# Function that rolls the finished day up in the station's sample store at midnight every day
+def WriteINI(Station, Day):
+        Started = time.perf_counter()
+        Station.Store.RollupDay(Day, Clock())
+        IniTime.Observe(time.perf_counter() - Started)
 
+# Function to get the latest indoor reading from the sampler thread - never waits for the DHT22
 def GetInsideTempHumid():
-        HumidIn = [0.0,0.0,0.0]
-        TempIn = [0.0,0.0,0.0]
-        for ReadAttempt in range(3):
-                try:
-                        HumidIn[ReadAttempt], TempIn[ReadAttempt] = Adafruit_DHT.read_retry(DHT_SENSOR, DHT_PIN)
-                except:
-                        HumidIn[ReadAttempt] = 0
-                        TempIn[ReadAttempt] = 0
-        HumidIn.sort()
-        TempIn.sort()
-        HumidInFloat = HumidIn[1] * 0.925
-        TempInFloat = (TempIn[1] * 1.09) - 1.50
-        return HumidInFloat, TempInFloat
-
-
-# The main Tkinter loop
-def Get_Weather_Updates():
-        global GTimeoutStart
-        global GTempOutFloat
-        global GTempInFloat
-        global GHumidOutInt
-        global GHumidInInt
-        global GPressInt
-        global GPressMaxInt
-        global GPressMinInt
-        global GPressAvThisHour
-        global GPressAvLastHour
-        global GPressLastInt
-        global GRainFloat
-        global GRainHFloat
-        global GTempOutMaxFloat
-        global GTempOutMinFloat
-        global GTempInMaxFloat
-        global GTempInMinFloat
-        global GPressMaxInt
-        global GPressMinInt
-        global GStartDay
-        global GStartHour
-        global GWindSpeedInt
-        global GWindGustInt
-        global GWindDirInt
-        global GDayNight
-        global GBattVoltageFloat
-        global GTimeCheckLast
-        SignalLevel = 0
-
-#                 t=Night mode                                      Wind (Av)
-#                 T=Day Mode                                        | | Wind (Gust)
-#                 |  Out T   Hum.  Pressure  Rain (Day) Rain (Hr)   | | | | Wind Dir
-#                 | |     |   | |   |     |   |       |   |     |   | | | | |   |
-# Message Format: | 9 9 . 9 H 9 9 P 9 9 9 9 R 9 9 9 . 9 r 9 9 . 9 W 9 9 9 9 9 9 9
-#                 ---------------------------------------------------------------
-#                 0 0 0 0 0 0 0 0 0 0 1 1 1 1 1 1 1 1 1 1 2 2 2 2 2 2 2 2 2 2 3 3
-#                 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
-
-
-        if (radio.available()):
+        Started = time.perf_counter()
+        Latest = IndoorSampler.Latest()
+        IndoorTime.Observe(time.perf_counter() - Started)
+        return Latest
+
+
+# Function to decode one packet received on a pipe and update that station, and the display if it is the one shown.
+# when is the time the radio received it, now if not given
+def ProcessPacket(receive_payload, pipe=1, rpd=None, when=None):
+
+# Payload layout is documented in PayloadParser.py
+
+        HumidInFloat, TempInFloat, ReadTime = GetInsideTempHumid()
+
+        ReceiveTime = Clock() if when is None else when
+        if Recorder is not None:
+                Recorder.Write(ReceiveTime, receive_payload, pipe)
+        Station = Stations.get(pipe)
+        if Station is None:
+                return								# No transmitter configured on this pipe
+        Started = time.perf_counter()
+        Reading = ParsePayload(receive_payload)
+        ParseTime.Observe(time.perf_counter() - Started)
+        Frames[Reading.Version].Inc()
+        if Reading.Kind not in EXPECTED_VALID or EXPECTED_VALID[Reading.Kind] & ~Reading.Valid:
+                CountParseFailures(Reading)
+                if Reading.Kind not in EXPECTED_VALID:
+                        return							# Corrupt or unknown frame, nothing in it can be trusted
+        if Reading.Station is not None and Reading.Station != pipe:
+                ParseFailures["station"].Inc()
+                return								# A v2 frame from a sensor head set up for another pipe
+        Values = ReadingValues(Reading)
+        if ReadTime:								# Nothing to show until the sampler has a fresh reading
+                Values['temp_in'] = TempInFloat
+                Values['humid_in'] = int(HumidInFloat)
+        Lost = None
+        if Reading.Kind == KIND_WEATHER:
+                Lost = Station.Link.Packet(ReceiveTime, rpd, Reading.Sequence)
+        Station.Store.Append(ReceiveTime, Reading, Values.get('temp_in'), Values.get('humid_in'), Lost, rpd)
+        Station.Stats.Add(ReceiveTime, Values)
+        if Reading.Gusts:
+                Station.Stats.AddSeries(ReceiveTime, 'gust_peak', Reading.Gusts)
+        with Station.Lock:							# Other threads read the station through its Snapshot()
+                Station.Packets += 1
+                Station.LastReceive = ReceiveTime
+                Station.SignalLost = False
+                Station.TempIn = Values.get('temp_in')				# None while the DHT22 has nothing recent
+                Station.HumidIn = Values.get('humid_in')
+
+                if (Reading.Kind == KIND_WEATHER):
+# Weather Data receive cycle - fields that failed to parse keep their last good value
+                        if Reading.Valid & VALID_TEMP:
+                                Station.TempOut = Reading.TempOut
+
+                        if Reading.Valid & VALID_HUMID:
+                                Station.HumidOut = Reading.HumidOut
+
+                        if Reading.Valid & VALID_PRESS:
+                                Station.Pressure = Reading.Pressure
+
+                        if Reading.Valid & VALID_RAIN:
+                                Station.Rain = Reading.Rain
+
+                        if Reading.Valid & VALID_RAINH:
+                                Station.RainHour = Reading.RainHour
+
+                        if Reading.Valid & VALID_WINDSPEED:
+                                Station.WindSpeed = Reading.WindSpeed
+
+                        if Reading.Valid & VALID_WINDGUST:
+                                Station.WindGust = Reading.WindGust
+
+                        if Reading.Valid & VALID_WINDDIR:
+                                Station.WindDir = Reading.WindDir
+
+                        if Reading.Gusts:
+                                Station.GustPeak = max(Reading.Gusts)
+
+                        Station.Samples.Append(ReceiveTime, Values)
+
+                elif (Reading.Kind == KIND_STATUS):
+# System status receive cycle
+                        if Reading.Valid & VALID_BATT:
+                                Station.Battery = Reading.Battery
+
+        if (Reading.Kind == KIND_WEATHER):
+                Station.Upload.Packet(Values, ReceiveTime)			# Only queued, for the sinks that take every packet
+        elif (Reading.Kind == KIND_STATUS) and Reading.Valid & VALID_CLOCK:
+                Acks.ClockReport(pipe, Reading.ClockOffset, ReceiveTime)
+        if Station is not Primary:
+                return
+        State = Snapshot()
+        Started = time.perf_counter()
+        MainWindow.UpdateDisplay(State)
+        DisplayTime.Observe(time.perf_counter() - Started)
+        if Web is not None:
+                Web.Publish(State)
+        MainWindow.UpdateSignal(Station.Link.Level(ReceiveTime))
+
+# Function to count the fields of a packet that failed to parse, or the whole packet if its type is unknown
+def CountParseFailures(Reading):
+        if Reading.Kind not in EXPECTED_VALID:
+                ParseFailures["crc" if Reading.Kind == KIND_CORRUPT else "kind"].Inc()
+                return
+        Missing = EXPECTED_VALID[Reading.Kind] & ~Reading.Valid
+        for Bit, Name in enumerate(FIELD_NAMES):
+                if Missing & (1 << Bit):
+                        ParseFailures[Name].Inc()
+
+# Function for the hourly/daily rollovers, the signal timeout and the checkpoints, run whenever the radio is idle
+def Housekeeping():
+        global NextCheckpoint
+        TimeNow = Clock()
+        for Station in Stations.values():
+                Station.Stats.Tick(TimeNow)
+                if not Station.SignalLost and (TimeNow - (Station.LastReceive or StartTime)) > 25:
+                        Station.SignalLost = True
+                        Station.SignalLosses += 1
+        if TimeNow >= NextCheckpoint:
+                NextCheckpoint = TimeNow + CHECKPOINT_INTERVAL
+                SaveState(TimeNow)
+        MainWindow.UpdateSignal(0 if Primary.SignalLost else Primary.Link.Level(TimeNow))	# Only redrawn when the bars change
+
+# Function called by a station's aggregator each time a minute, hour, day or month bucket closes
+def StatsRollover(Station, Period, Bucket):
+        if Period == MINUTE:
+                UploadMinute(Station, Bucket)
+                IndexMinute(Station, Bucket)
+        elif Period == HOUR:
+                Station.Store.RollupHour(datetime.datetime.fromtimestamp(Bucket.Start))
+        elif Period == DAY:
+                TempOut = Bucket.Stats['temp_out']
+                if TempOut.Count:
+                        Station.AddDay(TempOut.Max, TempOut.Min)
+                if Station is Primary:
+                        UpdateTempHistory()
+                WriteINI(Station, Bucket.Key)
+                ArchiveDay(Station, Bucket)
+
+# Function to add the day's minutes to the station's archive before the sample store prunes them
+def ArchiveDay(Station, Bucket):
+        if Station.ArchivePath is None:
+                return
+        Started = time.perf_counter()
+        if Station.Archive is None:
+                from Analytics import ColumnArchive				# NumPy is only loaded at the first midnight
+                Station.Archive = ColumnArchive(Station.ArchivePath)
+        Station.Archive.Export(Station.Store, Bucket.End + 60)
+        ArchiveTime.Observe(time.perf_counter() - Started)
+
+# Function to add a closed minute to the station's history index
+def IndexMinute(Station, Bucket):
+        Record = MinuteRecord(Bucket)
+        if Station.Index is None or Record is None:
+                return
+        Started = time.perf_counter()
+        Station.Index.AddMinute(Record)
+        IndexTime.Observe(time.perf_counter() - Started)
+
+# Function to get the outdoor temperature over the days on the history chart from the station's index, as
+# [x, y] in the chart's day units with each day centred on its max/min point, or None without an index
+def HistoryTrace(Station, TimeNow):
+        if Station.Index is None:
+                return None
+        Today = datetime.date.fromtimestamp(TimeNow)
+        Midnights = [datetime.datetime.combine(Today - datetime.timedelta(days=HISTORY_DAYS - Day), datetime.time()).timestamp() for Day in range(HISTORY_DAYS + 1)]
+        Level, Times, Temps = Station.Index.Series('temp_out', Midnights[0], Midnights[-1], POINTS)
+        Days = [bisect.bisect_right(Midnights, When) - 1 for When in Times]
+        return [[Day + (When - Midnights[Day]) / (Midnights[Day+1] - Midnights[Day]) - 0.5 for Day, When in zip(Days, Times)], Temps]
+
+# Function to redraw the display's history chart for the station on show
+def UpdateTempHistory():
+        State = Snapshot()
+        State["history_trace"] = HistoryTrace(Primary, State["time"])
+        Started = time.perf_counter()
+        MainWindow.UpdateTempHistory(State)
+        HistoryTime.Observe(time.perf_counter() - Started)
+
+# Function to send the means of the last minute to the station's upload sinks
+def UploadMinute(Station, Bucket):
+        Minute = Bucket.Stats
+        if Minute['temp_out'].Count == 0:
+                return								# No weather packet that minute
+        Started = time.perf_counter()
+        WindDir = Bucket.Wind.Direction()
+        Station.Upload.Submit({'temp_out': round(Minute['temp_out'].Mean, 1),
+                       'humid_out': round(Minute['humid_out'].Mean),
+                       'pressure': round(Minute['pressure'].Mean),
+                       'wind_speed': round(Minute['wind_speed'].Mean),
+                       'wind_gust': Minute['wind_gust'].Max,
+                       'wind_dir': round(WindDir) % 360 if WindDir is not None else Station.WindDir,
+                       'rain': Minute['rain'].Last,
+                       'rain_hour': Minute['rain_hour'].Last}, Bucket.Start)
+        UploadTime.Observe(time.perf_counter() - Started)
+
+# Function to get the aggregator values of a parsed packet, only fields that parsed are included
+def ReadingValues(Reading):
+        Values = {}
+        if Reading.Kind == KIND_WEATHER:
+                for Name, Bit, Value in (('temp_out', VALID_TEMP, Reading.TempOut), ('humid_out', VALID_HUMID, Reading.HumidOut),
+                                         ('pressure', VALID_PRESS, Reading.Pressure), ('rain', VALID_RAIN, Reading.Rain),
+                                         ('rain_hour', VALID_RAINH, Reading.RainHour), ('wind_speed', VALID_WINDSPEED, Reading.WindSpeed),
+                                         ('wind_gust', VALID_WINDGUST, Reading.WindGust), ('wind_dir', VALID_WINDDIR, Reading.WindDir)):
+                        if Reading.Valid & Bit:
+                                Values[Name] = Value
+        elif Reading.Kind == KIND_STATUS and Reading.Valid & VALID_BATT:
+                Values['battery'] = Reading.Battery
+        return Values
+
+# Function to get today's (max, min) of a quantity at a station, None if nothing has been received today
+def TodayRange(Name, Station=None):
+        Today = (Station or Primary).Stats.Stats(DAY, Name)
+        if Today is None:
+                return None
+        return Today.Max, Today.Min
+
+# Function to compare this hour's mean pressure with last hour's: 1 rising, -1 falling, 0 steady
+def PressureTrend(Station=None):
+        Stats = (Station or Primary).Stats
+        ThisHour = Stats.Stats(HOUR, 'pressure')
+        LastHour = Stats.PreviousStats(HOUR, 'pressure')
+        if ThisHour is None or LastHour is None:
+                return 0
+        if ThisHour.Mean > (LastHour.Mean+1):
+                return 1
+        if ThisHour.Mean < (LastHour.Mean-1):
+                return -1
+        return 0
+
+# Function to gather everything the display shows for a station into a dict of plain values, so it can be sent to a GUI in another process
+def Snapshot(Station=None):
+        Station = Station or Primary
+        Now = Clock()
+        State = Station.Snapshot()
+        State.update({"time": Now,
+                "temp_out_range": TodayRange('temp_out', Station),
+                "temp_in_range": TodayRange('temp_in', Station),
+                "pressure_range": TodayRange('pressure', Station),
+                "pressure_trend": PressureTrend(Station),
+                "signal": 0 if Station.SignalLost else Station.Link.Level(Now),
+                "packet_loss": round(Station.Link.LongLoss(), 3)})
+        return State
+
+# Returns a Unix time as the ACK payload the Arduino syncs its clock from, offering protocol v2 after it
+def AckPayload(Second):
+        return b"%d V%d" % (Second, PROTOCOL_V2)
+
+# Function to service the radio once: handle a waiting packet, otherwise top up the ACK payloads and do the housekeeping
+def PollRadio():
+        Started = time.perf_counter()
+        Available, Pipe = radio.available_pipe()
+        if Available:
                 length = radio.getDynamicPayloadSize()
                 receive_payload = radio.read(length)
-                HumidInFloat, GTempInFloat = GetInsideTempHumid()
-                GHumidInInt = int(HumidInFloat)
-                HourCheck = int(datetime.datetime.now().hour)
-
-                if (GTempInFloat > GTempInMaxFloat):
-                        GTempInMaxFloat = GTempInFloat
-                if (GTempInFloat < GTempInMinFloat):
-                        GTempInMinFloat = GTempInFloat
-
-
-                if (receive_payload.decode('utf-8')[0] == 'T'):
-# Weather Data receive cycle
-                        try:
-                                GTempOutFloat = float(receive_payload.decode('utf-8')[1:5])
-                                if (GTempOutFloat > GTempOutMaxFloat[0]):
-                                        GTempOutMaxFloat[0] = GTempOutFloat
-                                if (GTempOutFloat < GTempOutMinFloat[0]):
-                                        GTempOutMinFloat[0] = GTempOutFloat
-                        except:
-                                GTempOutFloat = 0
-
-                        try:
-                                GHumidOutInt = int(receive_payload.decode('utf-8')[6:8])
-                        except:
-                                GHumidInt = 0
-
-                        try:
-                                GPressInt = int(receive_payload.decode('utf-8')[9:13])
-                                if (GPressInt > GPressMaxInt):
-                                        GPressMaxInt = GPressInt
-                                if (GPressInt < GPressMinInt):
-                                        GPressMinInt = GPressInt
-                                GPressAvThisHour = (GPressLastInt + GPressInt)/2
-                                GPressLastInt = GPressInt
-                                SignalLevel += 1
-                        except:
-                                GPressInt = 0
-
-                        try:
-                                GRainFloat = float(receive_payload.decode('utf-8')[14:19])
-                        except:
-                                GRainFloat = 0
-
-                        try:
-                                GRainHFloat = float(receive_payload.decode('utf-8')[20:24])
-                        except:
-                                GRainHFloat = 0
-
-                        try:
-                                GWindSpeedInt = int(receive_payload.decode('utf-8')[25:27])
-                        except:
-                                GWindSpeedInt = 0
-
-                        try:
-                                GWindGustInt = int(receive_payload.decode('utf-8')[27:29])
-                        except:
-                                GWindGustInt = 0
-
-                        try:
-                                GWindDirInt = int(receive_payload.decode('utf-8')[29:32])
-                        except:
-                                GWindDirInt = 0
-
-                        try:
-                                TimeCheck = time.time()
-                                if (TimeCheck - GTimeCheckLast) > 60:
-                                        GTimeCheckLast=TimeCheck
-                                        f=urllib.request.urlopen(BaseURL + "&field1=%s&field2=%s&field3=%s&field4=%s&field5=%s&field6=%s&field7=%s&field8=%s" % (GTempOutFloat, GHumidOutInt, GPressInt, GWindSpeedInt, GWindGustInt, GWindDirInt, GRainFloat, GRainHFloat))
-                                        f.close()
-                        except:
-                                print("ThingSpeak Upload fail!")
-
-
-                else :
-# System status receive cycle
-                        try:
-                                GBattVoltageFloat=float(receive_payload.decode('utf-8')[1:6])
-                        except:
-                                GBattVoltageFloat = 0
-                MainWindow.UpdateDisplay()
-                GTimeoutStart = time.time()
-                MainWindow.UpdateSignal(5)
+                Rpd = radio.testRPD() if ReadRpd else None			# Only means anything straight after the read
+                ReceiveTime = Clock()
+                Acks.PacketReceived(Pipe, ReceiveTime)
+                ProcessPacket(receive_payload, Pipe, Rpd, ReceiveTime)
+                PacketLoopTime.Observe(time.perf_counter() - Started)
         else:
-                today = datetime.datetime.now()
-                TimeNow = time.time()
-                AckMessage=bytes(today.strftime('%s'),'utf-8')
-                radio.writeAckPayload(1,AckMessage)
-                if not (today.hour == GStartHour.hour):
-                        GStartHour = today
-                        GPressAvLastHour = GPressAvThisHour
-                if not (today.day == GStartDay.day):
-                        GTempOutMaxFloat = GTempOutMaxFloat[1:]+GTempOutMaxFloat[:1]
-                        GTempOutMinFloat = GTempOutMinFloat[1:]+GTempOutMinFloat[:1]
-                        GTempOutMaxFloat[0] = -99
-                        GTempOutMinFloat[0] = 99
-                        GTempInMaxFloat = -99
-                        GTempInMinFloat = 99
-                        GPressMaxInt = 0
-                        GPressMinInt = 9999
-                        GStartDay = today
-                        MainWindow.UpdateTempHistory()
-                        WriteINI()
-                if (TimeNow - GTimeoutStart) > 25:
-                        MainWindow.UpdateSignal(0)
+                Acks.Service(Clock())
+                Housekeeping()
+                IdleLoopTime.Observe(time.perf_counter() - Started)
+
+# Function to handle the packets the receiver thread has queued, then do the housekeeping
+def ProcessQueued():
+        Started = time.perf_counter()
+        for ReceiveTime, Pipe, receive_payload, Rpd in Receiver.GetPackets():
+                ProcessPacket(receive_payload, Pipe, Rpd, ReceiveTime)	# Stamped by the receiver thread at the IRQ, not now
+        Housekeeping()
+        QueueLoopTime.Observe(time.perf_counter() - Started)
+
+# The main Tkinter loop when polling the radio
+def Get_Weather_Updates():
+        PollRadio()
         Window.after(10, Get_Weather_Updates)
 
+# The main Tkinter loop when the IRQ line drives the receiver thread
+def Get_Weather_Updates_IRQ():
+        ProcessQueued()
+        Window.after(250, Get_Weather_Updates_IRQ)
+
+# The main loop of the headless station, the same work as the Tk loops above without a window
+def RunHeadless():
+        while True:
+                if Receiver is None:
+                        PollRadio()
+                        time.sleep(0.01)
+                else:
+                        time.sleep(0.25)
+                        ProcessQueued()
+
+# Function to print how long each startup phase took
+def ReportStartup():
+        for Name, Seconds in StartupTimes:
+                print("%-14s %8.1f ms" % (Name, Seconds * 1000))
+        print("%-14s %8.1f ms" % ("total", sum(Seconds for Name, Seconds in StartupTimes) * 1000))
+
+# Function to create the full screen Tk window and the Display in it
+def OpenWindow():
+        import tkinter as tk
+        from Display import Display
+        Window = tk.Tk()						# Instantiate Tkinter GUI
+        Window.title("Weather Station")
+        Window.attributes("-fullscreen", True)
+        Window.configure(bg="#2561A0")					# A nice blue background
+        return Window, Display(Window, RenderTime.Observe)			# Instantiate the main GUI WIndow
+
+# The Tkinter loop of a GUI attached to a headless station, showing whatever it publishes
+def Show_Station_Updates():
+        for Event, Data in Client.GetMessages():
+                if Event == "display":
+                        MainWindow.UpdateDisplay(Data)
+                elif Event == "history":
+                        MainWindow.UpdateTempHistory(Data)
+                elif Event == "signal":
+                        MainWindow.UpdateSignal(Data)
+        Window.after(100, Show_Station_Updates)
+
+
+# Local time from the station clock
+def LocalNow():
+        return datetime.datetime.fromtimestamp(Clock())
+
+# Function to open and configure the nRF24 radio
+def OpenRadio():
+        from RF24 import RF24, RF24_PA_HIGH, RF24_250KBPS
+        radio = RF24(22, 0);						# Instantiate Radio with CE on GPIO22
+        radio.begin()
+        radio.setAutoAck(True)
+        radio.enableAckPayload()
+        radio.enableDynamicPayloads()
+        radio.setPALevel(RF24_PA_HIGH)
+        radio.setDataRate(RF24_250KBPS)
+        for Pipe in STATIONS:
+                radio.openReadingPipe(Pipe,PipeAddress(ReadPipe,Pipe))		# Pipes 2-5 only use the last byte
+        radio.startListening()
+        return radio
+
+# Function to plug in the backends: the real hardware from the start up below, or fakes from Simulation.py
+def Initialise(RadioBackend, SamplerBackend, StationBackends, ClockBackend=time.time, ConfigFile='Config.ini', DisplayBackend=None):
+        global MainWindow
+        global radio
+        global IndoorSampler
+        global Stations
+        global Primary
+        global Acks
+        global Clock
+        global INIFile
+        global StartTime
+        global ReadRpd
+        radio = RadioBackend
+        ReadRpd = hasattr(radio, "testRPD")				# RF24 has it, not every wrapper does
+        IndoorSampler = SamplerBackend
+        Clock = ClockBackend
+        INIFile = ConfigFile
+        MainWindow = DisplayBackend					# The Tk Display is built later, once the stations exist
+        Stations = {}
+        for Station in StationBackends:
+                Station.Stats.AddListener(lambda Period, Bucket, Station=Station: StatsRollover(Station, Period, Bucket))
+                Stations[Station.Pipe] = Station
+        Primary = StationBackends[0]					# The station on the display
+        Acks = AckScheduler(radio, list(Stations), AckPayload)
+        Acks.Start()
+        StartTime = Clock()
+        for Station in StationBackends:
+                Meter.Collect("packets_received_total", "counter", "Packets received from a station", lambda Station=Station: Station.Packets, station=Station.Name, pipe=Station.Pipe)
+                Meter.Collect("signal_losses_total", "counter", "Times a station went quiet for longer than the signal timeout", lambda Station=Station: Station.SignalLosses, station=Station.Name)
+                Meter.Collect("rtc_offset_seconds", "gauge", "Station's RTC minus this clock, from its status packets", lambda Pipe=Station.Pipe: Acks.Offset[Pipe], station=Station.Name)
+                Meter.Collect("link_level", "gauge", "Signal bars on the display for the station, 0-5", lambda Station=Station: 0 if Station.SignalLost else Station.Link.Level(Clock()), station=Station.Name)
+                Meter.Collect("link_loss_ratio", "gauge", "Share of packets lost over the last hour of send cycles", lambda Station=Station: Station.Link.LongLoss(), station=Station.Name)
+                Meter.Collect("packets_lost_total", "counter", "Weather packets the link estimator counted as lost", lambda Station=Station: Station.Link.Lost, station=Station.Name)
+                Meter.Collect("link_rpd_ratio", "gauge", "Running share of packets above the nRF24 RPD threshold (-64 dBm)", lambda Station=Station: Station.Link.Rpd, station=Station.Name)
+                Meter.Collect("rtc_drift_seconds_per_day", "gauge", "Drift of the station's RTC since it was last set", lambda Pipe=Station.Pipe: Acks.Drift[Pipe], station=Station.Name)
+        Meter.Collect("acks_written_total", "counter", "ACK payloads loaded into the nRF24 TX FIFO", lambda: Acks.Writes)
+        Meter.Collect("acks_sent_total", "counter", "ACK payloads that went out with a packet", lambda: Acks.Sent)
+        Meter.Collect("ack_flushes_total", "counter", "Times the TX FIFO was flushed to free a slot", lambda: Acks.Flushes)
+        Meter.Collect("ack_age_seconds", "gauge", "Mean age of the ACK time when a weather packet takes it", lambda: Acks.SyncAge / Acks.SyncAcks if Acks.SyncAcks else None)
+
+# Function to build a station per configured pipe, each with its own store and fan-out to the upload sinks
+def OpenStations(DbPath, ArchivePath, CheckpointPath, IndexPath, SinksPath, Simulate=False):
+        if Simulate:
+                from Simulation import RecordingUploader
+        else:
+                Sinks = ReadSinks(SinksPath)
+                for Pipe, Sink in Sinks:
+                        Sink.Timer = Meter.Histogram("upload_request_seconds", "Upload request time on the sink's thread", sink=Sink.Name).Observe
+                        for Key, Kind in (("queue_depth", "gauge"), ("sent", "counter"), ("failed", "counter"), ("dropped", "counter"), ("rejected", "counter")):
+                                Meter.Collect("upload_%s%s" % (Key, "_total" if Kind == "counter" else ""), Kind, "Upload sink %s" % Key.replace("_", " "),
+                                              lambda Sink=Sink, Key=Key: Sink.Metrics()[Key], sink=Sink.Name)
+        StationList = []
+        for Pipe, Name in STATIONS.items():
+                if Simulate:
+                        Uploader = RecordingUploader()
+                else:
+                        Uploader = UploadFanOut(Name, [Sink for SinkPipe, Sink in Sinks if SinkPipe in (None, Pipe)])
+                StationList.append(StationState(Pipe, Name, SampleStore(StationFile(DbPath, Pipe)), Uploader, StationFile(ArchivePath, Pipe) if ArchivePath else None,
+                                                StationFile(CheckpointPath, Pipe) if CheckpointPath else None, StationFile(IndexPath, Pipe) if IndexPath else None))
+        return StationList
+
 
 #------------------------------------------------------------------------------------------------------
 # Start Here
@@ -521,72 +507,186 @@ def Get_Weather_Updates():
 
 # Global Variable
 
-GTimeCheckLast=0
-GStartDay = datetime.datetime.now()
-GStartHour = GStartDay
-GTimeoutStart = time.time()
-GTempOutFloat = 0
-GTempInFloat = 0
-# We need to set the current Max/Min ([0]) to something we can guarantee will be correctly updated
-# But the history max/min ([1:7]) can start with something that is displayable on the chart
-# Note that the chart gets history values from Config.ini so should never display these start values
-GTempOutMaxFloat = [-99,1,1,1,1,1,1]
-GTempOutMinFloat = [99,-1,-1,-1,-1,-1,-1]
-GITempOutMaxFloat = [-99,1,1,1,1,1,1]
-GITempOutMinFloat = [99,-1,-1,-1,-1,-1,-1]
-GTempInMaxFloat = -99
-GTempInMinFloat = 99
-GITempInMaxFloat = -99
-GITempInMinFloat = 99
-GHumidOutInt = 0
-GHumidInInt = 0
-GPressInt = 0
-GPressMaxInt = 0
-GPressMinInt = 9999
-GPressLastInt = 0
-GPressAvLastHour = 0
-GPressAvThisHour = 0
-GRainFloat = 0
-GRainHFloat = 0
-GWindSpeedInt = 0
-GWindGustInt = 0
-GWindDirInt = 0
-#GDayNight = True							# True = Day, False = Night
-GBattVoltageFloat = 0
-
-# Initialize everything
-
-DHT_SENSOR = Adafruit_DHT.DHT22
+# Everything received from the transmitters is kept per station, see Stations.py
+
+# Backends, set up by Initialise()
+
+radio = None
+IndoorSampler = None
+Stations = {}								# Pipe -> Station
+Primary = None								# The Station on the display
+Acks = None								# AckScheduler, serviced by the receiver thread in IRQ mode, clock reports come from the Tk thread
+Clock = time.time
+StartTime = 0
+INIFile = 'Config.ini'
+MainWindow = None
+Recorder = None								# Simulation.PacketRecorder when capturing payloads
+Web = None								# WebApi serving the snapshot and history
+Exporter = None								# MetricsServer for Prometheus
+Receiver = None								# RadioReceiver when the IRQ line is wired
+ReadRpd = False								# Radio has testRPD()
+NextCheckpoint = 0							# Clock() time the live state is next saved
+SavedPackets = {}							# Pipe -> the station's packet count at its last checkpoint
+Restored = {}								# Pipe -> (where from, samples replayed, why the checkpoint was not used) at startup
+RestoreTime = 0.0
+
+# Timing hooks and counters, exposed by MetricsServer and MetricsLog (see Metrics.py)
+
+Meter = Metrics()
+PacketLoopTime = Meter.Histogram("loop_seconds", "One pass of the receive loop", work="packet")
+IdleLoopTime = Meter.Histogram("loop_seconds", "One pass of the receive loop", work="idle")
+QueueLoopTime = Meter.Histogram("loop_seconds", "One pass of the receive loop", work="queue")
+IndoorTime = Meter.Histogram("indoor_read_seconds", "GetInsideTempHumid()")
+ParseTime = Meter.Histogram("parse_seconds", "ParsePayload()")
+DisplayTime = Meter.Histogram("display_update_seconds", "UpdateDisplay() on the receive loop")
+RenderTime = Meter.Histogram("display_render_seconds", "Display.Render() on the Tk thread")
+HistoryTime = Meter.Histogram("history_update_seconds", "UpdateTempHistory()")
+IniTime = Meter.Histogram("ini_write_seconds", "WriteINI(), the daily rollup of the sample store")
+ArchiveTime = Meter.Histogram("archive_export_seconds", "ArchiveDay(), adding a day to the per minute archive")
+UploadTime = Meter.Histogram("upload_submit_seconds", "Queuing a minute's upload on the receive loop")
+IndexTime = Meter.Histogram("index_minute_seconds", "Adding a minute to the history index and rolling it up")
+ParseFailures = dict((Name, Meter.Counter("parse_failures_total", "Packet fields that failed to parse, kind = packet of unknown type, crc = v2 frame failing its CRC, station = v2 station ID not the pipe's", field=Name)) for Name in FIELD_NAMES + ("kind", "crc", "station"))
+CheckpointEncodeTime = Meter.Histogram("checkpoint_encode_seconds", "EncodeCheckpoint() on the receive loop")
+CheckpointWriteTime = Meter.Histogram("checkpoint_write_seconds", "Writing, fsyncing and renaming a checkpoint, on the writer's thread")
+Checkpoints = CheckpointWriter(CheckpointWriteTime.Observe)
+Meter.Collect("checkpoint_writes_total", "counter", "Checkpoints written", lambda: Checkpoints.Writes)
+Meter.Collect("checkpoint_bytes_total", "counter", "Bytes of checkpoints written", lambda: Checkpoints.Bytes)
+Meter.Collect("checkpoint_failures_total", "counter", "Checkpoints that could not be written", lambda: Checkpoints.Failures)
+Frames = {PROTOCOL_ASCII: Meter.Counter("frames_total", "Packets received by payload format", protocol="ascii"),
+          PROTOCOL_V2: Meter.Counter("frames_total", "Packets received by payload format", protocol="v2")}
+EXPECTED_VALID = {KIND_WEATHER: VALID_WEATHER, KIND_STATUS: VALID_BATT}
+
+DHT_SENSOR = 22								# Adafruit_DHT.DHT22
 DHT_PIN = 4
-radio = RF24(22, 0);							# Instantiate Radio with CE on GPIO22
-Window = tk.Tk()							# Instantiate Tkinter GUI
-Window.title("Weather Station")
-Window.attributes("-fullscreen", True)
-Window.configure(bg="#2561A0")						# A nice blue background
-MainWindow = Display(Window)						# Instantiate the main GUI WIndow
-
 ReadPipe = 0x544d52687c							# RF Read pipe address - same as Arduino sender
 
-radio.begin()
-radio.setAutoAck(True)
-radio.enableAckPayload()
-radio.enableDynamicPayloads()
-radio.setPALevel(RF24_PA_HIGH)
-radio.setDataRate(RF24_250KBPS)
-radio.openReadingPipe(1,ReadPipe)
-radio.startListening()
+if __name__ == "__main__":
+
+# Command line options
+
+        parser = argparse.ArgumentParser(description="Weather Station receiver")
+        parser.add_argument("--irq-pin", type=int, default=irq_gpio_pin, help="BCM GPIO wired to the nRF24 IRQ line; receive by interrupt instead of polling")
+        parser.add_argument("--record", metavar="FILE", help="append every received payload with its timestamp to FILE for replay by Simulation.py")
+        parser.add_argument("--headless", action="store_true", help="run acquisition, storage and upload only, publishing the display state on --socket")
+        parser.add_argument("--attach", action="store_true", help="run the display only, showing the state a --headless station publishes on --socket")
+        parser.add_argument("--socket", default="WeatherStation.sock", help="Unix socket between --headless and --attach (default: %(default)s)")
+        parser.add_argument("--db", default="WeatherStation.db", help="sample store of the pipe 1 station, other pipes add -N to the name (default: %(default)s)")
+        parser.add_argument("--archive", default=ArchiveDir, help="per minute archive of the pipe 1 station, added to every midnight, other pipes add -N; empty to turn it off (default: %(default)s)")
+        parser.add_argument("--checkpoint", default=CheckpointFile, help="live state of the pipe 1 station, saved every %d minutes for a restart, other pipes add -N; empty to turn it off (default: %%(default)s)" % (CHECKPOINT_INTERVAL // 60))
+        parser.add_argument("--index", default=IndexDir, help="multi-resolution history of the pipe 1 station for the charts and /api/series, other pipes add -N; empty to turn it off (default: %(default)s)")
+        parser.add_argument("--sinks", default=SinksFile, help="upload sink configuration (default: %(default)s)")
+        parser.add_argument("--simulate", action="store_true", help="use the simulated radio, a fake DHT22 and a recording uploader instead of the hardware and ThingSpeak")
+        parser.add_argument("--http-port", type=int, default=WebPort, help="port of the local HTTP/JSON API, 0 to turn it off (default: %(default)s)")
+        parser.add_argument("--metrics-port", type=int, default=MetricsPort, help="port of the Prometheus /metrics endpoint, 0 to turn it off (default: %(default)s)")
+        parser.add_argument("--metrics-log", default=MetricsLogFile, help="rotating JSON log of the metrics, empty to turn it off (default: %(default)s)")
+        parser.add_argument("--profile-startup", action="store_true", help="print how long each startup phase took and exit before the main loop")
+        args = parser.parse_args()
+        irq_gpio_pin = args.irq_pin
+
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+# Display only: no radio, sensor, store or upload in this process
+
+        if args.attach:
+                from StateLink import StateClient
+                Window, MainWindow = OpenWindow()
+                StartupPhase("GUI build")
+                if args.profile_startup:
+                        ReportStartup()
+                        sys.exit(0)
+                Client = StateClient(args.socket)
+                Client.Start()
+                Window.after_idle(Show_Station_Updates)
+                Window.mainloop()
+                sys.exit(0)
 
-#Re-direct STDERR to log file
-sys.stderr = open('Errorlog.txt','w')
-
-# ThingSpeak
-BaseURL = 'https://api.thingspeak.com/update?api_key=%s' %MyAPI
+# Initialize everything
 
-# Get INI file data and display
-ReadINI()
-MainWindow.UpdateTempHistory()
+        if args.headless:
+                from StateLink import StateServer
+                StateDisplay = StateServer(args.socket)
+        else:
+                StateDisplay = None
+        if args.simulate:
+                from Simulation import SimClock, FakeDHT
+                from RadioReceiver import SimulatedRadio
+                Radio = SimulatedRadio()
+        else:
+                Radio = OpenRadio()
+        StartupPhase("radio init")
+        if args.simulate:
+                Sampler = DHTSampler(FakeDHT(SimClock(time.time())).Read)
+        else:
+                Sampler = DHTSampler(AdafruitReader(DHT_SENSOR, DHT_PIN))
+        Initialise(Radio, Sampler, OpenStations(args.db, args.archive, args.checkpoint, args.index, args.sinks, args.simulate), DisplayBackend=StateDisplay)
+        if args.record:
+                from Simulation import PacketRecorder
+                Recorder = PacketRecorder(args.record)
+        IndoorSampler.Start()
+        if args.http_port:
+                from WebApi import WebApi
+                Web = WebApi(args.db, args.http_port, station=Primary)	# Serves the station on the display
+        if args.metrics_port:
+                Exporter = MetricsServer(Meter, args.metrics_port)
+        StartupPhase("backends")
+        if not args.headless:
+                Window, MainWindow = OpenWindow()
+                StartupPhase("GUI build")
+
+#Re-direct STDERR to log file, keeping the last runs' as Errorlog.txt.1 and so on
+        if not args.profile_startup:
+                sys.stderr = RotatingStream('Errorlog.txt')
+
+# Upload sinks
+        for Station in Stations.values():
+                Station.Upload.Start()
+
+# Get history and today's state from the sample store and the checkpoint, and display
+        ReadINI()
+        StartupPhase("history load")
+        RestoreState()
+        StartupPhase("state restore")
+        UpdateTempHistory()
+        MainWindow.UpdateDisplay(Snapshot())
+        StartupPhase("first draw")
+        if args.profile_startup:
+                ReportStartup()
+                if Web is not None:
+                        Web.Server.server_close()
+                if Exporter is not None:
+                        Exporter.Server.server_close()
+                if args.headless:
+                        StateDisplay.Close()
+                sys.exit(0)
 
 # Begin Loop
 
-Window.after_idle(Get_Weather_Updates)
-Window.mainloop()
+        if Web is not None:
+                Web.Publish(Snapshot())
+                Web.Start()
+        if Exporter is not None:
+                Exporter.Start()
+        if args.metrics_log:
+                MetricsLog(Meter, args.metrics_log).Start()
+        Checkpoints.Start()
+
+        if irq_gpio_pin is not None:
+                Receiver = RadioReceiver(radio, GPIOIrqSource(irq_gpio_pin), Acks, clock=Clock)
+                Receiver.Start()
+        try:
+                if args.headless:
+                        try:
+                                RunHeadless()
+                        finally:
+                                StateDisplay.Close()
+                elif Receiver is None:
+                        Window.after_idle(Get_Weather_Updates)
+                        Window.mainloop()
+                else:
+                        Window.after_idle(Get_Weather_Updates_IRQ)
+                        Window.mainloop()
+        finally:
+                SaveState(Clock())						# A clean stop loses nothing
+                for Station in Stations.values():
+                        Station.Upload.Stop()					# Last try for the sinks without a backlog file, the rest save theirs
+                Checkpoints.Stop()
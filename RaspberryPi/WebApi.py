@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+
+# Local HTTP/JSON API for household dashboards
+#
+#       GET /api/current                 latest Snapshot() of the station
+#       GET /api/history?table=daily&start=2021-06-01&end=2021-07-01
+#       GET /api/history?table=hourly&start=<unix>&end=<unix>&limit=1000
+#       GET /api/recent?seconds=3600     the station's weather packets of the last seconds, up to 24 h
+#       GET /api/series?field=temp_out&start=<unix>&end=<unix>&points=400
+#                                        one field over any range at about points resolution, see HistoryIndex.py
+#       GET /api/events                  server-sent events, one "packet" event per packet
+#
+# The station calls Publish() once per packet. That encodes the snapshot to JSON once and wakes
+# the event streams, and everything else happens on the server's own threads: requests are
+# answered from the cached bytes, and history comes from a read-only connection to the sample
+# store, which WAL mode lets read alongside the station's writes. Recent packets are copied from
+# the station's ring buffer under its lock, and series are read from its history index. Current
+# and history send an ETag and answer If-None-Match with 304, for history without reading the
+# rows. An event stream that falls behind skips to the newest packet rather than queueing.
+#
+# Run this file directly for a local load test:
+#       python3 WebApi.py --load-test
+
+import http.server
+import urllib.parse
+import threading
+import json
+import time
+import os
+import sys
+import argparse
+from SampleStore import SampleStore, TABLE_KEYS
+from HistoryIndex import Downsample, POINTS
+
+HISTORY_LIMIT = 20000							# Most rows one history request returns
+SERIES_LIMIT = 4000							# Most points one series request returns
+KEEPALIVE = 15								# Seconds between comments on an idle event stream
+
+
+class ApiHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def Reply(self, status, body=b"", etag=None, contenttype="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", contenttype)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Access-Control-Allow-Origin", "*")	# Dashboards are usually served from somewhere else
+                if etag is not None:
+                        self.send_header("ETag", etag)
+                        self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                if self.command != "HEAD":
+                        self.wfile.write(body)
+
+        def Error(self, status, message):
+                self.Reply(status, json.dumps({"error": message}).encode('utf-8'))
+
+        def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                api = self.server.Api
+                if url.path == "/api/current":
+                        body, etag = api.Current()
+                        if body is None:
+                                self.Error(503, "no packet received yet")
+                        elif self.headers.get("If-None-Match") == etag:
+                                self.Reply(304, etag=etag)
+                        else:
+                                self.Reply(200, body, etag)
+                elif url.path == "/api/history":
+                        try:
+                                status, body, etag = api.History(query, self.headers.get("If-None-Match"))
+                        except (KeyError, ValueError) as error:
+                                self.Error(400, "bad history query: %s" % error)
+                                return
+                        self.Reply(status, body, etag)
+                elif url.path == "/api/recent":
+                        try:
+                                body = api.Recent(float(query.get("seconds", 3600)))
+                        except ValueError as error:
+                                self.Error(400, "bad recent query: %s" % error)
+                                return
+                        if body is None:
+                                self.Error(404, "no station to read recent packets from")
+                        else:
+                                self.Reply(200, body)
+                elif url.path == "/api/series":
+                        try:
+                                body = api.Series(query)
+                        except (KeyError, ValueError) as error:
+                                self.Error(400, "bad series query: %s" % error)
+                                return
+                        if body is None:
+                                self.Error(404, "no history index to read a series from")
+                        else:
+                                self.Reply(200, body)
+                elif url.path == "/api/events":
+                        self.Events(api)
+                else:
+                        self.Error(404, "no such endpoint")
+
+        do_HEAD = do_GET
+
+        def Events(self, api):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                self.close_connection = True
+                sequence = 0
+                try:
+                        while api.Running:
+                                body, sequence = api.WaitForPacket(sequence, KEEPALIVE)
+                                if body is None:
+                                        self.wfile.write(b": keep-alive\n\n")
+                                else:
+                                        self.wfile.write(b"event: packet\nid: %d\ndata: %s\n\n" % (sequence, body))
+                                self.wfile.flush()
+                except OSError:
+                        pass							# Dashboard went away
+
+        def log_message(self, *args):
+                pass								# stderr is the SD card error log, not an access log
+
+
+class WebApi():
+
+        def __init__(self, dbpath, port=8080, host="", station=None):
+                self.Store = SampleStore(dbpath, readonly=True)
+                self.Station = station						# StationState whose recent packets /api/recent serves
+                self.StoreLock = threading.Lock()
+                self.Changed = threading.Condition()
+                self.Sequence = 0
+                self.Body = None
+                self.Epoch = int(time.time())				# Part of every ETag, so a restart never matches an old one
+                self.Running = False
+                self.Server = http.server.ThreadingHTTPServer((host, port), ApiHandler)
+                self.Server.daemon_threads = True
+                self.Server.Api = self
+                self.Thread = None
+
+        def Start(self):
+                self.Running = True
+                self.Thread = threading.Thread(target=self.Server.serve_forever, name="WebApi", daemon=True)
+                self.Thread.start()
+
+        def Stop(self):
+                self.Running = False
+                with self.Changed:
+                        self.Changed.notify_all()
+                self.Server.shutdown()
+                self.Server.server_close()
+
+# Function called by the station for every packet, the only work the API adds to the radio loop
+        def Publish(self, State):
+                body = json.dumps(State).encode('utf-8')
+                with self.Changed:
+                        self.Sequence += 1
+                        self.Body = body
+                        self.Changed.notify_all()
+
+        def Current(self):
+                with self.Changed:
+                        return self.Body, '"%d-%d"' % (self.Epoch, self.Sequence)
+
+# Function to wait up to timeout for a packet after the given sequence number, returns (body or None, sequence)
+        def WaitForPacket(self, sequence, timeout):
+                with self.Changed:
+                        if not self.Changed.wait_for(lambda: self.Sequence != sequence or not self.Running, timeout) or not self.Running:
+                                return None, sequence
+                        return self.Body, self.Sequence
+
+# Function to get the station's packets received in the last seconds as JSON, None without a station
+        def Recent(self, seconds):
+                if self.Station is None:
+                        return None
+                columns, rows = self.Station.RecentSamples(time.time() - seconds)
+                return json.dumps({"columns": columns, "rows": rows}).encode('utf-8')
+
+# Function to get one field of the station from start to end at about points resolution, as JSON, None without an index.
+# Short ranges come from the packets in the store, the rest from the index
+        def Series(self, query):
+                if self.Station is None or self.Station.Index is None:
+                        return None
+                field = query.get("field", "temp_out")
+                end = float(query.get("end", time.time()))
+                start = float(query.get("start", end - 86400))
+                points = max(3, min(int(query.get("points", POINTS)), SERIES_LIMIT))	# LTTB keeps at least the first, one and the last
+                level, records = self.Station.Index.Range(field, start, end, points, self.Samples)
+                rows = [[when, count, round(low, 3), round(high, 3), round(mean, 3)] for when, count, low, high, mean in Downsample(records, points)]	# float32 back to the reading
+                return json.dumps({"field": field, "level": level, "columns": ["time", "count", "min", "max", "mean"], "rows": rows}).encode('utf-8')
+
+        def Samples(self, field, start, end):
+                with self.StoreLock:
+                        return self.Store.Samples(field, start, end)
+
+# Function to answer a history query, returns (status, body, etag)
+        def History(self, query, ifnonematch):
+                table = query.get("table", "daily")
+                if table not in TABLE_KEYS:
+                        raise KeyError(table)
+                if table == "daily":
+                        start = query.get("start", "0000-00-00")		# ISO dates compare as text
+                        end = query.get("end", "9999-99-99")
+                else:
+                        start = float(query.get("start", 0))
+                        end = float(query.get("end", 1e12))
+                limit = max(1, min(int(query.get("limit", HISTORY_LIMIT)), HISTORY_LIMIT))	# SQLite takes a negative LIMIT as none
+                with self.StoreLock:
+                        version = self.Store.RangeVersion(table, start, end)
+                        etag = '"%s"' % "-".join(str(part) for part in (table, start, end, limit) + tuple(version))
+                        if ifnonematch == etag:
+                                return 304, b"", etag
+                        columns, rows = self.Store.Range(table, start, end, limit)
+                return 200, json.dumps({"columns": columns, "rows": rows}).encode('utf-8'), etag
+
+
+#------------------------------------------------------------------------------------
+# Load test: dashboards polling and streaming while packets are published
+#------------------------------------------------------------------------------------
+
+def Get(connection, path, etag=None):
+        connection.request("GET", path, headers={"If-None-Match": etag} if etag else {})
+        response = connection.getresponse()
+        response.read()
+        return response.status, response.getheader("ETag")
+
+
+def Poller(port, paths, seconds, results):
+        import http.client
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        etags = {}
+        latencies = []
+        statuses = {}
+        stop = time.time() + seconds
+        while time.time() < stop:
+                for path in paths:
+                        started = time.perf_counter()
+                        status, etags[path] = Get(connection, path, etags.get(path))
+                        latencies.append(time.perf_counter() - started)
+                        statuses[status] = statuses.get(status, 0) + 1
+        results.append((latencies, statuses))
+
+
+def Streamer(port, seconds, counts):
+        import socket
+        connection = socket.create_connection(("127.0.0.1", port))
+        connection.sendall(b"GET /api/events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        connection.settimeout(1)
+        events = 0
+        stop = time.time() + seconds
+        while time.time() < stop:
+                try:
+                        data = connection.recv(65536)
+                except socket.timeout:
+                        continue
+                if not data:
+                        break
+                events += data.count(b"event: packet")
+        connection.close()
+        counts.append(events)
+
+
+def LoadTest(pollers, streamers, seconds, cadence):
+        import tempfile
+        import datetime
+        from Simulation import Simulator, GenerateCapture
+        start = datetime.datetime(2021, 6, 1).timestamp()
+        dbpath = os.path.join(tempfile.mkdtemp(), "WeatherStation.db")
+        sim = Simulator(start, dbpath)						# Two days of history to serve
+        sim.Replay(GenerateCapture(start, 2, cadence=60))
+        api = WebApi(dbpath, port=0, host="127.0.0.1")
+        api.Publish(sim.Display.State)						# As the station does at start up
+        api.Start()
+        port = api.Server.server_port
+        results = []
+        counts = []
+        paths = ["/api/current", "/api/history?table=hourly", "/api/history?table=daily", "/api/history?table=samples&start=%d&end=%d" % (start + 86400, start + 90000)]
+        threads = [threading.Thread(target=Poller, args=(port, paths, seconds, results)) for index in range(pollers)]
+        threads += [threading.Thread(target=Streamer, args=(port, seconds + 0.5, counts)) for index in range(streamers)]
+        for thread in threads:
+                thread.start()
+        time.sleep(0.2)
+        publish = []
+        published = 0
+        stop = time.time() + seconds
+        while time.time() < stop:						# The radio loop's side: one Publish per packet
+                state = sim.Display.State
+                started = time.perf_counter()
+                api.Publish(state)
+                publish.append(time.perf_counter() - started)
+                published += 1
+                time.sleep(cadence / 1000)
+        for thread in threads:
+                thread.join()
+        api.Stop()
+        latencies = sorted(latency for result in results for latency in result[0])
+        statuses = {}
+        for result in results:
+                for status, count in result[1].items():
+                        statuses[status] = statuses.get(status, 0) + count
+        publish.sort()
+        print("%d pollers: %d requests in %.0fs, %.0f req/s, latency p50 %.2f ms p95 %.2f ms, status %s" % (pollers, len(latencies), seconds, len(latencies) / seconds, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000, statuses))
+        print("%d event streams: %s of %d packets received" % (streamers, counts, published))
+        print("Publish() on the radio loop: mean %.1f us, p99 %.1f us, max %.1f us" % (sum(publish) / len(publish) * 1e6, publish[int(len(publish) * 0.99)] * 1e6, publish[-1] * 1e6))
+        return 0 if statuses.get(200) and not any(status >= 500 for status in statuses) else 1
+
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Weather Station local web API")
+        parser.add_argument("--load-test", action="store_true", help="poll and stream from a local server while packets are published")
+        parser.add_argument("--pollers", type=int, default=8, help="dashboards polling with If-None-Match")
+        parser.add_argument("--streamers", type=int, default=4, help="dashboards on the event stream")
+        parser.add_argument("--seconds", type=float, default=10)
+        parser.add_argument("--cadence", type=float, default=100, help="milliseconds between published packets")
+        args = parser.parse_args()
+        if not args.load_test:
+                parser.print_help()
+                sys.exit(0)
+        sys.exit(LoadTest(args.pollers, args.streamers, args.seconds, args.cadence))
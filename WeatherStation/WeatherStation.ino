@@ -33,6 +33,13 @@
  *                 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
  *                 
  *    The second packet has the battery voltage             
+ *    and, once a Unix time ACK has been received, the RTC offset from it in seconds: S 9 9 . 9 9 D + 9 9 9 9
+ *    The Raspberry Pi uses the offset to track the drift of the RTC.
+ *    
+ *    Once the Pi's ACK payload offers protocol v2 (" V2" after the Unix time) both packets are sent as binary
+ *    frames instead: fixed-point fields with 0.01 resolution, this station's ID, a sequence number that goes up
+ *    every 10s cycle, the peak gust of each 2s of the cycle and a CRC-16, in 29 and 11 bytes rather than 32 each.
+ *    The layout is documented in PayloadParser.py on the Pi. A Pi that does not offer v2 keeps getting ASCII.
  *    
  *    The Raspberry Pi receives, decodes and displays all data.
  *    The Raspberry Pi then sends current Unix time as am ACK Payload package.
@@ -47,6 +54,7 @@
 
 #include <avr/wdt.h>                                                                        // Watchdog timer
 #include <avr/interrupt.h>                                                                  // Interrupts
+#include <util/crc16.h>                                                                     // CRC for protocol v2 frames
 #include "nRF24L01.h"
 #include "RF24.h"
 #include <TimeLib.h>
@@ -79,6 +87,16 @@
 #define LCD_UPDATE_TIME 2000.0
 #define WIND_GUST_LOOP_TIME 500.0
 
+// Protocol v2
+#define STATION_ID 1                // Sent in every v2 frame, must be WritePipe's pipe on the Pi (1 for 7C, 2 for 7D...)
+#define PROTOCOL_ASCII 1
+#define PROTOCOL_V2 2
+#define KIND_WEATHER 1
+#define KIND_STATUS 2
+#define GUST_SAMPLES 5              // Peak gusts sent per 10s cycle, one per 2s
+#define UNMEASURED 0xFFFF           // Unsigned field with no reading
+#define UNMEASURED_SIGNED -32768    // Signed field with no reading
+
 
 // Initialize RainHourBuffer
 CircularBuffer<unsigned long,60> RainHourBuffer;      // 1 element per 0.3mm of rain
@@ -108,11 +126,17 @@ time_t LocalServerTime;
 
 
 // Radio Write pipe address - read pipe not needed since we use AutoAck function to get UnixTime
+// The Pi listens on pipe 1 (7C) and pipes 2-5 (7D, 7E, 7F, 80) - give each extra sensor head its own
 const uint64_t WritePipe = 0x544d52687CLL;
 
 // Initialize various strings
 char PayloadString[] = "T00.0H00P0000R000.0r00.9W0000000";
 char AckPayload[33];                // Returned Unix time from Pi
+byte Frame[32];                     // Protocol v2 frame being sent
+byte FrameLength;
+unsigned int Sequence;              // Protocol v2 frame sequence number, one per send cycle
+byte PiProtocol = PROTOCOL_ASCII;   // Highest protocol the Pi has offered in its ACK payload
+byte GustSamples[GUST_SAMPLES];     // Peak gust of each slice of this send cycle in 0.5 mph
 char DateTimeString[17];            // For display on LCD
 byte BottomLineDataCycle;           // Cycling weather information counter on Bottom line of LCD
 
@@ -144,6 +168,7 @@ int WindDirectionDegrees[] = {0,22,45,67,90,112,135,157,180,202,225,247,270,292,
 
 // Wind variables
 unsigned long WindSpeed;            // Average over a rolling 10 minute cycle
+float WindSpeedAverage;             // The same before rounding down, for protocol v2
 int WindDirection;                  // Average over a rolling 10 minute cycle
 byte WindDirIndex;                  // Index value of Wind Direction voltage array value
 byte WindGust;                      // Peak value over a rolling 10 minute cycle
@@ -167,6 +192,8 @@ long MaxUnixTime = 1924905600; // December 31st 2030
 long MinUnixTime = 1569888000; // October 1st 2019
 long ReturnUnixTime;
 bool TimeValid;               //Indicates return payload time stamp from Raspberry Pi is valid.
+long ClockOffset;             // RTC minus the last valid Unix time from the Pi, reported in the status packet
+bool ClockOffsetValid = false;
 
 // BME280 Sensor Found?
 boolean SensorFound;
@@ -191,7 +218,7 @@ void setup()
     lcd.setCursor(0,0);
     lcd.print("Weather Station.");
     lcd.setCursor(0,1);
-    lcd.print("  Version 1.3   ");
+    lcd.print("  Version 1.4   ");
 
 
   // Setup and configure rf radio
@@ -269,6 +296,10 @@ void loop(void)
     ThisWindSpeed = WindGustInterruptCounter*2.984;
     if (ThisWindSpeed > ThisWindGust)
       ThisWindGust = ThisWindSpeed;                             // This captured gust is bigger than any since the last 10 second cycle
+    long UntilSend = (long)(NextMainCycle - LoopMillis);        // Which slice of the send cycle this gust falls in
+    int Slice = GUST_SAMPLES - 1 - constrain(UntilSend, 0L, (long)MAIN_LOOP_TIME - 1) * GUST_SAMPLES / (long)MAIN_LOOP_TIME;
+    if (ThisWindSpeed * 2 > GustSamples[Slice])
+      GustSamples[Slice] = constrain(ThisWindSpeed * 2, 0, 255);
     WindGustInterruptCounter = 0;                               // Reset WindGust interrupt for next cycle
     }
       
@@ -329,6 +360,7 @@ void loop(void)
     PrintDateTime(LocalTime);
     VoltageSent = false;                                          // We will send Battery voltage once after sending weather data
     NextMainCycle = millis()+ MAIN_LOOP_TIME;                     // calculate time of next update
+    Sequence++;                                                   // The weather and status packets of a cycle share a sequence number
     RainPerHour=0;                                                // Initialize Rain Per Hour indicator
     WindSpeed=0;                                                  // Initialise wind speed for average calculation
     WindDirection=0;                                              // Initialise Wind direction for average calculation
@@ -422,6 +454,7 @@ void loop(void)
     PayloadString[24]='W';                                      // Set Wind marker in Payload string
     for (int WindLoop = 0; WindLoop < WindSpeedBuffer.size(); WindLoop++)
         WindSpeed+=WindSpeedBuffer[WindLoop];
+    WindSpeedAverage = (float)WindSpeed / WindSpeedBuffer.size();
     WindSpeed = WindSpeed / WindSpeedBuffer.size();
    
 
@@ -454,19 +487,97 @@ void loop(void)
       }
 
 
-    SendToRadio(true);
+    if (PiProtocol >= PROTOCOL_V2)
+      {
+      StartFrame(KIND_WEATHER);
+      if (SensorFound)
+        {
+        PutInt(5, constrain(round(CorrectedTemperature * 100), -32767L, 32767L));
+        PutInt(7, FixedPoint(CorrectedHumidity, 100, 10000));
+        PutInt(9, FixedPoint(PressureArray[1]/100 * PRESS_CAL, 10, 0xFFFE));
+        }
+      else
+        {
+        PutInt(5, UNMEASURED_SIGNED);
+        PutInt(7, UNMEASURED);
+        PutInt(9, UNMEASURED);
+        }
+      PutInt(11, FixedPoint(RainBucket, 100, 0xFFFE));
+      PutInt(13, FixedPoint(RainPerHour, 100, 0xFFFE));
+      PutInt(15, FixedPoint(WindSpeedAverage, 100, 0xFFFE));
+      PutInt(17, FixedPoint(LCD_WindGust, 100, 0xFFFE));
+      PutInt(19, FixedPoint(WindDirection, 10, 3600));
+      Frame[21] = GUST_SAMPLES;
+      for (int i = 0; i < GUST_SAMPLES; i++) Frame[22 + i] = GustSamples[i];
+      FinishFrame(22 + GUST_SAMPLES);
+      SendToRadio(true, Frame, FrameLength);
+      }
+    else
+      SendToRadio(true, PayloadString, 32);
+    memset(GustSamples, 0, GUST_SAMPLES);                       // Start the next cycle's gust slices
     }
   else if (VoltageSent == false) // Send status just once after every data send
     {  
       BattValue= analogRead(BatteryPin) / BATTERY_CAL;
-      PayloadString[0] = 'S';     
-      dtostrf(BattValue,4,2,ReadString);
-      for (int i = 1; i <6; i++) PayloadString[i] = ReadString[i-1];
-      SendToRadio(false);
+      if (PiProtocol >= PROTOCOL_V2)
+        {
+        StartFrame(KIND_STATUS);
+        PutInt(5, FixedPoint(BattValue, 1000, 0xFFFE));
+        PutInt(7, ClockOffsetValid ? constrain(ClockOffset, -32767L, 32767L) : UNMEASURED_SIGNED);
+        FinishFrame(9);
+        SendToRadio(false, Frame, FrameLength);
+        }
+      else
+        {
+        PayloadString[0] = 'S';     
+        dtostrf(BattValue,4,2,ReadString);
+        for (int i = 1; i <6; i++) PayloadString[i] = ReadString[i-1];
+        if (ClockOffsetValid)
+          {
+          PayloadString[6] = 'D';
+          sprintf(ReadString,"%+05ld",constrain(ClockOffset,-9999L,9999L));
+          for (int i = 7; i < 12; i++) PayloadString[i] = ReadString[i-7];
+          }
+        SendToRadio(false, PayloadString, 32);
+        }
       VoltageSent = true;
     }
 }
 
+// Protocol v2 frame helpers - little-endian, as the Pi unpacks them
+void PutInt(byte Position, int Value)
+  {
+  Frame[Position] = Value & 0xFF;
+  Frame[Position + 1] = (Value >> 8) & 0xFF;
+  }
+
+unsigned int FixedPoint(float Value, float Scale, unsigned int Highest)
+  {
+  float Scaled = Value * Scale + 0.5;                                 // Rounded, and clamped rather than wrapped
+  if (Scaled < 0)
+    return 0;
+  if (Scaled > Highest)
+    return Highest;
+  return (unsigned int)Scaled;
+  }
+
+void StartFrame(byte Kind)
+  {
+  Frame[0] = PROTOCOL_V2;
+  Frame[1] = Kind;
+  Frame[2] = STATION_ID;
+  PutInt(3, Sequence);
+  }
+
+void FinishFrame(byte Length)
+  {
+  uint16_t Crc = 0xFFFF;                                              // CRC-16/CCITT-FALSE, binascii.crc_hqx(frame, 0xFFFF) on the Pi
+  for (byte i = 0; i < Length; i++)
+    Crc = _crc_xmodem_update(Crc, Frame[i]);
+  PutInt(Length, Crc);
+  FrameLength = Length + 2;
+  }
+
 int AverageWindDirection(int BufferSize)
   {
   float SinTotal=0;
@@ -488,11 +599,11 @@ int AverageWindDirection(int BufferSize)
   return (Direction%360);
   }
 
-void SendToRadio(bool SyncPayload)
+void SendToRadio(bool SyncPayload, const void *Payload, byte Length)
   {
   int ReturnPayloadLength;
   lcd.setCursor(5,1);
-  if (radio.write(PayloadString, 32)) 
+  if (radio.write(Payload, Length)) 
     LastTransmit=true;
   else
     LastTransmit=false;
@@ -506,6 +617,8 @@ void SendToRadio(bool SyncPayload)
       radio.read(&AckPayload, ReturnPayloadLength);
       AckPayload[ReturnPayloadLength]=0;
       ReturnUnixTime = atol(AckPayload);
+      char *Offer = strchr(AckPayload, 'V');                      // " V2" after the time from a Pi that takes protocol v2
+      PiProtocol = (Offer != NULL && atoi(Offer + 1) >= PROTOCOL_V2) ? PROTOCOL_V2 : PROTOCOL_ASCII;
       }
     else
     // Nonsensical payload
@@ -516,6 +629,8 @@ void SendToRadio(bool SyncPayload)
       {
       if ((ReturnUnixTime>MinUnixTime) && (ReturnUnixTime<MaxUnixTime))
         {
+        ClockOffset = (long)(rtc.now().unixtime() - ReturnUnixTime);  // Before SyncToRTC corrects it
+        ClockOffsetValid = true;
         if (!TimeSynced)
           SyncToRTC(ReturnUnixTime);
         TimeValid=true;           